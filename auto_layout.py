@@ -0,0 +1,135 @@
+"""自动排版
+
+按每一页的实际尺寸（只读取尺寸，不渲染）把页面排到输出页面上，代替固定的 行 x 列 网格。
+使用货架装箱（shelf packing）：页面按原始比例缩放后从左到右放入一行（货架），放不下时
+另起一行，页面高度放不下时换下一张输出页面。每张输出页面分别尝试纵向和横向，选择能
+装下更多页面的方向，所以每张输出页面的行列数都可以不同。
+
+所有页面使用同一个缩放比例（不放大）：先按最小可读比例求出最少的输出页数，再二分查找
+不增加页数的最大比例。装箱只做简单的算术，数千个页面也只需要很短的时间。
+
+页面按输入顺序装入输出页面，不会移到前面的输出页面上；同一张输出页面内，后面较小的
+页面可能放进前面一行的空位。
+"""
+from collections import namedtuple
+
+# 输出页面四周的留白和页面之间的间距（点）
+DEFAULT_MARGIN = 14.0
+DEFAULT_SPACING = 8.0
+# 默认的最小可读缩放比例（相对于页面原始尺寸）
+DEFAULT_MIN_SCALE = 0.5
+# 页面最多按原始尺寸放置，不会放大
+MAX_SCALE = 1.0
+# 二分查找缩放比例的次数，精度约为 (MAX_SCALE - 最小比例) / 2**SCALE_SEARCH_STEPS
+SCALE_SEARCH_STEPS = 12
+# 浮点误差容限（点）
+EPSILON = 1e-6
+
+# 一张输出页面：width/height 为尺寸（点），boxes 为按输入顺序排列的各页放置区域 (x0, y0, x1, y1)，
+# 左上角为原点；输出页面依次包含连续的 len(boxes) 个页面
+Sheet = namedtuple('Sheet', 'width height boxes')
+
+
+def _fill_sheet(sizes, start, scale, sheet_size, margin, spacing, boxes=None):
+    """从 sizes[start] 开始尽可能多地装入一张输出页面，返回装入的页面数
+
+    提供列表 boxes 时追加各页的放置区域。比输出页面还大的页面单独缩小到能放下，
+    所以每张输出页面至少能装入一个页面。
+    """
+    content_width = sheet_size[0] - 2 * margin
+    content_height = sheet_size[1] - 2 * margin
+    # 每个货架为 [顶部位置, 高度, 已用宽度]
+    shelves = []
+    placed = []
+    i = start
+    while i < len(sizes):
+        width, height = sizes[i]
+        width, height = max(width, EPSILON), max(height, EPSILON)
+        fit = min(scale, content_width / width, content_height / height)
+        width, height = width * fit, height * fit
+
+        shelf_no = None
+        for k, (top, shelf_height, used) in enumerate(shelves):
+            if used + spacing + width <= content_width + EPSILON and height <= shelf_height + EPSILON:
+                shelf_no = k
+                break
+        if shelf_no is None and shelves:
+            # 最后一行下面没有内容，可以加高
+            top, shelf_height, used = shelves[-1]
+            if (used + spacing + width <= content_width + EPSILON
+                    and top + height <= content_height + EPSILON):
+                shelves[-1][1] = height
+                shelf_no = len(shelves) - 1
+        if shelf_no is None:
+            top = shelves[-1][0] + shelves[-1][1] + spacing if shelves else 0.0
+            if shelves and top + height > content_height + EPSILON:
+                break
+            shelves.append([top, height, -spacing])
+            shelf_no = len(shelves) - 1
+
+        shelf = shelves[shelf_no]
+        placed.append((shelf_no, shelf[2] + spacing, width, height))
+        shelf[2] += spacing + width
+        i += 1
+
+    if boxes is not None:
+        # 每一行水平居中，行内的页面垂直居中
+        for shelf_no, x, width, height in placed:
+            top, shelf_height, used = shelves[shelf_no]
+            x0 = margin + (content_width - used) / 2 + x
+            y0 = margin + top + (shelf_height - height) / 2
+            boxes.append((x0, y0, x0 + width, y0 + height))
+    return i - start
+
+
+def _pack(sizes, scale, sheet_sizes, margin, spacing, limit=None, sheets=None):
+    """按缩放比例 scale 装箱，返回输出页数；超过 limit 页时提前停止并返回 limit + 1
+
+    提供列表 sheets 时追加每张输出页面的 Sheet。
+    """
+    count = 0
+    start = 0
+    while start < len(sizes):
+        if limit is not None and count >= limit:
+            return limit + 1
+        best = None
+        for sheet_size in sheet_sizes:
+            boxes = [] if sheets is not None else None
+            filled = _fill_sheet(sizes, start, scale, sheet_size, margin, spacing, boxes)
+            # 装入数量相同时使用靠前的（首选的）方向
+            if best is None or filled > best[0]:
+                best = filled, sheet_size, boxes
+        filled, sheet_size, boxes = best
+        if sheets is not None:
+            sheets.append(Sheet(sheet_size[0], sheet_size[1], boxes))
+        start += filled
+        count += 1
+    return count
+
+
+def plan(sizes, sheet_sizes, min_scale=DEFAULT_MIN_SCALE, max_scale=MAX_SCALE,
+         margin=DEFAULT_MARGIN, spacing=DEFAULT_SPACING):
+    """把尺寸为 sizes（[(宽, 高)]，单位为点）的页面排到输出页面上，返回 (缩放比例, [Sheet])
+
+    sheet_sizes 为可选的输出页面尺寸（通常是同一纸张的纵向和横向），靠前的优先。
+    缩放比例在 min_scale 到 max_scale 之间，是输出页数最少时的最大比例。
+    """
+    if not 0 < min_scale <= max_scale:
+        raise ValueError(f'缩放比例范围无效：{min_scale} - {max_scale}')
+    sheet_sizes = list(sheet_sizes)
+    target = _pack(sizes, min_scale, sheet_sizes, margin, spacing)
+    if _pack(sizes, max_scale, sheet_sizes, margin, spacing, target) <= target:
+        scale = max_scale
+    else:
+        # low 时的页数不超过 target，high 时超过
+        low, high = min_scale, max_scale
+        for _ in range(SCALE_SEARCH_STEPS):
+            middle = (low + high) / 2
+            if _pack(sizes, middle, sheet_sizes, margin, spacing, target) <= target:
+                low = middle
+            else:
+                high = middle
+        scale = low
+    sheets = []
+    _pack(sizes, scale, sheet_sizes, margin, spacing, sheets=sheets)
+    return scale, sheets
@@ -0,0 +1,291 @@
+"""合并与预览热点路径的基准测试
+
+在本地生成测试语料（矢量PDF、扫描件PDF、大尺寸JPEG/PNG/TIFF照片、多页PDF），
+按不同的网格、页面方向和文件数量运行合并引擎，记录耗时、每秒页数、峰值内存
+和输出大小，结果以JSON保存，便于比较不同版本的性能。
+
+每个用例都在独立的子进程中运行，峰值内存互不影响。
+
+    python benchmarks/bench_merge.py -o before.json
+    python benchmarks/bench_merge.py -o after.json --compare before.json
+    python benchmarks/bench_merge.py --full -o full.json
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+# 语料格式版本，生成逻辑变化时加1，旧语料会被重新生成
+CORPUS_VERSION = 1
+# 每种语料生成的不同文件数，更大的批量循环使用这些文件
+CORPUS_VARIANTS = 4
+
+KINDS = ('vector', 'scanned', 'photo-jpeg', 'photo-png', 'photo-tiff', 'multipage')
+GRIDS = ('1x1', '2x2', '3x2', '4x4')
+ORIENTATIONS = ('portrait', 'landscape')
+QUICK_COUNTS = (10, 100)
+FULL_COUNTS = (10, 100, 1000, 5000)
+MODES = ('merge', 'preview')
+
+
+def default_corpus_dir():
+    return os.path.join(tempfile.gettempdir(), 'pdf_merger_bench_corpus')
+
+
+def _make_vector_pdf(path, rng, pages=1):
+    import fitz
+    with fitz.open() as doc:
+        for page_no in range(pages):
+            page = doc.new_page(width=595, height=420)
+            page.draw_rect(fitz.Rect(30, 30, 565, 390), color=(0.8, 0, 0), width=1.5)
+            for row in range(12):
+                y = 70 + row * 24
+                page.draw_line((30, y + 6), (565, y + 6), color=(0.8, 0.4, 0.4), width=0.5)
+                text = f'Item {page_no}-{row}  qty {rng.randint(1, 99)}  amount {rng.uniform(1, 9999):.2f}'
+                page.insert_text((40, y), text, fontsize=9)
+        doc.save(path, garbage=3, deflate=True)
+
+
+def _noise_image(size, rng, mode='RGB'):
+    from PIL import Image, ImageDraw
+    # 低分辨率噪声放大后更接近照片的纹理，也不会让PNG/TIFF大到不合理
+    base = Image.effect_noise((size[0] // 8, size[1] // 8), 40).resize(size, Image.BICUBIC).convert(mode)
+    draw = ImageDraw.Draw(base)
+    for _ in range(30):
+        x0, y0 = rng.randrange(size[0]), rng.randrange(size[1])
+        x1, y1 = x0 + rng.randrange(50, size[0] // 3), y0 + rng.randrange(20, size[1] // 8)
+        fill = tuple(rng.randrange(256) for _ in range(3)) if mode == 'RGB' else rng.randrange(256)
+        draw.rectangle([x0, y0, x1, y1], fill=fill)
+    return base
+
+
+def _make_scanned_pdf(path, rng):
+    import io
+    import fitz
+    # 200 DPI 的A4灰度扫描件
+    image = _noise_image((1654, 2339), rng, 'L')
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=80)
+    with fitz.open() as doc:
+        page = doc.new_page(width=595, height=842)
+        page.insert_image(page.rect, stream=buffer.getvalue())
+        doc.save(path)
+
+
+def _make_photo(path, rng, image_format):
+    # 1200万像素的手机照片
+    image = _noise_image((4000, 3000), rng)
+    if image_format == 'JPEG':
+        image.save(path, image_format, quality=90)
+    else:
+        image.save(path, image_format)
+
+
+def build_corpus(corpus_dir, variants=CORPUS_VARIANTS):
+    """生成（或复用已有的）测试语料，返回 {语料类型: [文件路径]}"""
+    marker = os.path.join(corpus_dir, f'corpus-v{CORPUS_VERSION}-{variants}.json')
+    if os.path.exists(marker):
+        with open(marker, encoding='utf-8') as f:
+            return json.load(f)
+
+    os.makedirs(corpus_dir, exist_ok=True)
+    rng = random.Random(20250613)
+    corpus = {kind: [] for kind in KINDS}
+    for i in range(variants):
+        path = os.path.join(corpus_dir, f'vector_{i}.pdf')
+        _make_vector_pdf(path, rng)
+        corpus['vector'].append(path)
+
+        path = os.path.join(corpus_dir, f'scanned_{i}.pdf')
+        _make_scanned_pdf(path, rng)
+        corpus['scanned'].append(path)
+
+        for kind, ext, image_format in (('photo-jpeg', 'jpg', 'JPEG'), ('photo-png', 'png', 'PNG'),
+                                        ('photo-tiff', 'tif', 'TIFF')):
+            path = os.path.join(corpus_dir, f'{kind}_{i}.{ext}')
+            _make_photo(path, rng, image_format)
+            corpus[kind].append(path)
+
+        path = os.path.join(corpus_dir, f'multipage_{i}.pdf')
+        _make_vector_pdf(path, rng, pages=20)
+        corpus['multipage'].append(path)
+
+    with open(marker, 'w', encoding='utf-8') as f:
+        json.dump(corpus, f, ensure_ascii=False, indent=2)
+    return corpus
+
+
+def run_case(case):
+    """在当前进程中运行一个用例并返回测量结果"""
+    import merge_engine
+
+    inputs = list(itertools.islice(itertools.cycle(case['files']), case['count']))
+    rows, cols = (int(n) for n in case['grid'].split('x'))
+    errors = []
+    start = time.perf_counter()
+    if case['mode'] == 'preview':
+        data = merge_engine.render_preview(inputs, rows, cols, case['orientation'],
+                                           on_error=errors.append)
+        wall = time.perf_counter() - start
+        output_pages = 1
+        output_bytes = len(data or b'')
+        # 预览只渲染第一张输出页面，按渲染的图块数计算速度
+        tiles = len(merge_engine.sheet_inputs(merge_engine.expand_pages(inputs), 0, rows, cols))
+        rate = {'tiles': tiles, 'tiles_per_s': round(tiles / wall, 2) if wall > 0 else None}
+    else:
+        stats = {}
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output = os.path.join(temp_dir, 'out.pdf')
+            output_pages = merge_engine.merge(
+                inputs, rows, cols, case['orientation'], output,
+                rasterize=case['rasterize'], on_error=errors.append, workers=case['workers'],
+                stats=stats, stream=case['stream'], profile=case['quality'])
+        wall = time.perf_counter() - start
+        output_bytes = stats['output_bytes']
+        # 多页PDF的每一页各占一个单元格，按展开后的输入页数计算速度
+        pages = stats['input_pages']
+        rate = {'input_pages': pages, 'pages_per_s': round(pages / wall, 2) if wall > 0 else None}
+
+    result = {key: value for key, value in case.items() if key != 'files'}
+    result.update({
+        'wall_s': round(wall, 4),
+        **rate,
+        'output_pages': output_pages,
+        'output_bytes': output_bytes,
+        'peak_rss': merge_engine.peak_rss(),
+        'errors': len(errors),
+    })
+    return result
+
+
+def case_key(result):
+    """用于在两次运行之间匹配同一用例的键"""
+    return '|'.join(str(result[k]) for k in ('mode', 'kind', 'grid', 'orientation', 'count',
+                                              'workers', 'stream', 'quality', 'rasterize'))
+
+
+def run_case_subprocess(case, timeout):
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--case', json.dumps(case)],
+                          capture_output=True, text=True, timeout=timeout)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else
+                           f'子进程退出码 {proc.returncode}')
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def environment_info():
+    import fitz
+    import PIL
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR,
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'git_commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'pymupdf': fitz.VersionBind,
+        'pillow': PIL.__version__,
+    }
+
+
+def compare(results, baseline_path):
+    """打印与基线结果的耗时对比"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {case_key(r): r for r in json.load(f)['results'] if 'wall_s' in r}
+    print(f'\n与基线 {baseline_path} 对比（耗时比例 < 1 表示更快）：', file=sys.stderr)
+    for result in results:
+        old = baseline.get(case_key(result))
+        if old is None or 'wall_s' not in result:
+            continue
+        ratio = result['wall_s'] / old['wall_s'] if old['wall_s'] else float('nan')
+        size_ratio = (result['output_bytes'] / old['output_bytes']) if old['output_bytes'] else float('nan')
+        print(f'  {case_key(result)}: 耗时 {old["wall_s"]:.3f}s -> {result["wall_s"]:.3f}s '
+              f'(x{ratio:.2f})，输出大小 x{size_ratio:.2f}', file=sys.stderr)
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description='合并与预览热点路径的基准测试')
+    parser.add_argument('-o', '--output', help='结果JSON保存路径（默认输出到标准输出）')
+    parser.add_argument('--compare', help='与之前保存的结果JSON对比')
+    parser.add_argument('--full', action='store_true',
+                        help='运行完整矩阵：所有网格、两种方向、10~5000个文件')
+    parser.add_argument('--kinds', nargs='+', choices=KINDS, default=list(KINDS))
+    parser.add_argument('--grids', nargs='+', default=None, help='网格，如 3x2（快速模式默认3x2）')
+    parser.add_argument('--orientations', nargs='+', choices=ORIENTATIONS, default=None)
+    parser.add_argument('--counts', nargs='+', type=int, default=None, help='每个用例的文件数')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('-j', '--workers', type=int, default=1, help='合并时的工作进程数')
+    parser.add_argument('--stream', action='store_true', help='使用流式写出')
+    parser.add_argument('--quality', default='print', help='质量配置名称')
+    parser.add_argument('--rasterize', action='store_true', help='栅格化输出')
+    parser.add_argument('--corpus-dir', default=default_corpus_dir(), help='语料目录')
+    parser.add_argument('--timeout', type=float, default=3600, help='单个用例的超时时间（秒）')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return 0
+
+    grids = args.grids or (list(GRIDS) if args.full else ['3x2'])
+    orientations = args.orientations or (list(ORIENTATIONS) if args.full else ['portrait'])
+    counts = args.counts or list(FULL_COUNTS if args.full else QUICK_COUNTS)
+
+    print(f'准备语料：{args.corpus_dir}', file=sys.stderr)
+    corpus = build_corpus(args.corpus_dir)
+
+    results = []
+    cases = itertools.product(args.modes, args.kinds, grids, orientations, counts)
+    for mode, kind, grid, orientation, count in cases:
+        case = {
+            'mode': mode, 'kind': kind, 'grid': grid, 'orientation': orientation,
+            'count': count, 'workers': args.workers, 'stream': args.stream,
+            'quality': args.quality, 'rasterize': args.rasterize, 'files': corpus[kind],
+        }
+        try:
+            result = run_case_subprocess(case, args.timeout)
+        except (RuntimeError, subprocess.TimeoutExpired) as e:
+            result = {key: value for key, value in case.items() if key != 'files'}
+            result['error'] = str(e)
+        results.append(result)
+        if 'error' in result:
+            print(f'  {case_key(result)}: 失败 - {result["error"]}', file=sys.stderr)
+        else:
+            if result['mode'] == 'preview':
+                rate = f'{result["tiles_per_s"]} 图块/秒'
+            else:
+                rate = f'{result["pages_per_s"]} 页/秒'
+            print(f'  {case_key(result)}: {result["wall_s"]:.3f}s, {rate}, '
+                  f'峰值内存 {(result["peak_rss"] or 0) / 1048576:.0f} MB, '
+                  f'输出 {result["output_bytes"] / 1024:.0f} KB', file=sys.stderr)
+
+    report = {'environment': environment_info(), 'results': results}
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.compare:
+        compare(results, args.compare)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""启动耗时测量
+
+反复启动图形界面（脚本或 PyInstaller 打包后的程序），测量从启动进程到主窗口显示的
+耗时。被测程序在设置了 PDF_MERGER_STARTUP_CHECK 环境变量时会在窗口显示后立即
+退出，并把程序内部测得的耗时（从执行 pdf_merger.py 到窗口显示）写入统计文件。
+
+    python benchmarks/bench_startup.py                              # 测量 pdf_merger.py
+    python benchmarks/bench_startup.py --exe dist/pdf_merger/pdf_merger.exe -o frozen.json
+
+结果中 wall_s 为进程启动到退出的总耗时（包含解释器启动、打包程序解压和加载），
+window_ms 为程序内部测得的从开始导入到窗口显示的耗时。
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STARTUP_CHECK_ENV = 'PDF_MERGER_STARTUP_CHECK'
+METRICS_ENV = 'PDF_MERGER_METRICS'
+
+
+def measure_once(command, work_dir, timeout):
+    """启动一次程序，返回 (总耗时秒数, 程序内部测得的窗口显示耗时毫秒数或 None)"""
+    metrics_path = os.path.join(work_dir, 'metrics.jsonl')
+    if os.path.exists(metrics_path):
+        os.unlink(metrics_path)
+    env = dict(os.environ)
+    env[STARTUP_CHECK_ENV] = '1'
+    env[METRICS_ENV] = metrics_path
+    start = time.perf_counter()
+    proc = subprocess.run(command, cwd=work_dir, env=env, capture_output=True, text=True,
+                          timeout=timeout)
+    wall = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip() or f'程序退出码 {proc.returncode}')
+
+    window_ms = None
+    if os.path.exists(metrics_path):
+        with open(metrics_path, encoding='utf-8') as f:
+            for line in f:
+                event = json.loads(line)
+                if event.get('name') == 'startup':
+                    window_ms = event['ms']
+    return wall, window_ms
+
+
+def summarize(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    return {'min': round(min(values), 4), 'median': round(statistics.median(values), 4),
+            'max': round(max(values), 4)}
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description='测量图形界面从启动到窗口显示的耗时')
+    parser.add_argument('--exe', help='打包后的程序路径（默认测量 pdf_merger.py 脚本）')
+    parser.add_argument('-n', '--runs', type=int, default=10, help='启动次数')
+    parser.add_argument('-o', '--output', help='结果JSON保存路径（默认输出到标准输出）')
+    parser.add_argument('--timeout', type=float, default=120, help='单次启动的超时时间（秒）')
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    if args.exe:
+        command = [os.path.abspath(args.exe)]
+        target = 'frozen'
+    else:
+        command = [sys.executable, os.path.join(ROOT_DIR, 'pdf_merger.py')]
+        target = 'script'
+
+    runs = []
+    # 在临时目录中运行，避免在当前目录留下日志文件
+    with tempfile.TemporaryDirectory() as work_dir:
+        for i in range(args.runs):
+            wall, window_ms = measure_once(command, work_dir, args.timeout)
+            runs.append({'wall_s': round(wall, 4), 'window_ms': window_ms})
+            print(f'  第 {i + 1} 次：{wall:.3f}s'
+                  + (f'，窗口显示 {window_ms:.0f} ms' if window_ms is not None else ''),
+                  file=sys.stderr)
+
+    report = {
+        'environment': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'target': target,
+        'command': command,
+        # 第一次启动受磁盘缓存影响，单独列出
+        'first': runs[0] if runs else None,
+        'wall_s': summarize([r['wall_s'] for r in runs[1:]] or [r['wall_s'] for r in runs]),
+        'window_ms': summarize([r['window_ms'] for r in runs[1:]] or [r['window_ms'] for r in runs]),
+        'runs': runs,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,241 @@
+"""重复发票检测
+
+精确重复：先按文件大小分组，只有大小相同的文件才读取内容计算哈希，大多数文件
+一个字节都不用读。近似重复：把第一页渲染为很小的灰度图，计算差值哈希（dHash），
+再用多索引哈希查找汉明距离不超过阈值的候选，不需要两两比较。同一张发票换了文件名、
+或者同时有PDF和手机照片时，都能在渲染和排版之前发现。
+
+同一模板的不同发票在低分辨率下几乎一样，所以两个都有文字层的PDF只有在第一页文字
+也相同时才算近似重复；照片无法这样区分，近似重复只适合提示，由用户确认。
+"""
+import hashlib
+import io
+import os
+import threading
+from collections import defaultdict, namedtuple
+
+import merge_engine
+import merge_metrics
+import page_cache
+
+# dHash 网格边长，哈希长度为其平方（256位）
+HASH_SIZE = 16
+# 汉明距离不超过此值视为近似重复
+DEFAULT_THRESHOLD = 12
+# 计算内容哈希时每次读取的字节数
+READ_CHUNK = 1024 * 1024
+
+EXACT = 'exact'
+SIMILAR = 'similar'
+
+# path 与 original 重复；kind 为 EXACT 或 SIMILAR，distance 为感知哈希的汉明距离
+Duplicate = namedtuple('Duplicate', 'path original kind distance')
+
+
+def content_hash(path, cache=None):
+    """文件内容的哈希值（十六进制字符串）"""
+    key = _cache_key(cache, path, 'content_hash')
+    if key:
+        data = cache.get(key)
+        if data is not None:
+            return data.decode('ascii')
+    digest = hashlib.blake2b(digest_size=16)
+    with merge_metrics.span('content_hash', file=os.path.basename(path)), open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK), b''):
+            digest.update(chunk)
+    value = digest.hexdigest()
+    if key:
+        cache.put(key, value.encode('ascii'))
+    return value
+
+
+def perceptual_hash(path, cache=None, index=None):
+    """第一页低分辨率渲染的差值哈希（dHash），返回 HASH_SIZE * HASH_SIZE 位的整数
+
+    渲染使用预览图块，PDF只按很小的尺寸光栅化，JPEG在解码时就缩小。
+    """
+    from PIL import Image, ImageOps
+    key = _cache_key(cache, path, 'dhash', HASH_SIZE)
+    if key:
+        data = cache.get(key)
+        if data is not None:
+            return int(data.decode('ascii'), 16)
+    box = (HASH_SIZE * 4, HASH_SIZE * 4)
+    tile = merge_engine.render_preview_tile(path, box, cache, index=index)
+    with merge_metrics.span('perceptual_hash', file=os.path.basename(path)):
+        with Image.open(io.BytesIO(tile)) as img:
+            gray = ImageOps.autocontrast(img.convert('L'))
+            pixels = gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR).tobytes()
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] < pixels[offset + col + 1])
+    if key:
+        cache.put(key, format(value, 'x').encode('ascii'))
+    return value
+
+
+def first_page_text(path, index=None):
+    """PDF第一页的文字（去掉空白），图片或没有文字层时返回 None"""
+    import fitz
+    if not path.lower().endswith(merge_engine.PDF_EXTENSIONS):
+        return None
+    documents = index.document(path) if index is not None else fitz.open(path)
+    with documents as doc:
+        if doc.page_count == 0:
+            return None
+        text = ''.join(doc[0].get_text().split())
+    return text or None
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def _cache_key(cache, path, kind, *params):
+    if cache is None:
+        return None
+    try:
+        return page_cache.make_key(path, kind, *params)
+    except OSError:
+        return None
+
+
+class DuplicateIndex:
+    """已登记文件的哈希索引，用于检查新文件是否与它们重复
+
+    内容哈希只在文件大小相同时才计算。感知哈希被切分为 threshold + 1 段，
+    汉明距离不超过 threshold 的两个哈希至少有一段完全相同（抽屉原理），
+    所以只需比较至少一段相同的候选。线程安全。
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, cache=None, index=None):
+        bits = HASH_SIZE * HASH_SIZE
+        self.threshold = threshold
+        self.cache = cache
+        self.index = index
+        bands = min(threshold + 1, bits)
+        width = bits // bands
+        # 每段为 (右移位数, 掩码)，最后一段包含剩余的位
+        self._bands = [(i * width, (1 << (width if i < bands - 1 else bits - i * width)) - 1)
+                       for i in range(bands)]
+        self._sizes = defaultdict(set)
+        self._digests = {}
+        self._by_digest = {}
+        self._phashes = {}
+        self._texts = {}
+        self._buckets = defaultdict(set)
+        self._lock = threading.RLock()
+
+    def _digest(self, path):
+        digest = self._digests.get(path)
+        if digest is None:
+            digest = content_hash(path, self.cache)
+            self._digests[path] = digest
+        return digest
+
+    def _text(self, path):
+        if path not in self._texts:
+            self._texts[path] = first_page_text(path, self.index)
+        return self._texts[path]
+
+    def find_exact(self, path):
+        """返回与 path 内容完全相同的已登记文件，没有时返回 None"""
+        with self._lock:
+            size = os.path.getsize(path)
+            peers = self._sizes.get(size, set()) - {path}
+            if not peers:
+                return None
+            # 大小相同的已登记文件到这时才计算内容哈希
+            for peer in sorted(peers):
+                self._by_digest.setdefault(self._digest(peer), peer)
+            return self._by_digest.get(self._digest(path))
+
+    def find_similar(self, path):
+        """返回 (最相似的已登记文件, 汉明距离)，没有距离不超过阈值的文件时返回 None"""
+        value = perceptual_hash(path, self.cache, self.index)
+        with self._lock:
+            candidates = set()
+            for band, (shift, mask) in enumerate(self._bands):
+                candidates |= self._buckets.get((band, (value >> shift) & mask), set())
+            candidates.discard(path)
+            matches = sorted((hamming(value, self._phashes[candidate]), candidate)
+                             for candidate in candidates)
+            for distance, candidate in matches:
+                if distance > self.threshold:
+                    break
+                # 都有文字层但文字不同的PDF是同一模板的不同发票
+                text, other = self._text(path), self._text(candidate)
+                if text is not None and other is not None and text != other:
+                    continue
+                return candidate, distance
+            return None
+
+    def add(self, path):
+        """登记文件（只记录大小，内容哈希在需要时才计算）"""
+        with self._lock:
+            self._sizes[os.path.getsize(path)].add(path)
+
+    def add_similar(self, path):
+        """登记文件的感知哈希，之后的 find_similar 会与它比较"""
+        value = perceptual_hash(path, self.cache, self.index)
+        with self._lock:
+            self._phashes[path] = value
+            for band, (shift, mask) in enumerate(self._bands):
+                self._buckets[(band, (value >> shift) & mask)].add(path)
+
+    def remove(self, path):
+        with self._lock:
+            for paths in self._sizes.values():
+                paths.discard(path)
+            self._texts.pop(path, None)
+            digest = self._digests.pop(path, None)
+            if digest is not None and self._by_digest.get(digest) == path:
+                del self._by_digest[digest]
+                # 同内容的其他已登记文件顶替被移除的文件
+                for other, other_digest in self._digests.items():
+                    if other_digest == digest and any(other in paths for paths in self._sizes.values()):
+                        self._by_digest[digest] = other
+                        break
+            value = self._phashes.pop(path, None)
+            if value is not None:
+                for band, (shift, mask) in enumerate(self._bands):
+                    self._buckets[(band, (value >> shift) & mask)].discard(path)
+
+    def check(self, path, similar=False):
+        """检查 path 是否与已登记的文件重复，返回 Duplicate 或 None；不重复的文件随即登记"""
+        original = self.find_exact(path)
+        if original is not None:
+            return Duplicate(path, original, EXACT, 0)
+        self.add(path)
+        if similar:
+            found = self.find_similar(path)
+            if found is not None:
+                return Duplicate(path, found[0], SIMILAR, found[1])
+            self.add_similar(path)
+        return None
+
+
+def find_duplicates(paths, similar=False, threshold=DEFAULT_THRESHOLD, cache=None, index=None,
+                    on_error=None):
+    """按顺序检查 paths，返回 (不重复的文件, [Duplicate])；每组重复中保留最先出现的文件
+
+    无法读取的文件保留在结果中并通过 on_error 报告，留给后续处理步骤决定如何处理。
+    """
+    duplicates_index = DuplicateIndex(threshold, cache, index)
+    unique = []
+    duplicates = []
+    with merge_metrics.span('find_duplicates', inputs=len(paths), similar=similar):
+        for path in paths:
+            try:
+                duplicate = duplicates_index.check(path, similar)
+            except (merge_engine.MergeError, OSError) as e:
+                if on_error is not None:
+                    on_error(f'检查重复文件时出错（{os.path.basename(path)}）：{str(e)}')
+                duplicate = None
+            if duplicate is None:
+                unique.append(path)
+            else:
+                duplicates.append(duplicate)
+    return unique, duplicates
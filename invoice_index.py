@@ -0,0 +1,375 @@
+"""发票信息索引
+
+从PDF的文字层中提取发票号码、开票日期、金额和销售方（不做OCR，图片和扫描件没有
+这些信息），结果按文件指纹保存在本地的索引文件中，文件不变就不再重复提取。
+索引用于合并前按日期、金额等排序或按销售方分组，合并后记录每张发票所在的输出
+页面和单元格，并可以导出为CSV清单，或在命令行中查找：
+
+    python invoice_index.py 24442000000012345678
+    python invoice_index.py 某某餐饮
+"""
+import json
+import os
+import re
+import sys
+import threading
+import traceback
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+
+import merge_engine
+import merge_metrics
+import page_cache
+from merge_engine import MergeError
+
+INDEX_VERSION = 1
+INDEX_FILE = 'invoice_index.json'
+
+# 可用的排序和分组字段
+SORT_KEYS = ('date', 'amount', 'number', 'seller')
+GROUP_KEYS = ('seller', 'month')
+
+NUMBER_PATTERN = re.compile(r'发\s*票\s*号\s*码\s*[:：]?\s*(\d{4,})')
+DATE_PATTERN = r'(\d{4})\s*(?:年\s*(\d{1,2})\s*月\s*(\d{1,2})\s*日|[-/.](\d{1,2})[-/.](\d{1,2}))'
+ISSUE_DATE_PATTERN = re.compile(r'开\s*票\s*日\s*期\s*[:：]?\s*' + DATE_PATTERN)
+ANY_DATE_PATTERN = re.compile(DATE_PATTERN)
+AMOUNT = r'(-?\d[\d,]*\.\d{2})'
+# 价税合计（小写）¥100.00，没有时取“价税合计”同一行的金额，最后取最大的人民币金额
+SMALL_TOTAL_PATTERN = re.compile(r'[（(]\s*小\s*写\s*[)）]\s*[¥￥]?\s*' + AMOUNT)
+TOTAL_PATTERN = re.compile(r'价\s*税\s*合\s*计[^\n]*?[¥￥]\s*' + AMOUNT)
+YUAN_PATTERN = re.compile(r'[¥￥]\s*' + AMOUNT)
+NAME_PATTERN = re.compile(r'名\s*称\s*[:：]\s*([^\s:：]+)')
+SELLER_PATTERN = re.compile(r'销\s*售\s*方|销\s*方')
+# 字符间距较大的数字之间的单个空格，较早的 PyMuPDF 会按字符插入（如 “1 , 0 9 7 . 5 7”、“2 0 2 4 - 1 2”）
+DIGIT_GAP_PATTERN = re.compile(r'(?<=[\d.,/-]) (?=[\d.,/-])')
+
+# 各字段均为字符串，未识别时为 None；date 为 YYYY-MM-DD，amount 为两位小数
+InvoiceFields = namedtuple('InvoiceFields', 'number date amount seller')
+EMPTY_FIELDS = InvoiceFields(None, None, None, None)
+
+# 合并结果中的位置：output 为输出文件，sheet 为其中的页码（从1开始），cell 为单元格序号（从0开始）
+Location = namedtuple('Location', 'output sheet cell')
+
+SearchResult = namedtuple('SearchResult', 'path page fields location')
+
+
+def default_index_path():
+    """默认的索引文件路径（与页面缓存放在同一目录下）"""
+    return os.path.join(os.path.dirname(page_cache.default_cache_dir()), INDEX_FILE)
+
+
+def _date(match):
+    if match is None:
+        return None
+    year, month, day = match.group(1), match.group(2) or match.group(4), match.group(3) or match.group(5)
+    return f'{int(year):04d}-{int(month):02d}-{int(day):02d}'
+
+
+def _amount(text):
+    try:
+        return str(Decimal(text.replace(',', '')).quantize(Decimal('0.01')))
+    except InvalidOperation:
+        return None
+
+
+def parse_invoice_text(text):
+    """从发票页面的文字中识别 InvoiceFields，支持电子发票（全电）和增值税发票的常见版式"""
+    text = DIGIT_GAP_PATTERN.sub('', text)
+    match = NUMBER_PATTERN.search(text)
+    number = match.group(1) if match else None
+    date = _date(ISSUE_DATE_PATTERN.search(text)) or _date(ANY_DATE_PATTERN.search(text))
+
+    match = SMALL_TOTAL_PATTERN.search(text) or TOTAL_PATTERN.search(text)
+    if match:
+        amount = _amount(match.group(1))
+    else:
+        amounts = [_amount(value) for value in YUAN_PATTERN.findall(text)]
+        amounts = [value for value in amounts if value is not None]
+        amount = max(amounts, key=Decimal) if amounts else None
+
+    # 版式中购买方在前、销售方在后，有“销售方”标记时取其后的第一个名称
+    names = list(NAME_PATTERN.finditer(text))
+    marker = SELLER_PATTERN.search(text)
+    seller = None
+    if marker is not None:
+        seller = next((m.group(1) for m in names if m.start() > marker.start()), None)
+    if seller is None and len(names) >= 2:
+        seller = names[1].group(1)
+    return InvoiceFields(number, date, amount, seller)
+
+
+def _report_error(on_error, error_msg, error_detail=None):
+    merge_engine.log_error(f'{error_msg}\n{error_detail}' if error_detail else error_msg)
+    if on_error is not None:
+        on_error(error_msg)
+
+
+def _extract_task(task):
+    """工作进程任务：提取同一文件若干页的发票信息，返回 (字段列表, 错误信息, 错误详情, 统计事件)"""
+    import fitz
+    path, pages = task
+    try:
+        with merge_metrics.span('extract_text', file=os.path.basename(path), pages=len(pages)):
+            with fitz.open(path) as doc:
+                fields = [tuple(parse_invoice_text(doc[page].get_text())) for page in pages]
+        return fields, None, None, merge_metrics.drain()
+    except Exception as e:
+        return (None, f'提取发票信息时出错（{os.path.basename(path)}）：{str(e)}',
+                traceback.format_exc(), merge_metrics.drain())
+
+
+class InvoiceIndex:
+    """持久化的发票信息索引，按文件指纹保存每页的 InvoiceFields 和最近一次合并的位置
+
+    文件修改后旧的记录自动作废。线程安全；修改后需要调用 save() 写回索引文件。
+    """
+
+    def __init__(self, path=None):
+        self.path = path or default_index_path()
+        self._files = self._load()
+        self._dirty = False
+        self._lock = threading.RLock()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            raise MergeError(f'无法读取发票索引 {self.path}：{e}')
+        if data.get('version') != INDEX_VERSION:
+            return {}
+        return data.get('files', {})
+
+    def save(self):
+        """把修改写回索引文件"""
+        with self._lock:
+            if not self._dirty:
+                return
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            # 先写临时文件再替换，中途退出也不会损坏已有索引
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': INDEX_VERSION, 'files': self._files}, f, ensure_ascii=False)
+            os.replace(temp_path, self.path)
+            self._dirty = False
+
+    def _entry(self, path, create=True):
+        """返回 path 的有效记录；文件已修改或还没有记录时创建新的空记录，create=False 时返回 None"""
+        key = os.path.normcase(os.path.abspath(path))
+        fingerprint = page_cache.file_fingerprint(path)
+        entry = self._files.get(key)
+        if entry is None or entry['fingerprint'] != fingerprint:
+            if not create:
+                return None
+            entry = {'fingerprint': fingerprint, 'pages': {}, 'locations': {}}
+            self._files[key] = entry
+            self._dirty = True
+        return entry
+
+    def _get(self, ref, kind):
+        with self._lock:
+            try:
+                entry = self._entry(ref.path, create=False)
+            except OSError:
+                return None
+            return entry[kind].get(str(ref.page)) if entry is not None else None
+
+    def fields(self, ref):
+        """页面（PageRef）的 InvoiceFields，还没有提取或文件无法访问时返回 None"""
+        values = self._get(ref, 'pages')
+        return InvoiceFields(*values) if values is not None else None
+
+    def update(self, refs, on_error=None, workers=1, chunksize=merge_engine.DEFAULT_CHUNKSIZE):
+        """提取 refs 中还没有记录的页面，返回新提取的页数
+
+        同一文件的页面在一个任务中处理；workers > 1 时在进程池中并行提取。
+        图片没有文字层，直接记为空字段。无法读取的文件通过 on_error 报告。
+        """
+        tasks = []
+        with self._lock:
+            for ref in dict.fromkeys(refs):
+                try:
+                    entry = self._entry(ref.path)
+                except OSError as e:
+                    _report_error(on_error, f'提取发票信息时出错：{str(e)}')
+                    continue
+                if str(ref.page) in entry['pages']:
+                    continue
+                if not ref.path.lower().endswith(merge_engine.PDF_EXTENSIONS):
+                    entry['pages'][str(ref.page)] = list(EMPTY_FIELDS)
+                    self._dirty = True
+                elif tasks and tasks[-1][0] == ref.path:
+                    tasks[-1][1].append(ref.page)
+                else:
+                    tasks.append((ref.path, [ref.page]))
+        if not tasks:
+            return 0
+
+        extracted = 0
+        executor = None
+        if workers and workers > 1 and len(tasks) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            executor = ProcessPoolExecutor(max_workers=min(workers, len(tasks)),
+                                           initializer=merge_metrics.init_worker,
+                                           initargs=(merge_metrics.enabled(),))
+        try:
+            with merge_metrics.span('extract_invoices', files=len(tasks)):
+                if executor is not None:
+                    results = executor.map(_extract_task, tasks, chunksize=max(1, chunksize))
+                else:
+                    results = map(_extract_task, tasks)
+                for (path, pages), (fields, error_msg, error_detail, events) in zip(tasks, results):
+                    merge_metrics.forward(events)
+                    if fields is None:
+                        _report_error(on_error, error_msg, error_detail)
+                        continue
+                    with self._lock:
+                        try:
+                            entry = self._entry(path)
+                        except OSError:
+                            continue
+                        for page, values in zip(pages, fields):
+                            entry['pages'][str(page)] = list(values)
+                        self._dirty = True
+                    extracted += len(pages)
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+        return extracted
+
+    def location(self, ref):
+        """页面最近一次合并时的 Location，没有记录时返回 None"""
+        values = self._get(ref, 'locations')
+        return Location(*values) if values is not None else None
+
+    def record_locations(self, placements, outputs):
+        """记录合并结果中各页面的位置；placements 为 merge 产生的 [merge_engine.Placement]"""
+        with self._lock:
+            for placement in placements:
+                output = _output_name(outputs, placement.volume)
+                try:
+                    entry = self._entry(placement.ref.path)
+                except OSError:
+                    continue
+                entry['locations'][str(placement.ref.page)] = [output, placement.sheet, placement.cell]
+                self._dirty = True
+
+    def search(self, query):
+        """查找发票号码、日期、金额、销售方或文件名中包含 query 的页面，返回 [SearchResult]"""
+        results = []
+        with self._lock:
+            for key, entry in self._files.items():
+                name_matches = query in os.path.basename(key)
+                for page, values in entry['pages'].items():
+                    if name_matches or any(value and query in value for value in values):
+                        location = entry['locations'].get(page)
+                        results.append(SearchResult(key, int(page), InvoiceFields(*values),
+                                                    Location(*location) if location else None))
+        results.sort(key=lambda result: (result.path, result.page))
+        return results
+
+
+def _output_name(outputs, volume):
+    return outputs[volume - 1] if 0 < volume <= len(outputs) else None
+
+
+def _sort_value(fields, key):
+    """排序用的值；没有该字段的页面排在最后"""
+    if fields is None:
+        value = None
+    elif key == 'month':
+        value = fields.date[:7] if fields.date else None
+    else:
+        value = getattr(fields, key)
+    if value is None:
+        return (1, '')
+    if key == 'amount':
+        return (0, Decimal(value))
+    return (0, value)
+
+
+def arrange(refs, index, sort_by=None, group_by=None):
+    """按发票信息重新排列页面（[PageRef]）
+
+    group_by（seller 或 month）相同的页面排在一起，组内再按 sort_by（date、amount、
+    number 或 seller）排序；值相同或缺少信息的页面保持原来的先后顺序，缺少信息的排在最后。
+    """
+    if sort_by is not None and sort_by not in SORT_KEYS:
+        raise MergeError(f'不支持的排序方式：{sort_by}')
+    if group_by is not None and group_by not in GROUP_KEYS:
+        raise MergeError(f'不支持的分组方式：{group_by}')
+    if sort_by is None and group_by is None:
+        return list(refs)
+    fields = {ref: index.fields(ref) for ref in refs}
+
+    def key(ref):
+        values = []
+        if group_by is not None:
+            values.append(_sort_value(fields[ref], group_by))
+        if sort_by is not None:
+            values.append(_sort_value(fields[ref], sort_by))
+        return values
+
+    return sorted(refs, key=key)
+
+
+def write_sidecar(path, placements, outputs, index, cols=None, on_error=None, workers=1):
+    """把每张发票在合并结果中的位置写成CSV清单（UTF-8 带BOM，可直接用Excel打开）
+
+    placements 为 merge 产生的 [merge_engine.Placement]，outputs 为输出文件列表
+    （stats['outputs']）；按网格排版时提供 cols 会同时写出行号和列号。
+    """
+    import csv
+    index.update([placement.ref for placement in placements], on_error, workers)
+    header = ['发票号码', '开票日期', '金额', '销售方', '源文件', '源页码', '输出文件', '输出页码', '单元格']
+    if cols:
+        header += ['行', '列']
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for placement in placements:
+            fields = index.fields(placement.ref) or EMPTY_FIELDS
+            output = _output_name(outputs, placement.volume)
+            row = [value or '' for value in fields] + [
+                placement.ref.path, placement.ref.page + 1,
+                os.path.basename(output) if output else '', placement.sheet, placement.cell + 1]
+            if cols:
+                row += [placement.cell // cols + 1, placement.cell % cols + 1]
+            writer.writerow(row)
+
+
+def build_arg_parser():
+    # 图形界面启动时会导入本模块，命令行用到的模块在这里才导入
+    import argparse
+    parser = argparse.ArgumentParser(description='在发票索引中查找发票及其在合并结果中的位置')
+    parser.add_argument('query', help='发票号码、日期（如 2025-06）、金额、销售方或文件名中的文字')
+    parser.add_argument('--index', default=default_index_path(),
+                        help=f'索引文件（默认 {default_index_path()}）')
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    try:
+        results = InvoiceIndex(args.index).search(args.query)
+    except MergeError as e:
+        print(e, file=sys.stderr)
+        return 1
+    for result in results:
+        fields = result.fields
+        line = (f'{result.path} 第{result.page + 1}页  号码 {fields.number or "-"}  日期 {fields.date or "-"}  '
+                f'金额 {fields.amount or "-"}  销售方 {fields.seller or "-"}')
+        if result.location is not None:
+            output, sheet, cell = result.location
+            line += f'  -> {output or "（未保存到文件）"} 第{sheet}页 第{cell + 1}格'
+        print(line)
+    if not results:
+        print('没有找到匹配的发票', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
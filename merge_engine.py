@@ -0,0 +1,1674 @@
+"""发票合并引擎
+
+不依赖Qt，可以在无界面的服务器或定时任务中运行。图形界面（pdf_merger.py）
+只负责收集参数和显示进度，实际的文件处理和排版都在这里完成。
+
+命令行用法示例：
+
+    python merge_engine.py -r 3 -c 2 -o 合并结果.pdf 发票/*.pdf 照片/*.jpg
+    python merge_engine.py --landscape -o 六月.pdf @六月清单.txt
+    python merge_engine.py --auto-layout -o 小票.pdf 小票/
+"""
+import contextlib
+import glob
+import hashlib
+import importlib
+import io
+import logging
+import math
+import multiprocessing
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict, namedtuple
+
+# fitz（PyMuPDF）和 PIL 导入耗时较长，只在用到它们的函数内导入，
+# 界面启动时不必等待加载；见 warm_up()
+import auto_layout
+import merge_metrics
+import page_cache
+
+logger = logging.getLogger('pdf_merger')
+
+# A4纸张尺寸（单位：点，与 reportlab.lib.pagesizes.A4 一致）
+A4 = (595.2755905511812, 841.8897637795277)
+PORTRAIT = 'portrait'
+LANDSCAPE = 'landscape'
+
+# 排版方式：固定的 行 x 列 网格，或按页面尺寸自动排版（见 auto_layout）
+LAYOUT_GRID = 'grid'
+LAYOUT_AUTO = 'auto'
+
+PDF_EXTENSIONS = ('.pdf',)
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.bmp')
+SUPPORTED_EXTENSIONS = PDF_EXTENSIONS + IMAGE_EXTENSIONS
+# 可能包含多帧的图片格式，每一帧作为一页
+MULTI_FRAME_EXTENSIONS = ('.tif',)
+
+# EXIF方向标记，及各方向摆正图片需要的变换（Image.Transpose 的值，与 ImageOps.exif_transpose 相同）
+EXIF_ORIENTATION = 0x0112
+EXIF_TRANSPOSE = {2: 0, 3: 3, 4: 1, 5: 5, 6: 4, 7: 6, 8: 2}
+# 宽高互换的方向
+EXIF_SWAPPED = (5, 6, 7, 8)
+# 不需要翻转的方向在嵌入原始JPEG时对应的旋转角度（PyMuPDF 逆时针为正）
+PASSTHROUGH_ROTATION = {1: 0, 3: 180, 6: -90, 8: 90}
+
+# 单元格内容占单元格的比例（四周留出5%边距）
+CELL_FILL_RATIO = 0.95
+
+# 位图输出质量：目标有效DPI、图像编码（jpeg 或无损的 flate）以及JPEG质量
+QualityProfile = namedtuple('QualityProfile', 'name label dpi image_format jpeg_quality')
+QUALITY_PROFILES = {
+    'draft': QualityProfile('draft', '草稿', 100, 'jpeg', 60),
+    'screen': QualityProfile('screen', '屏幕', 150, 'jpeg', 75),
+    'print': QualityProfile('print', '打印', 300, 'jpeg', 85),
+    'archive': QualityProfile('archive', '存档', 600, 'flate', None),
+}
+DEFAULT_PROFILE = 'print'
+# 图片没有DPI信息时按此分辨率计算页面尺寸
+IMAGE_DEFAULT_DPI = 300.0
+
+# 预览图相对于A4页面（单位：点）的默认缩放比例，即屏幕上预览页面的像素大小
+PREVIEW_ZOOM = 0.5
+
+# 并行处理时每个工作进程一次领取的任务数
+DEFAULT_CHUNKSIZE = 4
+
+# 多页PDF每个规范化任务最多处理的页数：同一任务中的页面只打开一次源文件，
+# 页数很多的文件拆成多个任务以便并行
+PAGES_PER_TASK = 16
+
+# 页面索引最多同时保持打开的源文档数
+DEFAULT_MAX_OPEN_DOCS = 8
+
+# 页码范围写法，如 "1-3,5,8-"（页码从1开始）
+PAGE_RANGE_PATTERN = re.compile(r'^\s*(\d*\s*(-\s*\d*)?)(\s*,\s*\d*\s*(-\s*\d*)?)*\s*$')
+
+# 流式写出时每完成多少页增量写盘一次
+DEFAULT_FLUSH_SHEETS = 50
+
+# 最终输出文件的保存参数：去掉未引用的对象、压缩交叉引用表，并把对象和交叉引用表
+# 写为压缩的对象流。相同对象的合并由 dedupe_objects 完成（MuPDF 在 garbage>=3 时
+# 两两比较对象，页数多时很慢）。较早的 PyMuPDF（如 1.23）不支持对象流，见 output_save_options
+OUTPUT_SAVE_OPTIONS = {'garbage': 2, 'deflate': True, 'use_objstms': 1}
+_output_save_options = None
+
+# PDF对象中的间接引用，如 "12 0 R"
+OBJECT_REF_PATTERN = re.compile(r'\b(\d+) 0 R\b')
+
+# 进度回调中的处理阶段
+STAGE_PREPARE = 'prepare'
+STAGE_COMPOSE = 'compose'
+
+# 节流后两次进度回调之间的最短间隔（秒）
+PROGRESS_INTERVAL = 0.2
+# 阶段开始后至少经过这么久才估计剩余时间，避免开头几页的速度偏差太大
+ETA_MIN_ELAPSED = 1.0
+# 命令行输出进度的间隔（秒）
+CLI_PROGRESS_INTERVAL = 2.0
+
+
+class MergeError(Exception):
+    """合并过程中出现的可向用户展示的错误"""
+
+
+class MergeCancelled(MergeError):
+    """任务被调用方取消"""
+
+
+# 输入文件中的一页，page 从0开始；图片只有第0页（多帧TIFF为帧序号）
+PageRef = namedtuple('PageRef', 'path page')
+
+# 页面在合并结果中的位置：volume 为分卷序号（从1开始，对应 stats['outputs']），
+# sheet 为分卷中的页码（从1开始），cell 为单元格序号（从0开始，按网格排版时逐行排列）
+Placement = namedtuple('Placement', 'ref volume sheet cell')
+
+
+def log_error(error_msg, exc_info=False):
+    """记录错误信息到日志文件"""
+    if exc_info:
+        logger.error(f"{error_msg}\n{traceback.format_exc()}")
+    else:
+        logger.error(error_msg)
+
+
+def page_size_for(orientation):
+    """根据页面方向返回输出页面尺寸 (宽, 高)"""
+    if orientation == LANDSCAPE:
+        return A4[1], A4[0]
+    return A4
+
+
+def get_profile(profile=None):
+    """按名称返回质量配置，也可以直接传入 QualityProfile"""
+    if isinstance(profile, QualityProfile):
+        return profile
+    try:
+        return QUALITY_PROFILES[profile or DEFAULT_PROFILE]
+    except KeyError:
+        raise MergeError(f'未知的输出质量：{profile}')
+
+
+def target_pixel_size(rows, cols, orientation=PORTRAIT, profile=None, layout=LAYOUT_GRID):
+    """返回单元格内容区域在目标DPI下的像素尺寸 (宽, 高)，图片超过该尺寸时会被缩小
+
+    自动排版时页面最大可以占满整张输出页面，两个方向都按A4的长边计算。
+    """
+    dpi = get_profile(profile).dpi
+    if layout == LAYOUT_AUTO:
+        side = math.ceil(max(A4) * dpi / 72)
+        return side, side
+    page_width, page_height = page_size_for(orientation)
+    return (math.ceil(page_width / cols * CELL_FILL_RATIO * dpi / 72),
+            math.ceil(page_height / rows * CELL_FILL_RATIO * dpi / 72))
+
+
+def encode_image(img, profile):
+    """按质量配置编码图片，返回可直接嵌入PDF的图像数据"""
+    buffer = io.BytesIO()
+    if profile.image_format == 'jpeg':
+        img.save(buffer, 'JPEG', quality=profile.jpeg_quality)
+    else:
+        # PNG数据以Flate压缩嵌入PDF
+        img.save(buffer, 'PNG', compress_level=6)
+    return buffer.getvalue()
+
+
+def warm_up():
+    """预先加载PDF和图像处理库，缩短第一次预览或合并前的等待（可在后台线程中调用）"""
+    for name in ('fitz', 'PIL.Image', 'concurrent.futures.process'):
+        importlib.import_module(name)
+    from PIL import Image
+    # 注册所有图片格式的解码器
+    Image.init()
+
+
+def to_rgb(img):
+    """转换为RGB模式，透明部分以白色填充"""
+    from PIL import Image
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        if img.mode != 'RGBA':
+            img = img.convert('RGBA')
+        background.paste(img, mask=img.split()[3])
+        return background
+    if img.mode != 'RGB':
+        return img.convert('RGB')
+    return img
+
+
+def is_supported(path):
+    return path.lower().endswith(SUPPORTED_EXTENSIONS)
+
+
+def image_orientation(img):
+    """图片的EXIF方向（1-8），没有方向信息时为1"""
+    try:
+        orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+    except Exception:
+        return 1
+    return orientation if orientation in range(1, 9) else 1
+
+
+def image_page_size(img):
+    """图片转换为PDF页面后的尺寸（点），按图片的DPI信息和EXIF方向计算，只需读取文件头"""
+    # TIFF的DPI是分数类型（IFDRational）
+    dpi = float(img.info.get('dpi', (IMAGE_DEFAULT_DPI, IMAGE_DEFAULT_DPI))[0] or IMAGE_DEFAULT_DPI)
+    if image_orientation(img) in EXIF_SWAPPED:
+        return img.height * 72 / dpi, img.width * 72 / dpi
+    return img.width * 72 / dpi, img.height * 72 / dpi
+
+
+def image_frame_count(path):
+    """图片的帧数（页数），只有 MULTI_FRAME_EXTENSIONS 中的格式会超过1"""
+    from PIL import Image
+    if not path.lower().endswith(MULTI_FRAME_EXTENSIONS):
+        return 1
+    with Image.open(path) as img:
+        return getattr(img, 'n_frames', 1)
+
+
+def draft_image(img, box, orientation=1):
+    """JPEG在解码时直接按 1/2、1/4、1/8 缩小，结果不小于 box（摆正后的宽, 高）；其他格式不受影响
+
+    必须在 load() 之前调用。
+    """
+    if orientation in EXIF_SWAPPED:
+        box = box[1], box[0]
+    scale = min(box[0] / img.width, box[1] / img.height)
+    if scale < 1:
+        img.draft(img.mode, (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+
+
+def _can_pass_through(img, orientation, max_size, frame):
+    """图片是否可以不解码、原样嵌入：尺寸不超过 max_size、不需要翻转的RGB或灰度JPEG"""
+    if img.format != 'JPEG' or frame or img.mode not in ('RGB', 'L'):
+        return False
+    if orientation not in PASSTHROUGH_ROTATION:
+        return False
+    if max_size:
+        width, height = (img.height, img.width) if orientation in EXIF_SWAPPED else img.size
+        if width > max_size[0] or height > max_size[1]:
+            return False
+    return True
+
+
+def convert_image_to_pdf(image_path, max_size=None, profile=None, frame=0):
+    """将图片（多帧图片的第 frame 帧）转换为单页PDF，返回PDF数据
+
+    max_size 为 (宽, 高) 像素时，比它大的图片会先缩小到该尺寸以内，再按质量配置编码；
+    JPEG在解码阶段就缩小到接近 max_size。不需要缩小和翻转的JPEG不解码，原样嵌入。
+    带EXIF方向信息的照片按方向摆正。
+    """
+    import fitz
+    from PIL import Image
+    profile = get_profile(profile)
+    rotate = 0
+    try:
+        # 打开并转换图片
+        with Image.open(image_path) as img:
+            if frame:
+                img.seek(frame)
+            # 页面尺寸按原始像素数计算，缩小图片不影响排版
+            page_width, page_height = image_page_size(img)
+            orientation = image_orientation(img)
+            merge_metrics.count('bytes_read', os.path.getsize(image_path))
+
+            if _can_pass_through(img, orientation, max_size, frame):
+                # JPEG数据直接嵌入PDF，方向通过旋转图像实现
+                merge_metrics.count('jpeg_passthrough')
+                with open(image_path, 'rb') as f:
+                    image_data = f.read()
+                rotate = PASSTHROUGH_ROTATION[orientation]
+            else:
+                if max_size:
+                    draft_image(img, max_size, orientation)
+                merge_metrics.count('pixels_decoded', img.width * img.height)
+                with merge_metrics.span('decode_image'):
+                    img.load()
+                    img = to_rgb(img)
+
+                # 缩小到目标有效DPI对应的像素尺寸
+                if max_size:
+                    box = max_size[::-1] if orientation in EXIF_SWAPPED else max_size
+                    scale = min(box[0] / img.width, box[1] / img.height)
+                    if scale < 1:
+                        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+                        with merge_metrics.span('resize_image'):
+                            img = img.resize(size, Image.LANCZOS, reducing_gap=3.0)
+                if orientation in EXIF_TRANSPOSE:
+                    img = img.transpose(EXIF_TRANSPOSE[orientation])
+                with merge_metrics.span('encode_image', format=profile.image_format):
+                    image_data = encode_image(img, profile)
+
+        with merge_metrics.span('build_image_pdf'), fitz.open() as doc:
+            page = doc.new_page(width=page_width, height=page_height)
+            page.insert_image(page.rect, stream=image_data, rotate=rotate)
+            return doc.tobytes(garbage=3, deflate=True)
+    except Exception as e:
+        raise MergeError(f'图片转换失败（{os.path.basename(image_path)}）：{str(e)}') from e
+
+
+def extract_pdf_pages(file_path, pages):
+    """提取PDF中的 pages 页（从0开始），返回每页一个的单页PDF数据列表
+
+    源文件只打开一次，所有页面共享同一个打开的文档。
+    """
+    import fitz
+    try:
+        merge_metrics.count('bytes_read', os.path.getsize(file_path))
+        # 读取原PDF文件
+        with merge_metrics.span('extract_pdf_page', pages=len(pages)), fitz.open(file_path) as src:
+            if src.page_count == 0:
+                raise Exception('PDF文件为空')
+            results = []
+            for page in pages:
+                # 创建新的PDF并添加该页
+                with fitz.open() as doc:
+                    doc.insert_pdf(src, from_page=page, to_page=page)
+                    results.append(doc.tobytes(garbage=3, deflate=True))
+            return results
+    except Exception as e:
+        raise MergeError(f'PDF处理失败（{os.path.basename(file_path)}）：{str(e)}') from e
+
+
+def prepare_pages(file_path, pages=(0,), max_size=None, profile=None):
+    """将输入文件的 pages 页规范化为单页PDF，返回PDF数据列表（不产生临时文件）
+
+    max_size 和 profile 只影响图片输入，见 convert_image_to_pdf；图片的 pages 为帧序号。
+    """
+    if file_path.lower().endswith(PDF_EXTENSIONS):
+        return extract_pdf_pages(file_path, pages)
+    return [convert_image_to_pdf(file_path, max_size, profile, frame) for frame in pages]
+
+
+def parse_page_range(spec, page_count):
+    """解析页码范围（如 "1-3,5,8-"，页码从1开始），返回从0开始的页码列表
+
+    spec 为空时返回全部页面；格式错误或超出 page_count 时抛出 MergeError。
+    """
+    if not spec or not spec.strip():
+        return list(range(page_count))
+    if not PAGE_RANGE_PATTERN.match(spec):
+        raise MergeError(f'页码范围格式错误：{spec}')
+    pages = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = (p.strip() for p in part.split('-', 1))
+            start = int(start) if start else 1
+            end = int(end) if end else page_count
+        else:
+            start = end = int(part)
+        if start < 1 or end > page_count or start > end:
+            raise MergeError(f'页码范围 {part} 超出文件页数（共 {page_count} 页）')
+        pages.extend(range(start - 1, end))
+    return pages
+
+
+class PageIndex:
+    """按需读取输入文件的页数和页面尺寸
+
+    PDF只解析交叉引用表和页面树，不解析页面内容流。最近使用的源文档保持打开，
+    同一文件的多个页面（计数、尺寸、预览）共享一个打开的文档；文件修改后自动重新打开。
+    线程安全，文档只能在 document() 的 with 块中使用。
+    """
+
+    def __init__(self, max_open=DEFAULT_MAX_OPEN_DOCS):
+        self.max_open = max_open
+        self._docs = OrderedDict()
+        self._counts = {}
+        self._lock = threading.RLock()
+
+    @contextlib.contextmanager
+    def document(self, path):
+        """返回已打开的PDF文档，with 块内独占使用"""
+        with self._lock:
+            yield self._open(path)
+
+    def _open(self, path):
+        import fitz
+        fingerprint = page_cache.file_fingerprint(path)
+        entry = self._docs.get(path)
+        if entry is not None:
+            if entry[0] == fingerprint:
+                self._docs.move_to_end(path)
+                return entry[1]
+            del self._docs[path]
+            entry[1].close()
+        try:
+            doc = fitz.open(path, filetype='pdf')
+        except Exception as e:
+            raise MergeError(f'PDF处理失败（{os.path.basename(path)}）：{str(e)}') from e
+        self._docs[path] = (fingerprint, doc)
+        while len(self._docs) > self.max_open:
+            _, (_, old) = self._docs.popitem(last=False)
+            old.close()
+        return doc
+
+    def page_count(self, path):
+        """文件的页数，多帧TIFF为帧数，其他图片为1"""
+        lower = path.lower()
+        if not lower.endswith(PDF_EXTENSIONS + MULTI_FRAME_EXTENSIONS):
+            return 1
+        with self._lock:
+            fingerprint = page_cache.file_fingerprint(path)
+            cached = self._counts.get(path)
+            if cached is not None and cached[0] == fingerprint:
+                return cached[1]
+            if lower.endswith(PDF_EXTENSIONS):
+                count = self._open(path).page_count
+            else:
+                try:
+                    count = image_frame_count(path)
+                except Exception as e:
+                    raise MergeError(f'图片读取失败（{os.path.basename(path)}）：{str(e)}') from e
+            self._counts[path] = (fingerprint, count)
+            return count
+
+    def page_size(self, path, page=0):
+        """页面尺寸（宽, 高），单位为点"""
+        if not path.lower().endswith(PDF_EXTENSIONS):
+            from PIL import Image
+            with Image.open(path) as img:
+                if page:
+                    img.seek(page)
+                return image_page_size(img)
+        with self.document(path) as doc:
+            rect = doc[page].rect
+            return rect.width, rect.height
+
+    def pages(self, path, page_range=None):
+        """按页码范围返回文件中要使用的页面（从0开始）"""
+        count = self.page_count(path)
+        if count == 0:
+            raise MergeError(f'PDF处理失败（{os.path.basename(path)}）：PDF文件为空')
+        return parse_page_range(page_range, count)
+
+    def close(self):
+        with self._lock:
+            for _, doc in self._docs.values():
+                doc.close()
+            self._docs.clear()
+
+
+def expand_pages(inputs, page_ranges=None, on_error=None, index=None):
+    """把输入文件展开为页面列表 [PageRef]，page_ranges 为 {文件: 页码范围}
+
+    无法读取或页码范围错误的文件会被跳过并通过 on_error 报告。
+    """
+    page_ranges = page_ranges or {}
+    own_index = index is None
+    if own_index:
+        index = PageIndex()
+    refs = []
+    try:
+        for path in inputs:
+            try:
+                pages = index.pages(path, page_ranges.get(path))
+            except (MergeError, OSError) as e:
+                _report_error(on_error, f'处理文件时出错：{str(e)}')
+                continue
+            refs.extend(PageRef(path, page) for page in pages)
+    finally:
+        if own_index:
+            index.close()
+    return refs
+
+
+def page_sizes(refs, on_error=None, index=None):
+    """读取页面（[PageRef]）的尺寸（点），不渲染页面，返回 (页面列表, [(宽, 高)])
+
+    无法读取尺寸的页面会被跳过并通过 on_error 报告。
+    """
+    own_index = index is None
+    if own_index:
+        index = PageIndex()
+    readable = []
+    sizes = []
+    try:
+        for ref in refs:
+            try:
+                size = index.page_size(ref.path, ref.page)
+            except Exception as e:
+                _report_error(on_error, f'处理文件时出错（{os.path.basename(ref.path)}）：{str(e)}')
+                continue
+            readable.append(ref)
+            sizes.append(size)
+    finally:
+        if own_index:
+            index.close()
+    return readable, sizes
+
+
+def plan_auto_layout(sizes, orientation=PORTRAIT, min_scale=auto_layout.DEFAULT_MIN_SCALE):
+    """按页面尺寸自动排版，返回 (缩放比例, [auto_layout.Sheet])
+
+    每张输出页面在纵向和横向A4中选择能装下更多页面的一个，orientation 为页数相同时
+    优先使用的方向；页面不会被缩小到 min_scale 以下（比整张输出页面还大的除外）。
+    """
+    other = LANDSCAPE if orientation == PORTRAIT else PORTRAIT
+    try:
+        return auto_layout.plan(sizes, (page_size_for(orientation), page_size_for(other)),
+                                min_scale)
+    except ValueError as e:
+        raise MergeError(str(e)) from e
+
+
+def cell_box(index, rows, cols, page_width, page_height, src_width, src_height):
+    """计算第 index 个单元格中源页面的放置区域，返回 (x0, y0, x1, y1)，左上角为原点"""
+    row = index // cols
+    col = index % cols
+    cell_width = page_width / cols
+    cell_height = page_height / rows
+
+    # 计算当前单元格的位置
+    x = col * cell_width
+    y = row * cell_height
+
+    # 计算最佳缩放比例，保持纵横比
+    scale_x = (cell_width * CELL_FILL_RATIO) / src_width
+    scale_y = (cell_height * CELL_FILL_RATIO) / src_height
+    scale = min(scale_x, scale_y)
+
+    # 计算居中位置
+    scaled_width = src_width * scale
+    scaled_height = src_height * scale
+    centered_x = x + (cell_width - scaled_width) / 2
+    centered_y = y + (cell_height - scaled_height) / 2
+    return centered_x, centered_y, centered_x + scaled_width, centered_y + scaled_height
+
+
+def calc_cell_rect(index, rows, cols, page_width, page_height, src_width, src_height):
+    """与 cell_box 相同，返回 fitz.Rect（PyMuPDF坐标系，左上角为原点）"""
+    import fitz
+    return fitz.Rect(cell_box(index, rows, cols, page_width, page_height, src_width, src_height))
+
+
+def sheet_count(cell_count, rows, cols):
+    """cell_count 个页面按 rows x cols 排列需要的输出页数"""
+    return math.ceil(cell_count / (rows * cols))
+
+
+def sheet_inputs(inputs, sheet, rows, cols):
+    """返回第 sheet 张输出页面（从0开始）上的单元格内容"""
+    per_sheet = rows * cols
+    return inputs[sheet * per_sheet:(sheet + 1) * per_sheet]
+
+
+def place_page(sheet, index, src_page, rows, cols, rasterize=False, profile=None, box=None):
+    """将源页面放入输出页面 sheet 的第 index 个单元格
+
+    默认以矢量方式（Form XObject）嵌入，文字和矢量图形保持原样；
+    rasterize=True 时按质量配置的DPI和单元格实际大小渲染为位图后嵌入，仅作为兼容模式使用。
+    box 为 (x0, y0, x1, y1) 时直接放在该区域（自动排版），不按网格计算。
+    """
+    import fitz
+    if box is not None:
+        rect = fitz.Rect(box)
+    else:
+        rect = calc_cell_rect(index, rows, cols, sheet.rect.width, sheet.rect.height,
+                              src_page.rect.width, src_page.rect.height)
+    if rasterize:
+        profile = get_profile(profile)
+        zoom = rect.width / src_page.rect.width * profile.dpi / 72
+        with merge_metrics.span('render_pixmap'):
+            pix = src_page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+        merge_metrics.count('pixels_rendered', pix.width * pix.height)
+        with merge_metrics.span('embed_pixmap', format=profile.image_format):
+            if profile.image_format == 'jpeg':
+                sheet.insert_image(rect, stream=pix.tobytes("jpeg", jpg_quality=profile.jpeg_quality))
+            else:
+                sheet.insert_image(rect, pixmap=pix)
+    else:
+        with merge_metrics.span('show_pdf_page'):
+            sheet.show_pdf_page(rect, src_page.parent, src_page.number)
+
+
+def default_workers():
+    """默认的工作进程数：CPU核心数"""
+    return os.cpu_count() or 1
+
+
+def _create_executor(workers, task_count):
+    """workers > 1 且任务不止一个时创建进程池，否则返回 None（在当前进程中顺序执行）"""
+    from concurrent.futures import ProcessPoolExecutor
+    if workers and workers > 1 and task_count > 1:
+        # 工作进程中的统计事件随任务结果带回主进程写出
+        return ProcessPoolExecutor(max_workers=min(workers, task_count),
+                                   initializer=merge_metrics.init_worker,
+                                   initargs=(merge_metrics.enabled(),))
+    return None
+
+
+def _map_ordered(func, items, executor=None, chunksize=DEFAULT_CHUNKSIZE):
+    """按原顺序返回 func(item) 的结果；提供 executor 时在进程池中并行执行"""
+    if executor is not None and len(items) > 1:
+        yield from executor.map(func, items, chunksize=max(1, chunksize))
+    else:
+        yield from map(func, items)
+
+
+def _notify(callback, *args):
+    if callback is not None:
+        callback(*args)
+
+
+def _check_cancelled(is_cancelled):
+    if is_cancelled is not None and is_cancelled():
+        raise MergeCancelled('任务已取消')
+
+
+def _report_error(on_error, error_msg, error_detail=None):
+    if error_detail:
+        log_error(f"{error_msg}\n{error_detail}")
+    else:
+        log_error(error_msg)
+    if on_error is not None:
+        on_error(error_msg)
+
+
+def _prepare_task(task):
+    """工作进程任务：规范化同一文件的若干页，返回 (PDF数据列表, 错误信息, 错误详情, 统计事件)"""
+    file_path, pages, max_size, profile = task
+    try:
+        with merge_metrics.span('prepare', file=os.path.basename(file_path), pages=len(pages)):
+            data = prepare_pages(file_path, pages, max_size, profile)
+        return data, None, None, merge_metrics.drain()
+    except Exception as e:
+        return None, f'处理文件时出错：{str(e)}', traceback.format_exc(), merge_metrics.drain()
+
+
+def _cache_key(cache, file_path, kind, *params):
+    """计算缓存键，不使用缓存或文件无法访问时返回 None"""
+    if cache is None:
+        return None
+    try:
+        return page_cache.make_key(file_path, kind, *params)
+    except OSError:
+        return None
+
+
+def _page_cache_key(cache, ref, max_size, profile):
+    if ref.path.lower().endswith(PDF_EXTENSIONS):
+        # PDF页面按原样提取，与质量配置无关
+        return _cache_key(cache, ref.path, 'page', ref.page)
+    return _cache_key(cache, ref.path, 'page', max_size, profile.name, ref.page)
+
+
+def _group_tasks(refs, max_size, profile):
+    """把需要处理的页面按文件分组为规范化任务，同一文件的连续页面放在一个任务中"""
+    tasks = []
+    for ref in refs:
+        last = tasks[-1] if tasks else None
+        if last is not None and last[0] == ref.path and len(last[1]) < PAGES_PER_TASK:
+            last[1].append(ref.page)
+        else:
+            tasks.append((ref.path, [ref.page], max_size, profile))
+    return tasks
+
+
+def _page_results(tasks, results):
+    """按页面顺序产出任务结果 (PDF数据, 错误信息, 错误详情)，失败任务的错误只随第一页产出一次"""
+    for task, (pages_data, error_msg, error_detail, events) in zip(tasks, results):
+        merge_metrics.forward(events)
+        for k in range(len(task[1])):
+            if pages_data is None:
+                yield None, error_msg if k == 0 else None, error_detail
+            else:
+                yield pages_data[k], None, None
+
+
+def _prepare_all(refs, progress=None, on_error=None, executor=None, chunksize=DEFAULT_CHUNKSIZE,
+                 is_cancelled=None, cache=None, max_size=None, profile=None, keep_failed=False):
+    """规范化所有页面（[PageRef]），返回 [(PageRef, 单页PDF数据)]
+
+    结果保持 refs 的顺序；出错的文件会被跳过并通过 on_error 报告。keep_failed=True 时
+    出错的页面保留为 (PageRef, None)，结果与 refs 一一对应（自动排版时位置已经确定）。
+    提供 cache 时，已经缓存的页面直接复用，只有未命中的页面才会交给工作进程处理。
+    """
+    prepared = []
+    total = len(refs)
+    profile = get_profile(profile)
+    keys = [_page_cache_key(cache, ref, max_size, profile) for ref in refs]
+    cached = [cache.get(key) if key else None for key in keys]
+    tasks = _group_tasks([ref for ref, data in zip(refs, cached) if data is None], max_size, profile)
+    results = _map_ordered(_prepare_task, tasks, executor, chunksize)
+    page_results = _page_results(tasks, results)
+    try:
+        for i, (ref, key, data) in enumerate(zip(refs, keys, cached)):
+            if data is None:
+                data, error_msg, error_detail = next(page_results)
+                if data is None:
+                    if error_msg:
+                        _report_error(on_error, error_msg, error_detail)
+                elif key:
+                    cache.put(key, data)
+            else:
+                merge_metrics.count('cache_hits')
+            if data is not None or keep_failed:
+                prepared.append((ref, data))
+            _notify(progress, STAGE_PREPARE, i + 1, total)
+            _check_cancelled(is_cancelled)
+    finally:
+        results.close()
+    return prepared
+
+
+def _compose_sheet(sheet, page_files, rows, cols, rasterize=False, profile=None, sheet_no=None,
+                   boxes=None):
+    """在输出页面 sheet 上排列 page_files，返回 [(错误信息, 错误详情)]
+
+    boxes 为自动排版确定的各页放置区域，为 None 时按 rows x cols 网格排列。
+    """
+    with merge_metrics.span('compose_sheet', sheet=sheet_no, cells=len(page_files)):
+        return _place_files(sheet, page_files, rows, cols, rasterize, profile, boxes)
+
+
+def _place_files(sheet, page_files, rows, cols, rasterize=False, profile=None, boxes=None):
+    import fitz
+    errors = []
+    for j, (ref, pdf_data) in enumerate(page_files):
+        if pdf_data is None:
+            # 规范化失败的页面已经报告过，留出空位
+            continue
+        try:
+            with fitz.open("pdf", pdf_data) as doc:
+                if doc.page_count > 0:
+                    place_page(sheet, j, doc[0], rows, cols, rasterize, profile,
+                               boxes[j] if boxes is not None else None)
+        except Exception as e:
+            errors.append((f'处理文件时出错（{os.path.basename(ref.path)}）：{str(e)}',
+                           traceback.format_exc()))
+    return errors
+
+
+def _object_key(doc, xref, text, digests):
+    if not doc.xref_is_stream(xref):
+        return text
+    digest = digests.get(xref)
+    if digest is None:
+        digest = hashlib.blake2b(doc.xref_stream_raw(xref), digest_size=16).digest()
+        digests[xref] = digest
+    return text, digest
+
+
+def _update_object(doc, xref, text):
+    """替换对象的字典部分，保留原有的（已压缩的）流数据"""
+    if not doc.xref_is_stream(xref):
+        doc.update_object(xref, text)
+        return
+    raw = doc.xref_stream_raw(xref)
+    keys = [(key, doc.xref_get_key(xref, key)) for key in ('Filter', 'DecodeParms')]
+    doc.update_object(xref, text)
+    doc.update_stream(xref, raw, compress=False)
+    for key, (kind, value) in keys:
+        if kind != 'null':
+            doc.xref_set_key(xref, key, value)
+
+
+def dedupe_objects(doc):
+    """合并文档中内容完全相同的对象（图片、字体、表单XObject等），返回合并掉的对象数
+
+    对象按字典文本和流数据的哈希分组，同组的引用都改为指向第一个对象，
+    多余的对象在保存时（garbage >= 1）被删除。引用改写后原本不同的对象可能变得相同
+    （如引用了同一张图片的两个表单XObject），因此重复进行直到没有新的合并。
+    """
+    with merge_metrics.span('dedupe_objects', pages=doc.page_count):
+        # 页面、页面树、目录和文档信息不能合并，但其中的引用需要改写
+        protected = {page.xref for page in doc} | {doc.pdf_catalog()}
+        kind, value = doc.xref_get_key(-1, 'Info')
+        if kind == 'xref':
+            protected.add(int(value.split()[0]))
+        objects = {}
+        for xref in range(1, doc.xref_length()):
+            text = doc.xref_object(xref, compressed=True)
+            if text == 'null':
+                continue
+            objects[xref] = text
+            if text.startswith(('<</Type/Pages', '<</Type/Annot')):
+                protected.add(xref)
+        digests = {}
+        first = {}
+        merged = {}
+        pending = sorted(set(objects) - protected)
+        while pending:
+            replaced = {}
+            for xref in pending:
+                original = first.setdefault(_object_key(doc, xref, objects[xref], digests), xref)
+                if original != xref:
+                    replaced[xref] = original
+            if not replaced:
+                break
+            merged.update(replaced)
+
+            def resolve(match):
+                xref = int(match.group(1))
+                return f'{replaced.get(xref, xref)} 0 R'
+
+            pending = []
+            for xref, text in objects.items():
+                if xref in merged or ' 0 R' not in text:
+                    continue
+                new_text = OBJECT_REF_PATTERN.sub(resolve, text)
+                if new_text != text:
+                    _update_object(doc, xref, new_text)
+                    objects[xref] = new_text
+                    if xref not in protected:
+                        pending.append(xref)
+        merge_metrics.count('objects_deduped', len(merged))
+        return len(merged)
+
+
+def _compose_sheet_task(task):
+    """工作进程任务：把一张输出页面排版为独立的单页PDF，返回 (PDF数据, 错误列表, 统计事件)"""
+    import fitz
+    page_files, rows, cols, page_size, rasterize, profile, sheet_no, boxes = task
+    with fitz.open() as doc:
+        sheet = doc.new_page(width=page_size[0], height=page_size[1])
+        errors = _compose_sheet(sheet, page_files, rows, cols, rasterize, profile, sheet_no, boxes)
+        return doc.tobytes(garbage=3, deflate=True), errors, merge_metrics.drain()
+
+
+def output_save_options():
+    """OUTPUT_SAVE_OPTIONS 中当前 PyMuPDF 的 Document.save 支持的参数"""
+    global _output_save_options
+    if _output_save_options is None:
+        import inspect
+        import fitz
+        accepted = inspect.signature(fitz.Document.save).parameters
+        _output_save_options = {key: value for key, value in OUTPUT_SAVE_OPTIONS.items()
+                                if key in accepted}
+    return _output_save_options
+
+
+class SheetWriter:
+    """接收排版完成的输出页面并写出到输出文件
+
+    默认在全部页面完成后一次写出；stream=True 时每完成 flush_sheets 页就以增量方式
+    追加写入磁盘并重新打开文档，已写出页面占用的内存随之释放。volume_sheets
+    为正整数时每 volume_sheets 页另存为一个分卷（输出名_001.pdf、输出名_002.pdf ...）。
+    写入过程中使用 .part 临时文件，完成后才替换为正式文件名。
+    """
+
+    def __init__(self, output, stream=False, volume_sheets=None, flush_sheets=DEFAULT_FLUSH_SHEETS):
+        import fitz
+        if hasattr(output, 'write') and (stream or volume_sheets):
+            raise MergeError('流式写出和分卷输出需要指定输出文件路径')
+        self.output = output
+        self.stream = stream
+        self.volume_sheets = volume_sheets
+        self.flush_sheets = max(1, flush_sheets)
+        self.outputs = []
+        self.page_count = 0
+        self.output_bytes = 0
+        self._volume = 1
+        self._volume_pages = 0
+        self._unflushed = 0
+        self._part_path = None
+        self.doc = fitz.open()
+
+    def _target_path(self):
+        if not self.volume_sheets:
+            return self.output
+        root, ext = os.path.splitext(self.output)
+        return f'{root}_{self._volume:03d}{ext or ".pdf"}'
+
+    def new_sheet(self, page_size):
+        return self.doc.new_page(width=page_size[0], height=page_size[1])
+
+    def add_sheet_pdf(self, pdf_data):
+        import fitz
+        with fitz.open("pdf", pdf_data) as sheet_doc:
+            self.doc.insert_pdf(sheet_doc)
+
+    def next_position(self):
+        """下一张输出页面的 (分卷序号, 分卷中的页码)，都从1开始"""
+        return self._volume, self._volume_pages + 1
+
+    def sheet_done(self):
+        """一页排版完成后调用，按需要增量写出或结束当前分卷"""
+        self.page_count += 1
+        self._volume_pages += 1
+        self._unflushed += 1
+        if self.volume_sheets and self._volume_pages >= self.volume_sheets:
+            self._finish_volume()
+        elif self.stream and self._unflushed >= self.flush_sheets:
+            self._flush()
+
+    def _flush(self):
+        import fitz
+        with merge_metrics.span('flush', sheets=self._unflushed):
+            if self._part_path is None:
+                self._part_path = self._target_path() + '.part'
+                self.doc.save(self._part_path, garbage=3, deflate=True)
+            else:
+                self.doc.saveIncr()
+        # 重新打开后已写出的对象不再常驻内存
+        self.doc.close()
+        self.doc = fitz.open(self._part_path)
+        self._unflushed = 0
+
+    def _finish_volume(self):
+        import fitz
+        if self._volume_pages == 0:
+            return
+        written = self.output_bytes
+        with merge_metrics.span('write', volume=self._volume, sheets=self._volume_pages):
+            if hasattr(self.output, 'write'):
+                dedupe_objects(self.doc)
+                data = self.doc.tobytes(**output_save_options())
+                self.output.write(data)
+                self.output_bytes += len(data)
+            else:
+                path = self._target_path()
+                if self._part_path is None:
+                    self._part_path = path + '.part'
+                    dedupe_objects(self.doc)
+                    self.doc.save(self._part_path, **output_save_options())
+                    self.doc.close()
+                else:
+                    if self._unflushed:
+                        self.doc.saveIncr()
+                    self.doc.close()
+                    self._compact()
+                os.replace(self._part_path, path)
+                self.outputs.append(path)
+                self.output_bytes += os.path.getsize(path)
+        merge_metrics.count('bytes_written', self.output_bytes - written)
+        self.doc = fitz.open()
+        self._part_path = None
+        self._volume += 1
+        self._volume_pages = 0
+        self._unflushed = 0
+
+    def _compact(self):
+        """整体重写增量写出的文件：各批页面中相同的资源只保留一份，并去掉增量写入留下的旧对象"""
+        import fitz
+        compact_path = self._part_path + '.tmp'
+        try:
+            with merge_metrics.span('compact'), fitz.open(self._part_path) as doc:
+                dedupe_objects(doc)
+                doc.save(compact_path, **output_save_options())
+            os.replace(compact_path, self._part_path)
+        except BaseException:
+            if os.path.exists(compact_path):
+                os.unlink(compact_path)
+            raise
+
+    def close(self):
+        """写出剩余页面"""
+        self._finish_volume()
+        self.doc.close()
+
+    def abort(self):
+        """放弃写出，删除未完成的临时文件以及已经写出的分卷"""
+        # 写出失败时文档可能已经关闭，不能让再次关闭的错误掩盖原来的异常
+        if not self.doc.is_closed:
+            self.doc.close()
+        paths = self.outputs + ([self._part_path] if self._part_path is not None else [])
+        for path in paths:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        self.outputs = []
+        self._part_path = None
+
+
+def _record_placements(placements, writer, page_files):
+    if placements is not None:
+        volume, sheet = writer.next_position()
+        placements.extend(Placement(ref, volume, sheet, j)
+                          for j, (ref, data) in enumerate(page_files) if data is not None)
+
+
+def _compose(writer, prepared, rows, cols, page_size, rasterize=False, profile=None,
+             progress=None, on_error=None, executor=None, chunksize=DEFAULT_CHUNKSIZE,
+             is_cancelled=None, done=0, total=None, layouts=None, placements=None):
+    """将规范化后的文件按网格排版，每完成一页交给 writer
+
+    layouts 为自动排版的 [auto_layout.Sheet] 时按其中的尺寸和放置区域排版，
+    prepared 依次分给各张输出页面。placements 为列表时追加每个页面的 Placement。
+    提供 executor 时每张输出页面在工作进程中独立排版，再按原顺序追加。
+    done/total 用于在分批调用时连续报告进度，返回更新后的 done。
+    """
+    if total is None:
+        total = len(prepared)
+    # 每张输出页面为 (页面尺寸, 页面文件, 放置区域)
+    sheets = []
+    if layouts is None:
+        files_per_page = rows * cols
+        for i in range(0, len(prepared), files_per_page):
+            sheets.append((page_size, prepared[i:i + files_per_page], None))
+    else:
+        start = 0
+        for layout in layouts:
+            end = start + len(layout.boxes)
+            sheets.append(((layout.width, layout.height), prepared[start:end], layout.boxes))
+            start = end
+
+    if executor is not None and len(sheets) > 1:
+        first_sheet = writer.page_count + 1
+        tasks = [(page_files, rows, cols, sheet_size, rasterize, profile, first_sheet + k, boxes)
+                 for k, (sheet_size, page_files, boxes) in enumerate(sheets)]
+        results = _map_ordered(_compose_sheet_task, tasks, executor, chunksize)
+        try:
+            for (_, page_files, _), (pdf_data, errors, events) in zip(sheets, results):
+                merge_metrics.forward(events)
+                writer.add_sheet_pdf(pdf_data)
+                _record_placements(placements, writer, page_files)
+                writer.sheet_done()
+                for error_msg, error_detail in errors:
+                    _report_error(on_error, error_msg, error_detail)
+                done += len(page_files)
+                _notify(progress, STAGE_COMPOSE, done, total)
+                _check_cancelled(is_cancelled)
+        finally:
+            results.close()
+        return done
+
+    for sheet_size, page_files, boxes in sheets:
+        # 创建新的空白页面并排列文件
+        sheet = writer.new_sheet(sheet_size)
+        errors = _compose_sheet(sheet, page_files, rows, cols, rasterize, profile,
+                                writer.page_count + 1, boxes)
+        for error_msg, error_detail in errors:
+            _report_error(on_error, error_msg, error_detail)
+        _record_placements(placements, writer, page_files)
+        writer.sheet_done()
+        done += len(page_files)
+        _notify(progress, STAGE_COMPOSE, done, total)
+        _check_cancelled(is_cancelled)
+    return done
+
+
+def peak_rss():
+    """返回当前进程的峰值常驻内存（字节），无法获取时返回 None"""
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS 上的单位是字节，Linux 上是KB
+        return usage if sys.platform == 'darwin' else usage * 1024
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    return None
+
+
+def merge(inputs, rows, cols, orientation=PORTRAIT, output=None, rasterize=False,
+          progress=None, on_error=None, workers=1, chunksize=DEFAULT_CHUNKSIZE, is_cancelled=None,
+          cache=None, stats=None, stream=False, volume_sheets=None, flush_sheets=DEFAULT_FLUSH_SHEETS,
+          profile=DEFAULT_PROFILE, page_ranges=None, index=None, layout=LAYOUT_GRID,
+          min_scale=auto_layout.DEFAULT_MIN_SCALE, arrange=None, placements=None):
+    """按 rows x cols 网格将 inputs 的所有页面合并为一个PDF并保存到 output
+
+    整个过程在内存中完成，不产生临时文件。output 可以是文件路径或可写的二进制流。
+    progress(stage, done, total) 用于报告进度，stage 为 STAGE_PREPARE 或
+    STAGE_COMPOSE；on_error(message) 在单个文件处理失败时调用，该文件会被跳过。
+    workers > 1 时文件规范化和逐页排版在进程池中并行执行，输出顺序与 inputs 一致。
+    is_cancelled() 返回 True 时停止处理并抛出 MergeCancelled，不会留下输出文件
+    （已写出的分卷也会被删除）；需要在其他线程中取消时可使用 MergeJob。
+    cache 为 page_cache.PageCache 时复用之前处理过的文件。
+    profile 为质量配置名称（draft/screen/print/archive），决定图片输入缩小到的有效DPI、
+    栅格化时的渲染DPI以及位图的编码方式。
+    多页PDF的每一页各占一个单元格；page_ranges 为 {文件: 页码范围（如 "1-3,5"）} 时
+    只使用指定的页面。index 为 PageIndex 时复用其中已读取的页数。
+
+    layout=LAYOUT_AUTO 时忽略 rows/cols：先读取所有页面的尺寸，再按原始比例装箱到
+    纵向或横向的A4页面上（见 auto_layout），页面不小于原始尺寸的 min_scale 倍，
+    orientation 为首选方向。
+
+    arrange(refs) 返回重新排列后的页面列表（[PageRef]），在排版之前调用，可用于按
+    发票信息排序或分组（见 invoice_index.arrange）。placements 为列表时追加每个页面
+    在结果中的位置（Placement），分卷序号对应 stats['outputs'] 中的文件。
+
+    stream=True 时按批处理：每次只规范化几页所需的输入，排版完成后立即释放，
+    并每 flush_sheets 页增量写出一次，内存占用与输入数量无关；volume_sheets
+    为正整数时每 volume_sheets 页输出为一个分卷，详见 SheetWriter。
+
+    stats 为字典时写入 input_pages（输入页数）、prepared_bytes、output_bytes、outputs、
+    peak_rss 等统计信息，
+    自动排版时还有缩放比例 scale。返回输出的页数。
+    """
+    if layout not in (LAYOUT_GRID, LAYOUT_AUTO):
+        raise MergeError(f'未知的排版方式：{layout}')
+    if layout == LAYOUT_GRID and (rows < 1 or cols < 1):
+        raise MergeError('行数和列数必须大于0')
+
+    page_size = page_size_for(orientation)
+    profile = get_profile(profile)
+    max_size = target_pixel_size(rows, cols, orientation, profile, layout)
+    layouts = None
+    if layout == LAYOUT_AUTO:
+        own_index = index is None
+        if own_index:
+            index = PageIndex()
+        try:
+            with merge_metrics.span('index_pages', inputs=len(inputs)):
+                refs = expand_pages(inputs, page_ranges, on_error, index)
+            if arrange is not None:
+                refs = arrange(refs)
+            with merge_metrics.span('page_sizes', pages=len(refs)):
+                refs, sizes = page_sizes(refs, on_error, index)
+        finally:
+            if own_index:
+                index.close()
+        with merge_metrics.span('auto_layout', pages=len(refs)):
+            scale, layouts = plan_auto_layout(sizes, orientation, min_scale)
+        grid = f'auto@{scale:.2f}'
+    else:
+        with merge_metrics.span('index_pages', inputs=len(inputs)):
+            refs = expand_pages(inputs, page_ranges, on_error, index)
+        if arrange is not None:
+            refs = arrange(refs)
+        grid = f'{rows}x{cols}'
+    total = len(refs)
+    sheets_per_batch = max(1, workers or 1) * max(1, chunksize)
+    if layout == LAYOUT_AUTO:
+        # 位置已经确定，每批正好包含若干张完整的输出页面
+        if not stream:
+            sheets_per_batch = max(1, len(layouts))
+        batches = []
+        start = 0
+        for k in range(0, len(layouts), sheets_per_batch):
+            sheets = layouts[k:k + sheets_per_batch]
+            end = start + sum(len(sheet.boxes) for sheet in sheets)
+            batches.append((start, end, sheets))
+            start = end
+    else:
+        # 每批的输入数量正好够所有工作进程各排版 chunksize 页
+        batch_size = sheets_per_batch * rows * cols if stream else max(1, total)
+        batches = [(start, min(start + batch_size, total), None)
+                   for start in range(0, total, batch_size)]
+
+    def prepare_progress(offset):
+        return lambda stage, done, _: _notify(progress, stage, offset + done, total)
+
+    with merge_metrics.run('merge', inputs=total, grid=grid, orientation=orientation,
+                           profile=profile.name, rasterize=rasterize, stream=stream, workers=workers):
+        writer = SheetWriter(output, stream, volume_sheets, flush_sheets)
+        executor = _create_executor(workers, total)
+        prepared_bytes = 0
+        composed = 0
+        try:
+            # 上一批中凑不满一页的文件留到下一批（网格排版）
+            pending = []
+            for start, end, sheets in batches:
+                batch = _prepare_all(refs[start:end], prepare_progress(start),
+                                     on_error, executor, chunksize, is_cancelled, cache,
+                                     max_size, profile, keep_failed=sheets is not None)
+                prepared_bytes += sum(len(data) for _, data in batch if data is not None)
+                pending += batch
+                if sheets is None and end < total:
+                    ready = len(pending) // (rows * cols) * (rows * cols)
+                else:
+                    ready = len(pending)
+                page_files, pending = pending[:ready], pending[ready:]
+                composed = _compose(writer, page_files, rows, cols, page_size, rasterize, profile,
+                                    progress, on_error, executor, chunksize, is_cancelled,
+                                    done=composed, total=total if stream else None,
+                                    layouts=sheets, placements=placements)
+                del batch, page_files
+
+            if writer.page_count == 0 or prepared_bytes == 0:
+                raise MergeError('没有可处理的文件！')
+            writer.close()
+        except BaseException:
+            writer.abort()
+            raise
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+    if stats is not None:
+        stats['input_pages'] = total
+        stats['prepared_bytes'] = prepared_bytes
+        stats['pages'] = writer.page_count
+        stats['output_bytes'] = writer.output_bytes
+        stats['outputs'] = writer.outputs
+        stats['peak_rss'] = peak_rss()
+        if layout == LAYOUT_AUTO:
+            stats['scale'] = scale
+    return writer.page_count
+
+
+def prefetch(inputs, rows, cols, orientation=PORTRAIT, cache=None, profile=DEFAULT_PROFILE,
+             page_ranges=None, on_error=None, workers=1, chunksize=DEFAULT_CHUNKSIZE, index=None,
+             layout=LAYOUT_GRID):
+    """预先规范化 inputs 的所有页面并存入 cache，返回页数
+
+    之后用相同的网格（或排版方式）、方向和质量参数调用 merge 时直接使用缓存中的结果，
+    文件可以在到达时就处理好，而不必等到合并时才处理。
+    """
+    if cache is None:
+        raise MergeError('预先处理文件需要提供缓存')
+    profile = get_profile(profile)
+    max_size = target_pixel_size(rows, cols, orientation, profile, layout)
+    refs = expand_pages(inputs, page_ranges, on_error, index)
+    executor = _create_executor(workers, len(refs))
+    try:
+        with merge_metrics.span('prefetch', inputs=len(inputs), pages=len(refs)):
+            _prepare_all(refs, on_error=on_error, executor=executor, chunksize=chunksize,
+                         cache=cache, max_size=max_size, profile=profile)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    return len(refs)
+
+
+def format_eta(seconds):
+    """把预计剩余秒数格式化为进度文字，如 "剩余约 2 分 5 秒"；无法估计时返回空字符串"""
+    if seconds is None:
+        return ''
+    seconds = int(math.ceil(seconds))
+    if seconds < 60:
+        return f'剩余约 {seconds} 秒'
+    minutes, seconds = divmod(seconds, 60)
+    if minutes < 60:
+        return f'剩余约 {minutes} 分 {seconds} 秒'
+    hours, minutes = divmod(minutes, 60)
+    return f'剩余约 {hours} 小时 {minutes} 分'
+
+
+class ProgressReporter:
+    """节流的进度回调，可直接作为 merge 等函数的 progress 参数
+
+    按时间间隔而不是每一页转发进度给 callback(stage, done, total)，每个阶段的
+    第一次和最后一次进度总会转发。同时记录各阶段的实测速度，用于估计剩余时间。
+    """
+
+    def __init__(self, callback=None, interval=PROGRESS_INTERVAL):
+        self.callback = callback
+        self.interval = interval
+        # 阶段 -> (开始时间, 开始时的完成数, 完成数, 总数)
+        self._stages = {}
+        self._last = None
+
+    def __call__(self, stage, done, total):
+        now = time.monotonic()
+        state = self._stages.get(stage)
+        self._stages[stage] = (now, done, done, total) if state is None else state[:2] + (done, total)
+        if (state is not None and done < total and self._last is not None
+                and now - self._last < self.interval):
+            return
+        self._last = now
+        _notify(self.callback, stage, done, total)
+
+    def eta(self, stage):
+        """阶段 stage 预计还需要的秒数，还无法估计时返回 None"""
+        state = self._stages.get(stage)
+        if state is None:
+            return None
+        start, first, done, total = state
+        if done >= total:
+            return 0.0
+        elapsed = time.monotonic() - start
+        if done <= first or elapsed < ETA_MIN_ELAPSED:
+            return None
+        return (total - done) * elapsed / (done - first)
+
+    def snapshot(self):
+        """返回 {阶段: (完成数, 总数, 预计剩余秒数或 None)}"""
+        return {stage: (state[2], state[3], self.eta(stage))
+                for stage, state in list(self._stages.items())}
+
+
+class MergeJob:
+    """可以取消、可以查询进度的一次合并任务
+
+    在工作线程中调用 run()，其他线程可以随时调用 cancel() 或读取 state 和
+    progress()。取消后合并在处理完当前页面时停止，临时文件和已写出的分卷都会被删除。
+    options 为 merge 的其他关键字参数（orientation、workers、cache、stream 等）。
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, inputs, rows, cols, output, progress=None, on_error=None,
+                 interval=PROGRESS_INTERVAL, **options):
+        self.inputs = list(inputs)
+        self.rows = rows
+        self.cols = cols
+        self.output = output
+        self.options = options
+        self.reporter = ProgressReporter(progress, interval)
+        self.state = MergeJob.PENDING
+        self.error = None
+        self.warnings = []
+        self.pages = 0
+        self.stats = {}
+        self._on_error = on_error
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def is_cancelled(self):
+        return self._cancelled.is_set()
+
+    def progress(self):
+        """返回 {阶段: (完成数, 总数, 预计剩余秒数或 None)}"""
+        return self.reporter.snapshot()
+
+    def _report_error(self, error_msg):
+        self.warnings.append(error_msg)
+        _notify(self._on_error, error_msg)
+
+    def run(self):
+        """执行合并并返回输出页数；取消时抛出 MergeCancelled，失败时抛出原来的异常"""
+        try:
+            _check_cancelled(self.is_cancelled)
+            self.state = MergeJob.RUNNING
+            self.pages = merge(self.inputs, self.rows, self.cols, output=self.output,
+                               progress=self.reporter, on_error=self._report_error,
+                               is_cancelled=self.is_cancelled, stats=self.stats, **self.options)
+        except MergeCancelled:
+            self.state = MergeJob.CANCELLED
+            raise
+        except BaseException as e:
+            self.state = MergeJob.FAILED
+            self.error = str(e)
+            raise
+        self.state = MergeJob.DONE
+        return self.pages
+
+
+def preview_cell_size(rows, cols, orientation=PORTRAIT, zoom=PREVIEW_ZOOM):
+    """预览页面中单元格内容区域的像素大小 (宽, 高)"""
+    page_width, page_height = page_size_for(orientation)
+    return (max(1, int(page_width * zoom / cols * CELL_FILL_RATIO)),
+            max(1, int(page_height * zoom / rows * CELL_FILL_RATIO)))
+
+
+def render_preview_tile(source, box, cache=None, page=0, index=None):
+    """按预览中单元格的像素大小直接渲染源文件的第 page 页（从0开始），返回PPM图像数据
+
+    box 为 (宽, 高) 像素，结果保持纵横比并且不超过 box。不生成中间PDF：PDF页面
+    直接按目标大小光栅化，JPEG在解码阶段就按比例缩小，所以耗时只与单元格大小有关。
+    index 为 PageIndex 时使用其中已打开的文档。
+    """
+    import fitz
+    from PIL import Image
+    width, height = box
+    key = _cache_key(cache, source, 'tile', width, height, page)
+    if key:
+        data = cache.get(key)
+        if data is not None:
+            merge_metrics.count('cache_hits')
+            return data
+    try:
+        with merge_metrics.span('preview_tile', file=os.path.basename(source)):
+            if source.lower().endswith(PDF_EXTENSIONS):
+                documents = index.document(source) if index is not None else fitz.open(source)
+                with documents as doc:
+                    if doc.page_count == 0:
+                        raise Exception('PDF文件为空')
+                    src_page = doc[page]
+                    zoom = min(width / src_page.rect.width, height / src_page.rect.height)
+                    pix = src_page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+                    merge_metrics.count('pixels_rendered', pix.width * pix.height)
+                    data = pix.tobytes('ppm')
+            else:
+                with Image.open(source) as img:
+                    if page:
+                        img.seek(page)
+                    orientation = image_orientation(img)
+                    # JPEG 可以在解码时直接按 1/2、1/4、1/8 缩小
+                    draft_image(img, (width, height), orientation)
+                    merge_metrics.count('pixels_decoded', img.width * img.height)
+                    img = to_rgb(img)
+                    if orientation in EXIF_SWAPPED:
+                        img.thumbnail((height, width), Image.BILINEAR)
+                    else:
+                        img.thumbnail((width, height), Image.BILINEAR)
+                    if orientation in EXIF_TRANSPOSE:
+                        img = img.transpose(EXIF_TRANSPOSE[orientation])
+                    buffer = io.BytesIO()
+                    img.save(buffer, 'PPM')
+                    data = buffer.getvalue()
+    except Exception as e:
+        raise MergeError(f'预览文件时出错（{os.path.basename(source)}）：{str(e)}') from e
+    if key:
+        cache.put(key, data)
+    return data
+
+
+def render_preview_tiles(refs, box, on_tile, progress=None, on_error=None, is_cancelled=None,
+                         cache=None, index=None):
+    """逐个渲染页面（[PageRef]）的预览图块（见 render_preview_tile），每完成一个调用 on_tile(序号, PPM数据)
+
+    用于增量预览：调用方只传入当前页面上还没有合适图块的页面。出错的页面通过 on_error
+    报告，不会回调 on_tile。
+    """
+    with merge_metrics.run('preview_tiles', inputs=len(refs)):
+        for i, ref in enumerate(refs):
+            _check_cancelled(is_cancelled)
+            try:
+                on_tile(i, render_preview_tile(ref.path, box, cache, ref.page, index))
+            except MergeError as e:
+                _report_error(on_error, str(e), traceback.format_exc())
+            _notify(progress, STAGE_PREPARE, i + 1, len(refs))
+
+
+def render_preview(inputs, rows, cols, orientation=PORTRAIT, zoom=PREVIEW_ZOOM,
+                   progress=None, on_error=None, is_cancelled=None, cache=None, sheet=0,
+                   page_ranges=None, index=None):
+    """渲染第 sheet 张输出页面（从0开始）的预览图，返回PPM格式的图像数据；没有可用文件时返回 None
+
+    只处理该页面上的文件，每个单元格按屏幕上的大小直接渲染后拼接，不经过PDF排版。
+    """
+    from PIL import Image
+    cells = sheet_inputs(expand_pages(inputs, page_ranges, on_error, index), sheet, rows, cols)
+    box = preview_cell_size(rows, cols, orientation, zoom)
+    page_width, page_height = page_size_for(orientation)
+    width, height = round(page_width * zoom), round(page_height * zoom)
+    with merge_metrics.run('preview', inputs=len(cells), grid=f'{rows}x{cols}', sheet=sheet):
+        canvas = Image.new('RGB', (width, height), (255, 255, 255))
+        placed = 0
+
+        def on_tile(index, data):
+            nonlocal placed
+            with Image.open(io.BytesIO(data)) as tile:
+                x0, y0, x1, y1 = cell_box(index, rows, cols, width, height, tile.width, tile.height)
+                size = (max(1, round(x1 - x0)), max(1, round(y1 - y0)))
+                canvas.paste(tile if tile.size == size else tile.resize(size, Image.BILINEAR),
+                             (round(x0), round(y0)))
+            placed += 1
+
+        render_preview_tiles(cells, box, on_tile, progress, on_error, is_cancelled, cache, index)
+        if not placed:
+            return None
+        buffer = io.BytesIO()
+        canvas.save(buffer, 'PPM')
+        return buffer.getvalue()
+
+
+def split_page_range(pattern):
+    """拆分 "文件.pdf:1-3,5" 形式的输入，返回 (路径, 页码范围或 None)"""
+    path, sep, spec = pattern.rpartition(':')
+    if sep and path.lower().endswith(PDF_EXTENSIONS) and PAGE_RANGE_PATTERN.match(spec):
+        return path, spec.strip()
+    return pattern, None
+
+
+def expand_inputs(patterns, page_ranges=None):
+    """展开命令行输入：普通文件、通配符、目录以及 @清单文件（每行一个路径或通配符）
+
+    PDF路径后可以加 ":页码范围"（如 发票.pdf:1-3,5）只使用部分页面，提供字典
+    page_ranges 时页码范围按文件写入其中。
+    """
+    files = []
+    seen = set()
+
+    def add(path, spec=None):
+        key = os.path.normcase(os.path.abspath(path))
+        if is_supported(path) and key not in seen:
+            seen.add(key)
+            files.append(path)
+            if spec and page_ranges is not None:
+                page_ranges[path] = spec
+
+    def expand(pattern, base_dir=''):
+        pattern, spec = split_page_range(pattern)
+        pattern = os.path.join(base_dir, os.path.expanduser(pattern))
+        if os.path.isdir(pattern):
+            for name in sorted(os.listdir(pattern)):
+                add(os.path.join(pattern, name))
+        elif glob.has_magic(pattern):
+            for path in sorted(glob.glob(pattern, recursive=True)):
+                add(path, spec)
+        elif os.path.isfile(pattern):
+            add(pattern, spec)
+        else:
+            raise MergeError(f'找不到输入文件：{pattern}')
+
+    for pattern in patterns:
+        if pattern.startswith('@'):
+            manifest = pattern[1:]
+            base_dir = os.path.dirname(manifest)
+            with open(manifest, encoding='utf-8-sig') as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        expand(line, base_dir)
+        else:
+            expand(pattern)
+    return files
+
+
+def build_arg_parser():
+    import argparse
+    import invoice_index
+    parser = argparse.ArgumentParser(
+        prog='merge_engine',
+        description='将发票PDF和图片按网格合并到A4页面上（无界面批处理）')
+    parser.add_argument('inputs', nargs='+',
+                        help='输入文件、通配符、目录，或以 @ 开头的清单文件；'
+                             'PDF后加 ":页码范围" 只使用部分页面，如 账单.pdf:1-3,5')
+    parser.add_argument('-o', '--output', required=True, help='输出PDF路径')
+    parser.add_argument('-r', '--rows', type=int, default=3, help='每页行数（默认3）')
+    parser.add_argument('-c', '--cols', type=int, default=2, help='每页列数（默认2）')
+    parser.add_argument('--landscape', action='store_true',
+                        help='横向输出页面（自动排版时为页数相同时优先使用的方向）')
+    parser.add_argument('--auto-layout', action='store_true',
+                        help='按页面实际尺寸自动排版（忽略行数和列数），每页自动选择方向和排列，使总页数最少')
+    parser.add_argument('--min-scale', type=float, default=auto_layout.DEFAULT_MIN_SCALE,
+                        help=f'自动排版时页面相对原始尺寸的最小缩放比例（默认{auto_layout.DEFAULT_MIN_SCALE}）')
+    parser.add_argument('--pages', default=None,
+                        help='所有PDF默认使用的页码范围，如 1 表示只取第一页（默认全部页面）')
+    parser.add_argument('--rasterize', action='store_true',
+                        help='栅格化输出（兼容模式），默认矢量排版')
+    parser.add_argument('--quality', choices=list(QUALITY_PROFILES), default=DEFAULT_PROFILE,
+                        help=f'位图输出质量（默认{DEFAULT_PROFILE}）：图片缩小到的有效DPI及编码方式，'
+                             + '，'.join(f'{p.name}={p.dpi}DPI/{p.image_format}' for p in QUALITY_PROFILES.values()))
+    parser.add_argument('--skip-duplicates', action='store_true',
+                        help='跳过内容完全相同的重复文件（只保留最先出现的一个）')
+    parser.add_argument('--skip-similar', action='store_true',
+                        help='同时跳过看起来相同的文件（如同一张发票的PDF和照片），按第一页的感知哈希判断')
+    parser.add_argument('--sort', choices=invoice_index.SORT_KEYS, default=None,
+                        help='按PDF文字层中识别的发票信息排序页面：开票日期、金额、发票号码或销售方')
+    parser.add_argument('--group', choices=invoice_index.GROUP_KEYS, default=None,
+                        help='按销售方或开票月份把页面排在一起（组内按 --sort 排序）')
+    parser.add_argument('--sidecar', nargs='?', const='', default=None, metavar='CSV',
+                        help='同时输出发票位置清单（发票号码、日期、金额、销售方及所在的输出页和单元格），'
+                             '默认与输出文件同名的 .csv')
+    parser.add_argument('--invoice-index', default=invoice_index.default_index_path(),
+                        help='发票信息索引文件，提取过的文件不再重复提取，可用 invoice_index.py 查找发票所在位置')
+    parser.add_argument('-j', '--workers', type=int, default=default_workers(),
+                        help='并行工作进程数（默认为CPU核心数，1表示不并行）')
+    parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE,
+                        help=f'每个工作进程一次领取的任务数（默认{DEFAULT_CHUNKSIZE}）')
+    parser.add_argument('--cache-dir', default=page_cache.default_cache_dir(),
+                        help='磁盘缓存目录，重复处理相同文件时直接复用结果')
+    parser.add_argument('--no-cache', action='store_true', help='不使用缓存')
+    parser.add_argument('--stream', action='store_true',
+                        help='流式处理：分批规范化并增量写出，适合数千个文件的大批量任务')
+    parser.add_argument('--flush-sheets', type=int, default=DEFAULT_FLUSH_SHEETS,
+                        help=f'流式处理时每多少页写盘一次（默认{DEFAULT_FLUSH_SHEETS}）')
+    parser.add_argument('--volume-sheets', type=int, default=None,
+                        help='每个分卷的页数，指定后输出为 输出名_001.pdf、输出名_002.pdf ...')
+    parser.add_argument('--metrics', nargs='?', const=merge_metrics.METRICS_FILE, default=None,
+                        help=f'把各阶段耗时和计数以JSON行追加到文件（默认 {merge_metrics.METRICS_FILE}）')
+    parser.add_argument('--profile', metavar='PATH', default=None,
+                        help='用 cProfile 分析本次运行并把结果保存到 PATH')
+    parser.add_argument('-v', '--verbose', action='store_true', help='完成后输出内存和大小统计')
+    parser.add_argument('-q', '--quiet', action='store_true', help='不输出进度信息')
+    return parser
+
+
+def cli_main(argv=None):
+    """命令行入口，返回进程退出码"""
+    args = build_arg_parser().parse_args(argv)
+    logging.basicConfig(level=logging.ERROR, format='%(levelname)s - %(message)s')
+    if args.metrics:
+        merge_metrics.configure(args.metrics)
+    else:
+        merge_metrics.configure_from_env()
+
+    def report(stage, done, total):
+        if not args.quiet:
+            label = '处理页面' if stage == STAGE_PREPARE else '排版页面'
+            eta = format_eta(progress.eta(stage)) if done < total else ''
+            print(f'{label}: {done}/{total} {eta}'.rstrip(), file=sys.stderr)
+
+    progress = ProgressReporter(report, CLI_PROGRESS_INTERVAL)
+
+    try:
+        cache = None
+        if not args.no_cache:
+            cache = page_cache.PageCache(disk_dir=args.cache_dir)
+        page_ranges = {}
+        inputs = expand_inputs(args.inputs, page_ranges)
+        if not inputs:
+            raise MergeError('没有找到支持的输入文件')
+        if args.pages:
+            for path in inputs:
+                if path.lower().endswith(PDF_EXTENSIONS):
+                    page_ranges.setdefault(path, args.pages)
+        if args.skip_duplicates or args.skip_similar:
+            # 在处理文件之前排除重复文件
+            import duplicate_index
+            inputs, duplicates = duplicate_index.find_duplicates(
+                inputs, similar=args.skip_similar, cache=cache,
+                on_error=lambda msg: print(msg, file=sys.stderr))
+            if not args.quiet:
+                for duplicate in duplicates:
+                    relation = '相同' if duplicate.kind == duplicate_index.EXACT else '相似'
+                    print(f'跳过重复文件：{duplicate.path}（与 {duplicate.original} {relation}）',
+                          file=sys.stderr)
+        invoices = arrange = placements = None
+        if args.sort or args.group or args.sidecar is not None:
+            # 提取发票信息，用于排序分组以及记录每张发票在结果中的位置
+            import invoice_index
+            invoices = invoice_index.InvoiceIndex(args.invoice_index)
+            placements = []
+            if args.sort or args.group:
+                def arrange_pages(refs):
+                    invoices.update(refs, workers=args.workers, chunksize=args.chunksize)
+                    return invoice_index.arrange(refs, invoices, args.sort, args.group)
+                arrange = arrange_pages
+        stats = {}
+        with merge_metrics.profiled(args.profile):
+            page_count = merge(inputs, args.rows, args.cols,
+                               LANDSCAPE if args.landscape else PORTRAIT,
+                               args.output, rasterize=args.rasterize, progress=progress,
+                               workers=args.workers, chunksize=args.chunksize, cache=cache,
+                               stats=stats, stream=args.stream, volume_sheets=args.volume_sheets,
+                               flush_sheets=args.flush_sheets, profile=args.quality,
+                               page_ranges=page_ranges,
+                               layout=LAYOUT_AUTO if args.auto_layout else LAYOUT_GRID,
+                               min_scale=args.min_scale, arrange=arrange, placements=placements)
+        if invoices is not None:
+            if args.sidecar is not None:
+                sidecar = args.sidecar or os.path.splitext(args.output)[0] + '.csv'
+                invoice_index.write_sidecar(sidecar, placements, stats['outputs'], invoices,
+                                            None if args.auto_layout else args.cols,
+                                            workers=args.workers)
+            invoices.record_locations(placements, stats['outputs'])
+            invoices.save()
+    except (MergeError, OSError) as e:
+        print(f'合并失败：{e}', file=sys.stderr)
+        return 1
+    if not args.quiet:
+        outputs = '、'.join(stats['outputs']) or args.output
+        print(f'合并完成：{len(inputs)} 个文件 -> {page_count} 页 -> {outputs}',
+              file=sys.stderr)
+    if args.verbose:
+        peak = stats.get('peak_rss')
+        print(f"规范化页面 {stats['prepared_bytes'] / 1048576:.1f} MB，"
+              f"输出 {stats['output_bytes'] / 1048576:.1f} MB，"
+              f"峰值内存 {'未知' if peak is None else f'{peak / 1048576:.1f} MB'}", file=sys.stderr)
+        if 'scale' in stats:
+            print(f"自动排版缩放比例 {stats['scale']:.0%}", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(cli_main())
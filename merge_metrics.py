@@ -0,0 +1,168 @@
+"""结构化耗时统计与性能分析钩子
+
+启用后，每个处理阶段的耗时（按输入文件和输出页面）以JSON行的形式追加到
+pdf_merger_metrics.jsonl（与错误日志 pdf_merger_error.log 在同一目录），每次
+合并或预览结束时再写入一条汇总记录，包含总耗时以及读写字节数、渲染像素数等计数。
+
+启用方式：
+    环境变量 PDF_MERGER_METRICS=1（或直接设置为输出文件路径），或命令行 --metrics
+    环境变量 PDF_MERGER_PROFILE=输出路径，或命令行 --profile 输出路径：
+        用 cProfile 分析整个任务，结果可用 python -m pstats 或 snakeviz 查看
+
+未启用时所有记录函数都直接返回，几乎没有额外开销。
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+import uuid
+
+METRICS_FILE = 'pdf_merger_metrics.jsonl'
+METRICS_ENV = 'PDF_MERGER_METRICS'
+PROFILE_ENV = 'PDF_MERGER_PROFILE'
+
+_lock = threading.Lock()
+_file = None
+# 工作进程中暂存的事件，由任务结果带回主进程后统一写出
+_worker_events = None
+_local = threading.local()
+
+
+def configure(path=METRICS_FILE):
+    """启用统计，事件追加写入 path"""
+    global _file
+    with _lock:
+        if _file is not None:
+            _file.close()
+        _file = open(path, 'a', encoding='utf-8', buffering=1)
+
+
+def disable():
+    global _file
+    with _lock:
+        if _file is not None:
+            _file.close()
+        _file = None
+
+
+def configure_from_env():
+    """根据环境变量 PDF_MERGER_METRICS 启用统计"""
+    value = os.environ.get(METRICS_ENV, '').strip()
+    if value and value.lower() not in ('0', 'false', 'no'):
+        configure(METRICS_FILE if value.lower() in ('1', 'true', 'yes') else value)
+
+
+def enabled():
+    return _file is not None or _worker_events is not None
+
+
+def _write(event):
+    with _lock:
+        if _file is not None:
+            _file.write(json.dumps(event, ensure_ascii=False) + '\n')
+
+
+def _record(event):
+    if _worker_events is not None:
+        _worker_events.append(event)
+        return
+    current = getattr(_local, 'run', None)
+    if event['event'] == 'count':
+        # 计数只汇总到所属任务的记录中
+        if current is not None:
+            current['counters'][event['name']] = current['counters'].get(event['name'], 0) + event['value']
+        return
+    if current is not None:
+        event['run'] = current['run']
+    _write(event)
+
+
+@contextlib.contextmanager
+def span(name, **fields):
+    """记录代码块的耗时，fields 为附加的上下文（文件名、页码等）"""
+    if not enabled():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed(name, start, **fields)
+
+
+def elapsed(name, start, **fields):
+    """记录从 start（time.perf_counter() 的返回值）到现在的耗时，用于无法包成代码块的阶段"""
+    if not enabled():
+        return
+    event = {'event': 'span', 'name': name,
+             'ms': round((time.perf_counter() - start) * 1000, 3),
+             'ts': round(time.time(), 3), 'pid': os.getpid()}
+    event.update(fields)
+    _record(event)
+
+
+def count(name, value=1):
+    """累加计数，例如 bytes_read、pixels_rendered"""
+    if enabled():
+        _record({'event': 'count', 'name': name, 'value': value})
+
+
+@contextlib.contextmanager
+def run(name, **fields):
+    """一次完整任务（合并、预览）的范围，结束时写出汇总记录"""
+    if not enabled() or _worker_events is not None:
+        yield
+        return
+    current = {'run': uuid.uuid4().hex[:12], 'counters': {}}
+    previous = getattr(_local, 'run', None)
+    _local.run = current
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _local.run = previous
+        event = {'event': 'run', 'name': name, 'run': current['run'],
+                 'ms': round((time.perf_counter() - start) * 1000, 3),
+                 'ts': round(time.time(), 3), 'pid': os.getpid(),
+                 'counters': current['counters']}
+        event.update(fields)
+        _write(event)
+
+
+def init_worker(collect):
+    """进程池初始化函数：collect 为 True 时在工作进程中暂存事件"""
+    global _worker_events
+    _worker_events = [] if collect else None
+
+
+def drain():
+    """取出工作进程中暂存的事件（在主进程中调用时返回空列表）"""
+    global _worker_events
+    if not _worker_events:
+        return []
+    events, _worker_events = _worker_events, []
+    return events
+
+
+def forward(events):
+    """在主进程中写出工作进程带回的事件"""
+    for event in events:
+        _record(event)
+
+
+@contextlib.contextmanager
+def profiled(path=None):
+    """path 或环境变量 PDF_MERGER_PROFILE 指定输出路径时，用 cProfile 分析代码块"""
+    path = path or os.environ.get(PROFILE_ENV)
+    if not path:
+        yield
+        return
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
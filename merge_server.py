@@ -0,0 +1,473 @@
+"""本地HTTP合并服务
+
+把合并任务集中到一台性能较好的电脑上：客户端上传文件和排版参数，服务把任务放入
+队列，由有限个后台线程依次执行，客户端查询进度并下载结果。上传的文件按内容保存，
+不同电脑上传的同一张发票共用一份文件和页面缓存，不会重复处理。
+
+    python merge_server.py --port 8765 --jobs 2
+
+接口（默认只监听 127.0.0.1）：
+
+    POST   /jobs               multipart/form-data：files（可多个，按顺序排版）以及
+                               rows、cols、orientation（portrait/landscape）、layout（grid/auto）、
+                               quality、rasterize、pages 等可选字段；返回 202 和任务信息
+    GET    /jobs/<id>          任务状态和各阶段进度（JSON）
+    GET    /jobs/<id>/result   下载合并结果（任务完成后；任务失败或已取消时返回 410）
+    DELETE /jobs/<id>          取消任务并删除其文件
+
+    curl -F rows=3 -F cols=2 -F files=@a.pdf -F files=@b.jpg http://127.0.0.1:8765/jobs
+"""
+import argparse
+import email.parser
+import email.policy
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import merge_engine
+import merge_metrics
+import page_cache
+from merge_engine import MergeCancelled, MergeError
+
+logger = logging.getLogger('pdf_merger')
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+# 同时执行的任务数，每个任务内部再使用多个工作进程
+DEFAULT_CONCURRENT_JOBS = 1
+# 排队中的任务超过此数量时拒绝新任务
+DEFAULT_MAX_QUEUED = 32
+# 单次上传的大小上限（字节）
+DEFAULT_MAX_UPLOAD = 512 * 1024 * 1024
+# 已结束的任务及其文件保留的时间（秒）
+DEFAULT_JOB_TTL = 3600
+# 下载结果时每次发送的字节数
+DOWNLOAD_CHUNK = 256 * 1024
+# 行数和列数的上限（与图形界面的输入框一致）
+MAX_GRID = 99
+
+
+class QueueFull(MergeError):
+    """排队的任务已达上限"""
+
+
+class JobFailed(MergeError):
+    """任务已经失败或被取消，不会再有结果"""
+
+    def __init__(self, state, message):
+        super().__init__(message)
+        self.state = state
+
+
+def parse_form(content_type, body):
+    """解析 multipart/form-data 请求体，返回 (字段 {名称: 值}, 文件 [(文件名, 数据)])"""
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body)
+    if not message.is_multipart():
+        raise MergeError('请求必须是 multipart/form-data')
+    fields = {}
+    files = []
+    for part in message.iter_parts():
+        name = part.get_param('name', header='content-disposition')
+        data = part.get_payload(decode=True) or b''
+        filename = part.get_filename()
+        if filename is not None:
+            files.append((os.path.basename(filename.replace('\\', '/')), data))
+        elif name:
+            try:
+                fields[name] = data.decode('utf-8')
+            except UnicodeDecodeError:
+                raise MergeError(f'参数 {name} 不是有效的 UTF-8 文本')
+    return fields, files
+
+
+def _int_field(fields, name, default):
+    try:
+        return int(fields.get(name, default))
+    except ValueError:
+        raise MergeError(f'参数 {name} 必须是整数')
+
+
+class MergeService:
+    """合并任务队列：最多 concurrent_jobs 个任务同时执行，其余按提交顺序排队
+
+    线程安全，HTTP请求处理线程直接调用。上传的文件以内容哈希命名保存在
+    work_dir/files 中，合并结果保存在 work_dir/jobs/<任务编号> 中，
+    任务结束 job_ttl 秒后连同不再被其他任务使用的上传文件一起删除。
+    任务在写入任何文件之前就已登记，清理时不会删除仍有任务在使用或正在写入的文件。
+    """
+
+    def __init__(self, work_dir, concurrent_jobs=DEFAULT_CONCURRENT_JOBS,
+                 max_queued=DEFAULT_MAX_QUEUED, job_ttl=DEFAULT_JOB_TTL, cache=None,
+                 workers=None):
+        self.work_dir = work_dir
+        self.files_dir = os.path.join(work_dir, 'files')
+        self.jobs_dir = os.path.join(work_dir, 'jobs')
+        os.makedirs(self.files_dir, exist_ok=True)
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        self.max_queued = max_queued
+        self.job_ttl = job_ttl
+        self.cache = cache if cache is not None else page_cache.PageCache()
+        self.workers = workers if workers is not None else merge_engine.default_workers()
+        # 任务编号 -> {'job': MergeJob, 'created': 提交时间, 'finished': 结束时间, 'names': 原文件名,
+        #             'dir': 结果目录, 'remove': 结束后是否立即删除}
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, concurrent_jobs))
+
+    def _file_path(self, name, data):
+        # 内容相同的文件只保存一份，修改时间不变，页面缓存可以直接复用
+        ext = os.path.splitext(name)[1].lower()
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        return os.path.join(self.files_dir, digest + ext)
+
+    def _store_file(self, path, data):
+        if not os.path.exists(path):
+            temp_path = path + f'.{uuid.uuid4().hex[:8]}.part'
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+
+    def _new_job_dir(self):
+        # 在锁内调用，目录已存在时换一个编号
+        while True:
+            job_id = uuid.uuid4().hex[:12]
+            job_dir = os.path.join(self.jobs_dir, job_id)
+            try:
+                os.makedirs(job_dir)
+            except FileExistsError:
+                continue
+            return job_id, job_dir
+
+    def submit(self, files, rows=2, cols=2, orientation=merge_engine.PORTRAIT,
+               profile=merge_engine.DEFAULT_PROFILE, rasterize=False, pages=None,
+               layout=merge_engine.LAYOUT_GRID):
+        """提交任务，files 为 [(文件名, 数据)]，返回任务编号"""
+        if not files:
+            raise MergeError('没有上传文件')
+        for name, value in (('rows', rows), ('cols', cols)):
+            if isinstance(value, bool) or not isinstance(value, int) or not 1 <= value <= MAX_GRID:
+                raise MergeError(f'参数 {name} 必须是 1 到 {MAX_GRID} 之间的整数')
+        if orientation not in (merge_engine.PORTRAIT, merge_engine.LANDSCAPE):
+            raise MergeError(f'不支持的页面方向：{orientation}')
+        if layout not in (merge_engine.LAYOUT_GRID, merge_engine.LAYOUT_AUTO):
+            raise MergeError(f'不支持的排版方式：{layout}')
+        merge_engine.get_profile(profile)
+        # 超出各文件页数的范围要打开文件后才知道，在合并时报告
+        if pages and not merge_engine.PAGE_RANGE_PATTERN.match(pages):
+            raise MergeError(f'页码范围格式错误：{pages}')
+        unsupported = [name for name, _ in files if not merge_engine.is_supported(name)]
+        if unsupported:
+            raise MergeError(f'不支持的文件类型：{"、".join(unsupported)}')
+        self.cleanup()
+        paths = [self._file_path(name, data) for name, data in files]
+        page_ranges = {}
+        if pages:
+            page_ranges = {path: pages for path in paths
+                           if path.lower().endswith(merge_engine.PDF_EXTENSIONS)}
+        # 先登记任务再写入上传文件，其他任务清理时会把这些文件当作正在使用
+        with self._lock:
+            queued = sum(1 for entry in self._jobs.values()
+                         if entry['job'].state == merge_engine.MergeJob.PENDING)
+            if queued >= self.max_queued:
+                raise QueueFull('排队的任务太多，请稍后再试')
+            job_id, job_dir = self._new_job_dir()
+            job = merge_engine.MergeJob(
+                paths, rows, cols, os.path.join(job_dir, 'result.pdf'), orientation=orientation,
+                rasterize=rasterize, workers=self.workers, cache=self.cache, stream=True,
+                profile=profile, page_ranges=page_ranges, layout=layout)
+            self._jobs[job_id] = {'job': job, 'created': time.time(), 'finished': None,
+                                  'names': [name for name, _ in files], 'dir': job_dir,
+                                  'remove': False}
+        try:
+            for path, (_, data) in zip(paths, files):
+                self._store_file(path, data)
+        except OSError:
+            self._remove(job_id)
+            raise
+        self._executor.submit(self._run, job_id, job)
+        logger.info('任务 %s：%d 个文件，%dx%d', job_id, len(files), rows, cols)
+        return job_id
+
+    def _run(self, job_id, job):
+        try:
+            job.run()
+        except MergeCancelled:
+            pass
+        except MergeError as e:
+            logger.warning('任务 %s 失败：%s', job_id, e)
+        except Exception:
+            merge_engine.log_error(f'任务 {job_id} 失败', exc_info=True)
+        with self._lock:
+            entry = self._jobs.get(job_id)
+            if entry is not None:
+                entry['finished'] = time.time()
+        if entry is not None and entry['remove']:
+            self._remove(job_id)
+
+    def _entry(self, job_id):
+        with self._lock:
+            entry = self._jobs.get(job_id)
+        if entry is None:
+            raise KeyError(job_id)
+        return entry
+
+    def status(self, job_id):
+        """任务状态，找不到任务时抛出 KeyError"""
+        entry = self._entry(job_id)
+        job = entry['job']
+        info = {
+            'id': job_id,
+            'state': job.state,
+            'files': entry['names'],
+            'progress': {stage: {'done': done, 'total': total,
+                                 'eta_s': None if eta is None else round(eta, 1)}
+                         for stage, (done, total, eta) in job.progress().items()},
+            'warnings': job.warnings,
+            'created': round(entry['created'], 3),
+        }
+        if job.state == merge_engine.MergeJob.PENDING:
+            with self._lock:
+                info['queue_position'] = sum(
+                    1 for other in self._jobs.values()
+                    if other['job'].state == merge_engine.MergeJob.PENDING
+                    and other['created'] < entry['created'])
+        if job.state == merge_engine.MergeJob.DONE:
+            info['pages'] = job.pages
+            info['output_bytes'] = job.stats.get('output_bytes')
+            info['result'] = f'/jobs/{job_id}/result'
+        if job.error:
+            info['error'] = job.error
+        return info
+
+    def result_path(self, job_id):
+        """已完成任务的结果文件路径，任务未完成时返回 None，失败或已取消时抛出 JobFailed"""
+        job = self._entry(job_id)['job']
+        if job.state == merge_engine.MergeJob.FAILED:
+            raise JobFailed(job.state, job.error or '任务失败')
+        if job.state == merge_engine.MergeJob.CANCELLED:
+            raise JobFailed(job.state, '任务已取消')
+        return job.output if job.state == merge_engine.MergeJob.DONE else None
+
+    def cancel(self, job_id):
+        """取消任务并删除其文件；正在执行的任务在停止后删除"""
+        entry = self._entry(job_id)
+        # 先取消，排队中的任务开始执行时会立即停止
+        entry['job'].cancel()
+        with self._lock:
+            entry['remove'] = True
+            running = entry['finished'] is None and entry['job'].state == merge_engine.MergeJob.RUNNING
+        if not running:
+            self._remove(job_id)
+
+    def _remove(self, job_id):
+        with self._lock:
+            entry = self._jobs.pop(job_id, None)
+            if entry is None:
+                return
+            in_use = {path for other in self._jobs.values() for path in other['job'].inputs}
+            # 在锁内删除，同时提交的任务不会在检查之后又开始使用这些文件
+            for path in set(entry['job'].inputs) - in_use:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+        shutil.rmtree(entry['dir'], ignore_errors=True)
+
+    def cleanup(self):
+        """删除结束超过 job_ttl 秒的任务"""
+        cutoff = time.time() - self.job_ttl
+        with self._lock:
+            expired = [job_id for job_id, entry in self._jobs.items()
+                       if entry['finished'] is not None and entry['finished'] < cutoff]
+        for job_id in expired:
+            self._remove(job_id)
+
+    def close(self):
+        """取消所有任务并等待正在执行的任务结束"""
+        with self._lock:
+            jobs = [entry['job'] for entry in self._jobs.values()]
+        for job in jobs:
+            job.cancel()
+        self._executor.shutdown(wait=True)
+
+
+class MergeRequestHandler(BaseHTTPRequestHandler):
+    """把HTTP请求转交给 server.service（MergeService）"""
+    server_version = 'PDFMerger/1.0'
+
+    def log_message(self, format, *args):
+        logger.info('%s %s', self.address_string(), format % args)
+
+    def _send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, message):
+        self._send_json(status, {'error': message})
+
+    def _route(self):
+        """返回 (任务编号, 是否为 /result)，路径不匹配时返回 (None, False)"""
+        parts = [part for part in self.path.split('?')[0].split('/') if part]
+        if len(parts) == 2 and parts[0] == 'jobs':
+            return parts[1], False
+        if len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'result':
+            return parts[1], True
+        return None, False
+
+    def do_POST(self):
+        if self.path.split('?')[0].rstrip('/') != '/jobs':
+            self._send_error(HTTPStatus.NOT_FOUND, '找不到该地址')
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        if length <= 0:
+            self._send_error(HTTPStatus.LENGTH_REQUIRED, '缺少请求内容')
+            return
+        if length > self.server.max_upload:
+            self._send_error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                             f'上传内容超过 {self.server.max_upload // 1048576} MB')
+            return
+        try:
+            fields, files = parse_form(self.headers.get('Content-Type', ''), self.rfile.read(length))
+            job_id = self.server.service.submit(
+                files, _int_field(fields, 'rows', 2), _int_field(fields, 'cols', 2),
+                fields.get('orientation', merge_engine.PORTRAIT),
+                fields.get('quality', merge_engine.DEFAULT_PROFILE),
+                fields.get('rasterize', '').lower() in ('1', 'true', 'yes', 'on'),
+                fields.get('pages') or None,
+                fields.get('layout', merge_engine.LAYOUT_GRID))
+        except QueueFull as e:
+            self._send_error(HTTPStatus.SERVICE_UNAVAILABLE, str(e))
+            return
+        except MergeError as e:
+            self._send_error(HTTPStatus.BAD_REQUEST, str(e))
+            return
+        self._send_json(HTTPStatus.ACCEPTED, self.server.service.status(job_id))
+
+    def do_GET(self):
+        job_id, result = self._route()
+        if job_id is None:
+            self._send_error(HTTPStatus.NOT_FOUND, '找不到该地址')
+            return
+        try:
+            if not result:
+                self._send_json(HTTPStatus.OK, self.server.service.status(job_id))
+                return
+            path = self.server.service.result_path(job_id)
+        except KeyError:
+            self._send_error(HTTPStatus.NOT_FOUND, f'找不到任务：{job_id}')
+            return
+        except JobFailed as e:
+            # 任务不会再有结果，客户端不必继续等待
+            self._send_json(HTTPStatus.GONE, {'error': str(e), 'state': e.state})
+            return
+        if path is None:
+            self._send_error(HTTPStatus.CONFLICT, '任务尚未完成')
+            return
+        self._send_file(path)
+
+    def _send_file(self, path):
+        # 分块发送，结果文件再大也不需要整个读入内存
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            # 查询之后结果已被过期清理删除
+            self._send_error(HTTPStatus.NOT_FOUND, '结果文件已被删除')
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            self.send_response(HTTPStatus.OK)
+            self.send_header('Content-Type', 'application/pdf')
+            self.send_header('Content-Length', str(size))
+            self.send_header('Content-Disposition', 'attachment; filename="merged.pdf"')
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile, DOWNLOAD_CHUNK)
+
+    def do_DELETE(self):
+        job_id, result = self._route()
+        if job_id is None or result:
+            self._send_error(HTTPStatus.NOT_FOUND, '找不到该地址')
+            return
+        try:
+            self.server.service.cancel(job_id)
+        except KeyError:
+            self._send_error(HTTPStatus.NOT_FOUND, f'找不到任务：{job_id}')
+            return
+        self._send_json(HTTPStatus.ACCEPTED, {'id': job_id, 'cancelled': True})
+
+
+def create_server(service, host=DEFAULT_HOST, port=DEFAULT_PORT, max_upload=DEFAULT_MAX_UPLOAD):
+    """创建HTTP服务（port 为 0 时自动选择端口，见 server.server_address）"""
+    server = ThreadingHTTPServer((host, port), MergeRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    server.max_upload = max_upload
+    return server
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description='本地HTTP合并服务')
+    parser.add_argument('--host', default=DEFAULT_HOST,
+                        help=f'监听地址（默认 {DEFAULT_HOST}，只接受本机连接；0.0.0.0 允许局域网访问）')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f'端口（默认{DEFAULT_PORT}）')
+    parser.add_argument('--jobs', type=int, default=DEFAULT_CONCURRENT_JOBS,
+                        help=f'同时执行的任务数（默认{DEFAULT_CONCURRENT_JOBS}）')
+    parser.add_argument('-j', '--workers', type=int, default=merge_engine.default_workers(),
+                        help='每个任务的工作进程数（默认为CPU核心数）')
+    parser.add_argument('--max-queued', type=int, default=DEFAULT_MAX_QUEUED,
+                        help=f'最多排队的任务数（默认{DEFAULT_MAX_QUEUED}）')
+    parser.add_argument('--max-upload-mb', type=int, default=DEFAULT_MAX_UPLOAD // 1048576,
+                        help='单次上传的大小上限（MB）')
+    parser.add_argument('--job-ttl', type=float, default=DEFAULT_JOB_TTL,
+                        help=f'任务结束后结果保留的秒数（默认{DEFAULT_JOB_TTL}）')
+    parser.add_argument('--work-dir', default=None, help='上传文件和合并结果的保存目录（默认临时目录）')
+    parser.add_argument('--cache-dir', default=page_cache.default_cache_dir(), help='磁盘缓存目录')
+    parser.add_argument('--no-cache', action='store_true', help='只使用内存缓存')
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    merge_metrics.configure_from_env()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='pdf_merger_server_')
+    try:
+        cache = page_cache.PageCache(disk_dir=None if args.no_cache else args.cache_dir)
+        service = MergeService(work_dir, args.jobs, args.max_queued, args.job_ttl, cache,
+                               args.workers)
+        server = create_server(service, args.host, args.port, args.max_upload_mb * 1048576)
+    except OSError as e:
+        print(f'无法启动服务：{e}', file=sys.stderr)
+        return 1
+    host, port = server.server_address[:2]
+    logger.info('合并服务已启动：http://%s:%d/jobs（工作目录 %s）', host, port, work_dir)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info('正在停止服务')
+    finally:
+        server.server_close()
+        service.close()
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,154 @@
+"""规范化页面和缩略图缓存
+
+缓存键由文件路径、大小、修改时间以及渲染参数计算得出，文件没有变化时
+重复预览、调整布局和最终合并都可以直接复用已经处理好的结果。内存中按
+LRU策略淘汰，可选地同时保存到磁盘目录，下次打开同一批文件时无需重新处理。
+"""
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+# 缓存数据格式版本，处理逻辑变化导致旧数据不再适用时加1
+CACHE_VERSION = 2
+# 默认内存缓存上限（字节）
+DEFAULT_MEMORY_LIMIT = 256 * 1024 * 1024
+# 默认磁盘缓存上限（字节）
+DEFAULT_DISK_LIMIT = 2 * 1024 * 1024 * 1024
+
+
+def default_cache_dir():
+    """返回当前用户的默认磁盘缓存目录"""
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'pdf_merger', 'cache')
+
+
+def file_fingerprint(file_path):
+    """根据路径、大小和修改时间生成文件指纹，无需读取文件内容"""
+    stat = os.stat(file_path)
+    return f'{os.path.normcase(os.path.abspath(file_path))}|{stat.st_size}|{stat.st_mtime_ns}'
+
+
+def make_key(file_path, kind, *params):
+    """生成缓存键：文件指纹 + 数据类型 + 渲染参数"""
+    raw = '|'.join([str(CACHE_VERSION), file_fingerprint(file_path), kind] + [repr(p) for p in params])
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+class PageCache:
+    """线程安全的两级（内存LRU + 可选磁盘）字节缓存"""
+
+    def __init__(self, memory_limit=DEFAULT_MEMORY_LIMIT, disk_dir=None, disk_limit=DEFAULT_DISK_LIMIT,
+                 prune=True):
+        self.memory_limit = memory_limit
+        self.disk_dir = disk_dir
+        self.disk_limit = disk_limit
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._memory_used = 0
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            # 缓存目录很大时清理较慢，调用方可以改为稍后自行调用 prune_disk()
+            if prune:
+                self.prune_disk()
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + '.bin')
+
+    def _remember(self, key, data):
+        if len(data) > self.memory_limit:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._memory_used -= len(old)
+        self._entries[key] = data
+        self._memory_used += len(data)
+        while self._memory_used > self.memory_limit:
+            _, evicted = self._entries.popitem(last=False)
+            self._memory_used -= len(evicted)
+
+    def get(self, key):
+        """返回缓存的数据，不存在时返回 None"""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+        if self.disk_dir:
+            try:
+                with open(self._disk_path(key), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                data = None
+            if data is not None:
+                with self._lock:
+                    self._remember(key, data)
+                    self.hits += 1
+                return data
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, data):
+        with self._lock:
+            self._remember(key, data)
+        if self.disk_dir:
+            path = self._disk_path(key)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # 先写入临时文件再替换，避免程序中断时留下不完整的缓存
+                fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._memory_used = 0
+
+    def prune_disk(self):
+        """磁盘缓存超过上限时按最久未修改的顺序删除文件"""
+        if not self.disk_dir:
+            return
+        entries = []
+        total = 0
+        stale_before = time.time() - 3600
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if name.endswith('.tmp'):
+                    # 一小时前的临时文件是中断的写入遗留下来的
+                    if stat.st_mtime > stale_before:
+                        continue
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.disk_limit:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError:
+                pass
@@ -1,20 +1,28 @@
 import sys
 import logging
+import time
+
+# 启动计时起点，用于统计从启动到窗口显示的耗时
+STARTUP_TIME = time.perf_counter()
+
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
                              QPushButton, QListWidget, QLabel, QFileDialog, QSpinBox,
-                             QComboBox, QMessageBox, QScrollArea, QProgressBar)
-from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QPixmap, QPainter
-from PyPDF2 import PdfReader, PdfWriter
-from PIL import Image
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A4, landscape
+                             QComboBox, QMessageBox, QScrollArea, QProgressBar, QCheckBox,
+                             QLineEdit)
+from PyQt5.QtCore import Qt, QRectF, QThread, QTimer, pyqtSignal
+from PyQt5.QtGui import QImage, QPixmap, QPainter
 
+import multiprocessing
 import os
-import tempfile
-import fitz
-import io
-import traceback
+import threading
+from collections import OrderedDict
+
+import duplicate_index
+import invoice_index
+import merge_engine
+import merge_metrics
+import page_cache
+from merge_engine import MergeCancelled, MergeError
 
 # 配置日志记录
 log_file = 'pdf_merger_error.log'
@@ -25,20 +33,340 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 
+# 调整布局参数后等待多久再生成预览（毫秒）
+PREVIEW_DEBOUNCE_MS = 250
+# 最多保留多少个页面的预览图块（至少保留当前预览页面上的全部单元格）
+PREVIEW_TILE_LIMIT = 300
+# 跳过重复文件的提示中最多列出的文件数
+DUPLICATE_LIST_LIMIT = 20
+# 文件排序方式：(显示名称, invoice_index 的排序字段)
+SORT_OPTIONS = [('开票日期', 'date'), ('金额', 'amount'), ('发票号码', 'number'), ('销售方', 'seller')]
+# 设置此环境变量时窗口显示后立即退出，供 benchmarks/bench_startup.py 测量启动耗时
+STARTUP_CHECK_ENV = 'PDF_MERGER_STARTUP_CHECK'
+
+
+class PreviewWorker(QThread):
+    """在后台线程中按单元格大小渲染预览图块，避免调整参数时界面卡顿"""
+    progress = pyqtSignal(int, int, str)          # 请求编号, 进度值, 进度条文字
+    warning = pyqtSignal(int, str)                # 请求编号, 警告信息
+    tile_ready = pyqtSignal(int, object, QImage)  # 请求编号, 页面（PageRef）, 预览图块
+    completed = pyqtSignal(int)                   # 请求编号
+    failed = pyqtSignal(int, str)                 # 请求编号, 错误信息
+
+    def __init__(self, request_id, pages, box, cache=None, index=None, parent=None):
+        super().__init__(parent)
+        self.request_id = request_id
+        self.pages = list(pages)
+        self.box = box
+        self.cache = cache
+        self.index = index
+        self._cancelled = False
+        # 按时间间隔而不是每个图块更新进度条
+        self.reporter = merge_engine.ProgressReporter(self.report_progress)
+
+    def cancel(self):
+        self._cancelled = True
+
+    def is_cancelled(self):
+        return self._cancelled
+
+    def report_progress(self, stage, done, total):
+        self.progress.emit(self.request_id, int((done / total) * 100),
+                           f'正在生成预览: %p% - {done}/{total} 页')
+
+    def report_warning(self, error_msg):
+        self.warning.emit(self.request_id, error_msg)
+
+    def report_tile(self, index, data):
+        # 在后台线程中解码，界面线程只负责绘制
+        self.tile_ready.emit(self.request_id, self.pages[index], QImage.fromData(data))
+
+    def run(self):
+        try:
+            merge_engine.render_preview_tiles(
+                self.pages, self.box, self.report_tile, progress=self.reporter,
+                on_error=self.report_warning, is_cancelled=self.is_cancelled, cache=self.cache,
+                index=self.index)
+        except MergeCancelled:
+            return
+        except Exception as e:
+            error_msg = f'预览生成失败：{str(e)}'
+            merge_engine.log_error(error_msg, exc_info=True)
+            self.failed.emit(self.request_id, error_msg)
+            return
+        self.completed.emit(self.request_id)
+
+
+class MergeWorker(QThread):
+    """在后台线程中执行合并任务，合并期间界面保持响应，可随时取消"""
+    progress = pyqtSignal(int, str)     # 进度值, 进度条文字
+    warning = pyqtSignal(str)           # 单个文件出错时的警告信息
+    completed = pyqtSignal(int)         # 输出页数
+    failed = pyqtSignal(str, bool)      # 错误信息, 是否为意外错误
+    cancelled = pyqtSignal()
+
+    def __init__(self, inputs, rows, cols, output, parent=None, invoices=None, sidecar=None,
+                 **options):
+        super().__init__(parent)
+        # 提供发票索引时记录每张发票在结果中的位置，并按需要写出CSV清单 sidecar
+        self.invoices = invoices
+        self.sidecar = sidecar
+        self.placements = None
+        if invoices is not None:
+            self.placements = options['placements'] = []
+        self.job = merge_engine.MergeJob(inputs, rows, cols, output, progress=self.report_progress,
+                                         on_error=self.warning.emit, **options)
+        # 流式合并时文件处理和排版交替进行，进度按两者完成量之和计算
+        self.stage_done = {merge_engine.STAGE_PREPARE: 0, merge_engine.STAGE_COMPOSE: 0}
+
+    def cancel(self):
+        self.job.cancel()
+
+    def report_progress(self, stage, done, total):
+        self.stage_done[stage] = done
+        value = int(sum(self.stage_done.values()) / (2 * total) * 100)
+        label = '正在处理文件' if stage == merge_engine.STAGE_PREPARE else '正在合并'
+        eta = merge_engine.format_eta(self.job.reporter.eta(stage)) if done < total else ''
+        self.progress.emit(value, f'{label}: %p% - {done}/{total} 页 {eta}'.rstrip())
+
+    def run(self):
+        try:
+            with merge_metrics.profiled():
+                pages = self.job.run()
+        except MergeCancelled:
+            self.cancelled.emit()
+            return
+        except MergeError as e:
+            self.failed.emit(str(e), False)
+            return
+        except Exception as e:
+            error_msg = f'文件合并失败：{str(e)}'
+            merge_engine.log_error(error_msg, exc_info=True)
+            self.failed.emit(error_msg, True)
+            return
+        if self.invoices is not None:
+            try:
+                self.write_index()
+            except (MergeError, OSError) as e:
+                self.warning.emit(f'生成发票清单失败：{str(e)}')
+        self.completed.emit(pages)
+
+    def write_index(self):
+        outputs = self.job.stats['outputs']
+        if self.sidecar:
+            cols = None if self.job.options.get('layout') == merge_engine.LAYOUT_AUTO else self.job.cols
+            invoice_index.write_sidecar(self.sidecar, self.placements, outputs, self.invoices, cols,
+                                        self.warning.emit, merge_engine.default_workers())
+        self.invoices.record_locations(self.placements, outputs)
+        self.invoices.save()
+
+
+class SortWorker(QThread):
+    """在后台线程中提取发票信息，并按其排序文件列表（每个文件按其第一页排序）"""
+    sorted = pyqtSignal(list)     # 排序后的文件列表
+    failed = pyqtSignal(str)
+
+    def __init__(self, files, page_ranges, sort_by, invoices, page_index, parent=None):
+        super().__init__(parent)
+        self.files = list(files)
+        self.page_ranges = dict(page_ranges)
+        self.sort_by = sort_by
+        self.invoices = invoices
+        self.page_index = page_index
+
+    def run(self):
+        try:
+            refs = []
+            for file in self.files:
+                try:
+                    page = self.page_index.pages(file, self.page_ranges.get(file))[0]
+                except (MergeError, OSError):
+                    # 无法读取的文件保持原来的相对顺序，排在最后
+                    page = 0
+                refs.append(merge_engine.PageRef(file, page))
+            self.invoices.update(refs, workers=merge_engine.default_workers())
+            self.invoices.save()
+            order = invoice_index.arrange(refs, self.invoices, self.sort_by)
+        except (MergeError, OSError) as e:
+            self.failed.emit(f'排序失败：{str(e)}')
+            return
+        except Exception as e:
+            merge_engine.log_error('排序文件时出错', exc_info=True)
+            self.failed.emit(f'排序失败：{str(e)}')
+            return
+        self.sorted.emit([ref.path for ref in order])
+
+
+class DuplicateWorker(QThread):
+    """在后台线程中按感知哈希查找与已添加文件相似的新文件（如同一张发票的PDF和照片）"""
+    similar_found = pyqtSignal(str, str, int)     # 新文件, 相似的已添加文件, 汉明距离
+
+    def __init__(self, files, duplicates, parent=None):
+        super().__init__(parent)
+        self.files = list(files)
+        self.duplicates = duplicates
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def run(self):
+        for file in self.files:
+            if self._cancelled:
+                return
+            try:
+                found = self.duplicates.find_similar(file)
+                if found is None:
+                    self.duplicates.add_similar(file)
+                else:
+                    self.similar_found.emit(file, found[0], found[1])
+            except Exception:
+                # 无法渲染的文件在预览和合并时会提示
+                merge_engine.log_error(f'检查相似文件时出错（{os.path.basename(file)}）', exc_info=True)
+
+
+class PageCountWorker(QThread):
+    """在后台线程中统计所有文件的总页数，预览只需要当前页面上的文件时界面不必等待"""
+    counted = pyqtSignal(object, int)     # 文件和页码范围, 总页数
+
+    def __init__(self, key, page_index, parent=None):
+        super().__init__(parent)
+        self.key = key
+        self.page_index = page_index
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def run(self):
+        total = 0
+        for file, page_range in self.key:
+            if self._cancelled:
+                return
+            try:
+                total += len(self.page_index.pages(file, page_range))
+            except Exception:
+                # 无法读取的文件在合并时会提示，预览中直接跳过
+                continue
+        self.counted.emit(self.key, total)
+
+
+class AutoPlanWorker(QThread):
+    """在后台线程中读取所有页面的尺寸并自动排版，页面很多时界面不必等待"""
+    planned = pyqtSignal(object, list, dict)    # 排版参数, [(页面列表, auto_layout.Sheet)], 新读取的页面尺寸
+
+    def __init__(self, key, page_index, page_sizes, parent=None):
+        super().__init__(parent)
+        self.key = key
+        self.page_index = page_index
+        self.page_sizes = dict(page_sizes)
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def run(self):
+        files, orientation = self.key
+        readable = []
+        sizes = []
+        new_sizes = {}
+        try:
+            for file, page_range in files:
+                try:
+                    pages = self.page_index.pages(file, page_range)
+                except Exception:
+                    # 无法读取的文件在合并时会提示，预览中直接跳过
+                    continue
+                for page in pages:
+                    if self._cancelled:
+                        return
+                    ref = merge_engine.PageRef(file, page)
+                    size = self.page_sizes.get(ref)
+                    if size is None:
+                        try:
+                            size = new_sizes[ref] = self.page_index.page_size(file, page)
+                        except Exception:
+                            continue
+                    readable.append(ref)
+                    sizes.append(size)
+            _, sheets = merge_engine.plan_auto_layout(sizes, orientation)
+        except Exception:
+            merge_engine.log_error('自动排版预览失败', exc_info=True)
+            return
+        plan = []
+        start = 0
+        for sheet in sheets:
+            plan.append((readable[start:start + len(sheet.boxes)], sheet))
+            start += len(sheet.boxes)
+        self.planned.emit(self.key, plan, new_sizes)
+
+
 class PDFMerger(QMainWindow):
     def __init__(self):
         super().__init__()
         self.files = []
+        # 多页PDF的页码范围 {文件: 范围}，未设置的文件使用全部页面
+        self.page_ranges = {}
+        # 按需读取页数，同一文件的页面共享打开的文档
+        self.page_index = merge_engine.PageIndex()
         self.preview_label = None
         self.progress_bar = None
+        # 预览请求编号，只有最新请求的结果会显示
+        self.preview_request_id = 0
+        self.preview_worker = None
+        self.preview_workers = set()
+        self.merge_worker = None
+        # 增量预览：按源页面保存的图块，以及当前预览页面和各单元格已绘制的图块
+        self.preview_tiles = OrderedDict()
+        self.preview_sheet = 0
+        self.preview_canvas = None
+        self.preview_layout = None
+        self.preview_cells = []
+        # 自动排版：已读取的页面尺寸，以及最近一次的排版结果 (参数, [(页面列表, auto_layout.Sheet)])
+        self.page_sizes = {}
+        self.auto_plan = None
+        self.plan_workers = set()
+        self.preview_timer = QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(PREVIEW_DEBOUNCE_MS)
+        self.preview_timer.timeout.connect(self.start_preview)
+        self.cache = self.create_cache()
+        # 重复文件检测：内容相同的文件在添加时跳过，相似的文件在列表中标出
+        self.duplicates = duplicate_index.DuplicateIndex(cache=self.cache, index=self.page_index)
+        self.similar_files = {}
+        self.duplicate_workers = set()
+        # 总页数在后台统计：(文件和页码范围, 总页数)
+        self.page_total = None
+        self.count_workers = set()
+        # 发票信息索引在第一次排序或生成清单时才加载
+        self.invoices = None
+        self.sort_worker = None
         self.initUI()
 
+    def create_cache(self):
+        """创建页面缓存，磁盘缓存目录不可用时只使用内存缓存"""
+        try:
+            # 清理磁盘缓存放到窗口显示后的 warm_up() 中进行
+            return page_cache.PageCache(disk_dir=page_cache.default_cache_dir(), prune=False)
+        except OSError:
+            self.log_error('无法创建磁盘缓存目录，仅使用内存缓存', exc_info=True)
+            return page_cache.PageCache()
+
+    def warm_up(self):
+        """窗口显示后在后台线程中加载PDF和图像处理库并清理磁盘缓存"""
+        threading.Thread(target=self._warm_up, name='warm-up', daemon=True).start()
+
+    def _warm_up(self):
+        try:
+            merge_engine.warm_up()
+            self.cache.prune_disk()
+        except Exception:
+            # 失败时这些库会在第一次预览或合并时再加载，届时的错误会正常提示
+            self.log_error('后台预加载失败', exc_info=True)
+
     def log_error(self, error_msg, exc_info=None):
         """记录错误信息到日志文件"""
-        if exc_info:
-            logging.error(f"{error_msg}\n{traceback.format_exc()}")
-        else:
-            logging.error(error_msg)
+        merge_engine.log_error(error_msg, exc_info=bool(exc_info))
 
     def initUI(self):
         self.setWindowTitle('哲宇一号发票合并助手')
@@ -57,6 +385,14 @@ class PDFMerger(QMainWindow):
         left_layout.addWidget(QLabel('已选择的文件：'))
         left_layout.addWidget(self.file_list)
 
+        # 页码范围（应用到选中的PDF文件）
+        range_layout = QHBoxLayout()
+        range_layout.addWidget(QLabel('页码范围：'))
+        self.page_range = QLineEdit()
+        self.page_range.setPlaceholderText('全部页面，如 1-3,5')
+        range_layout.addWidget(self.page_range)
+        left_layout.addLayout(range_layout)
+
         # 按钮布局
         button_layout = QHBoxLayout()
         add_button = QPushButton('添加文件')
@@ -91,9 +427,46 @@ class PDFMerger(QMainWindow):
         layout_options.addWidget(self.cols)
         middle_layout.addLayout(layout_options)
 
+        # 自动排版：按页面实际尺寸排列，忽略行数和列数
+        self.auto_layout = QCheckBox('自动排版（按页面尺寸，页数最少）')
+        self.auto_layout.setChecked(False)
+        middle_layout.addWidget(self.auto_layout)
+
+        # 按发票信息排序文件列表（从PDF文字层中提取）
+        middle_layout.addWidget(QLabel('文件排序：'))
+        sort_options = QHBoxLayout()
+        self.sort_key = QComboBox()
+        for label, key in SORT_OPTIONS:
+            self.sort_key.addItem(label, key)
+        self.sort_button = QPushButton('排序')
+        sort_options.addWidget(self.sort_key)
+        sort_options.addWidget(self.sort_button)
+        middle_layout.addLayout(sort_options)
+
+        # 栅格化兼容模式（默认使用矢量排版）
+        self.rasterize = QCheckBox('栅格化输出（兼容模式）')
+        self.rasterize.setChecked(False)
+        middle_layout.addWidget(self.rasterize)
+
+        # 输出质量（影响图片和栅格化内容的分辨率与压缩方式）
+        middle_layout.addWidget(QLabel('输出质量：'))
+        self.quality = QComboBox()
+        for profile in merge_engine.QUALITY_PROFILES.values():
+            self.quality.addItem(f'{profile.label}（{profile.dpi} DPI）', profile.name)
+        self.quality.setCurrentIndex(self.quality.findData(merge_engine.DEFAULT_PROFILE))
+        middle_layout.addWidget(self.quality)
+
+        # 发票位置清单：每张发票的号码、日期、金额、销售方及其所在的输出页和单元格
+        self.write_sidecar = QCheckBox('同时生成发票位置清单（CSV）')
+        self.write_sidecar.setChecked(False)
+        middle_layout.addWidget(self.write_sidecar)
+
         # 合并按钮
-        merge_button = QPushButton('合并文件')
-        middle_layout.addWidget(merge_button)
+        self.merge_button = QPushButton('合并文件')
+        middle_layout.addWidget(self.merge_button)
+        self.cancel_button = QPushButton('取消合并')
+        self.cancel_button.setEnabled(False)
+        middle_layout.addWidget(self.cancel_button)
 
         # 右侧布局（预览区域）
         right_layout = QVBoxLayout()
@@ -115,6 +488,18 @@ class PDFMerger(QMainWindow):
         preview_layout.addWidget(self.preview_label)
         preview_scroll.setWidget(preview_container)
         right_layout.addWidget(preview_scroll)
+
+        # 预览翻页
+        page_layout = QHBoxLayout()
+        self.prev_page_button = QPushButton('上一页')
+        self.next_page_button = QPushButton('下一页')
+        self.page_label = QLabel()
+        self.page_label.setAlignment(Qt.AlignCenter)
+        page_layout.addWidget(self.prev_page_button)
+        page_layout.addWidget(self.page_label)
+        page_layout.addWidget(self.next_page_button)
+        right_layout.addLayout(page_layout)
+        self.update_page_controls()
         
         # 添加所有布局到主布局
         layout.addLayout(left_layout, 2)
@@ -125,10 +510,17 @@ class PDFMerger(QMainWindow):
         add_button.clicked.connect(self.add_files)
         remove_button.clicked.connect(self.remove_files)
         remove_all_button.clicked.connect(self.remove_all_files)
-        merge_button.clicked.connect(self.merge_files)
+        self.file_list.itemSelectionChanged.connect(self.show_page_range)
+        self.page_range.editingFinished.connect(self.apply_page_range)
+        self.merge_button.clicked.connect(self.merge_files)
+        self.cancel_button.clicked.connect(self.cancel_merge)
+        self.sort_button.clicked.connect(self.sort_files)
+        self.prev_page_button.clicked.connect(lambda: self.show_preview_sheet(self.preview_sheet - 1))
+        self.next_page_button.clicked.connect(lambda: self.show_preview_sheet(self.preview_sheet + 1))
         self.orientation.currentIndexChanged.connect(self.update_preview)
         self.rows.valueChanged.connect(self.update_preview)
         self.cols.valueChanged.connect(self.update_preview)
+        self.auto_layout.toggled.connect(self.on_layout_mode_changed)
 
     def add_files(self):
         files, _ = QFileDialog.getOpenFileNames(
@@ -137,10 +529,31 @@ class PDFMerger(QMainWindow):
             "",
             "支持的文件 (*.pdf *.jpg *.jpeg *.png *.tif *.bmp)"
         )
+        added = []
+        skipped = []
         for file in files:
-            if file not in self.files:
-                self.files.append(file)
-                self.file_list.addItem(os.path.basename(file))
+            if file in self.files:
+                continue
+            try:
+                original = self.duplicates.find_exact(file)
+                if original is None:
+                    self.duplicates.add(file)
+            except OSError:
+                original = None
+            if original is not None:
+                skipped.append(f'{os.path.basename(file)}（与 {os.path.basename(original)} 相同）')
+                continue
+            self.files.append(file)
+            self.file_list.addItem(self.file_item_text(file))
+            added.append(file)
+        if skipped:
+            lines = skipped[:DUPLICATE_LIST_LIMIT]
+            if len(skipped) > len(lines):
+                lines.append(f'……等共 {len(skipped)} 个文件')
+            QMessageBox.information(self, '提示', '以下文件与已添加的文件内容完全相同，已跳过：\n'
+                                    + '\n'.join(lines))
+        if added:
+            self.check_similar(added)
         if files:
             self.update_preview()
         self.update_progress_bar()
@@ -149,16 +562,131 @@ class PDFMerger(QMainWindow):
         for item in self.file_list.selectedItems():
             idx = self.file_list.row(item)
             self.file_list.takeItem(idx)
-            self.files.pop(idx)
+            removed = self.files.pop(idx)
+            self.page_ranges.pop(removed, None)
+            self.similar_files.pop(removed, None)
+            self.duplicates.remove(removed)
+            for ref in [ref for ref in self.preview_tiles if ref.path == removed]:
+                del self.preview_tiles[ref]
+            for ref in [ref for ref in self.page_sizes if ref.path == removed]:
+                del self.page_sizes[ref]
         self.update_preview()
         self.update_progress_bar()
 
     def remove_all_files(self):
         self.files.clear()
         self.file_list.clear()
+        self.page_ranges.clear()
+        self.similar_files.clear()
+        for worker in self.duplicate_workers:
+            worker.cancel()
+        self.duplicates = duplicate_index.DuplicateIndex(cache=self.cache, index=self.page_index)
+        self.preview_tiles.clear()
+        self.page_sizes.clear()
         self.update_preview()
         self.update_progress_bar()
 
+    def file_item_text(self, file):
+        page_range = self.page_ranges.get(file)
+        name = os.path.basename(file)
+        if page_range:
+            name += f'（第 {page_range} 页）'
+        if file in self.similar_files:
+            name += '（疑似重复）'
+        return name
+
+    def check_similar(self, files):
+        worker = DuplicateWorker(files, self.duplicates, self)
+        worker.similar_found.connect(self.on_similar_found)
+        worker.finished.connect(lambda: self.duplicate_workers.discard(worker))
+        worker.finished.connect(worker.deleteLater)
+        self.duplicate_workers.add(worker)
+        worker.start()
+
+    def on_similar_found(self, file, original, distance):
+        if file not in self.files or original not in self.files:
+            return
+        self.similar_files[file] = original
+        item = self.file_list.item(self.files.index(file))
+        item.setText(self.file_item_text(file))
+        item.setForeground(Qt.red)
+        item.setToolTip(f'与 {os.path.basename(original)} 很相似，可能是同一张发票（差异 {distance}）')
+
+    def invoice_index(self):
+        """加载发票信息索引，索引文件损坏时提示并返回 None"""
+        if self.invoices is None:
+            try:
+                self.invoices = invoice_index.InvoiceIndex()
+            except MergeError as e:
+                QMessageBox.warning(self, '警告', str(e))
+        return self.invoices
+
+    def sort_files(self):
+        if not self.files or self.sort_worker is not None:
+            return
+        invoices = self.invoice_index()
+        if invoices is None:
+            return
+        worker = SortWorker(self.files, self.page_ranges, self.sort_key.currentData(), invoices,
+                            self.page_index, self)
+        worker.sorted.connect(self.on_files_sorted)
+        worker.failed.connect(self.show_warning)
+        worker.finished.connect(self.on_sort_finished)
+        worker.finished.connect(worker.deleteLater)
+        self.sort_worker = worker
+        self.sort_button.setEnabled(False)
+        if self.merge_worker is None:
+            self.progress_bar.setFormat('正在读取发票信息...')
+        worker.start()
+
+    def on_files_sorted(self, order):
+        # 排序期间文件列表有变化时放弃这次结果
+        if sorted(order) != sorted(self.files):
+            return
+        # 取出列表项再按新顺序放回，保留“疑似重复”等标记
+        items = {file: self.file_list.takeItem(0) for file in list(self.files)}
+        self.files = list(order)
+        for file in self.files:
+            self.file_list.addItem(items[file])
+        self.update_preview()
+
+    def on_sort_finished(self):
+        self.sort_worker = None
+        self.sort_button.setEnabled(True)
+        if self.merge_worker is None:
+            self.update_progress_bar()
+
+    def selected_files(self):
+        return [self.files[self.file_list.row(item)] for item in self.file_list.selectedItems()]
+
+    def show_page_range(self):
+        selected = self.selected_files()
+        self.page_range.setText(self.page_ranges.get(selected[0], '') if selected else '')
+
+    def apply_page_range(self):
+        """把输入的页码范围应用到选中的PDF文件"""
+        page_range = self.page_range.text().strip()
+        changed = False
+        for file in self.selected_files():
+            if not file.lower().endswith(merge_engine.PDF_EXTENSIONS):
+                continue
+            if page_range:
+                try:
+                    self.page_index.pages(file, page_range)
+                except (MergeError, OSError) as e:
+                    QMessageBox.warning(self, '警告', str(e))
+                    return
+            if self.page_ranges.get(file, '') == page_range:
+                continue
+            if page_range:
+                self.page_ranges[file] = page_range
+            else:
+                self.page_ranges.pop(file, None)
+            self.file_list.item(self.files.index(file)).setText(self.file_item_text(file))
+            changed = True
+        if changed:
+            self.update_preview()
+
     def update_progress_bar(self):
         total_files = len(self.files)
         if total_files == 0:
@@ -168,221 +696,363 @@ class PDFMerger(QMainWindow):
             self.progress_bar.setValue(100)
             self.progress_bar.setFormat(f"已选择 {total_files} 个文件")
 
-    def convert_image_to_pdf(self, image_path):
-        try:
-            # 创建临时PDF文件
-            temp_pdf = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-            temp_pdf.close()
-            
-            # 打开并转换图片
-            with Image.open(image_path) as img:
-                # 转换为RGB模式
-                if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
-                    background = Image.new('RGB', img.size, (255, 255, 255))
-                    if img.mode == 'P':
-                        img = img.convert('RGBA')
-                    background.paste(img, mask=img.split()[3] if img.mode == 'RGBA' else None)
-                    img = background
-                elif img.mode != 'RGB':
-                    img = img.convert('RGB')
-                
-                # 保存为PDF
-                img.save(temp_pdf.name, 'PDF', resolution=300.0)
-            
-            return temp_pdf.name
-        except Exception as e:
-            error_msg = f'图片转换失败（{os.path.basename(image_path)}）：{str(e)}'
-            self.log_error(error_msg, exc_info=True)
-            raise Exception(error_msg)
+    def current_orientation(self):
+        if self.orientation.currentText() == '横向':
+            return merge_engine.LANDSCAPE
+        return merge_engine.PORTRAIT
 
-    def process_pdf_page(self, file_path):
-        try:
-            # 创建临时PDF文件
-            temp_pdf = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-            temp_pdf.close()
-            
-            # 读取原PDF文件
-            reader = PdfReader(file_path)
-            if len(reader.pages) > 0:
-                # 创建新的PDF并添加第一页
-                writer = PdfWriter()
-                writer.add_page(reader.pages[0])
-                with open(temp_pdf.name, 'wb') as f:
-                    writer.write(f)
-                return temp_pdf.name
-            else:
-                raise Exception('PDF文件为空')
-        except Exception as e:
-            error_msg = f'PDF处理失败（{os.path.basename(file_path)}）：{str(e)}'
-            self.log_error(error_msg, exc_info=True)
-            raise Exception(error_msg)
+    def on_layout_mode_changed(self, auto):
+        self.rows.setEnabled(not auto)
+        self.cols.setEnabled(not auto)
+        self.update_preview()
+
+    def show_warning(self, error_msg):
+        QMessageBox.warning(self, '警告', error_msg)
+
+    def page_refs(self, limit=None):
+        """按文件顺序展开的页面列表；指定 limit 时读够 limit 页就停止，后面的文件不必打开"""
+        refs = []
+        for file in self.files:
+            if limit is not None and len(refs) >= limit:
+                break
+            try:
+                pages = self.page_index.pages(file, self.page_ranges.get(file))
+            except (MergeError, OSError):
+                # 无法读取的文件在合并时会提示，预览中直接跳过
+                continue
+            refs.extend(merge_engine.PageRef(file, page) for page in pages)
+        return refs
+
+    def auto_plan_key(self):
+        return self.page_count_key(), self.current_orientation()
+
+    def auto_sheets(self):
+        """自动排版的结果 [(页面列表, auto_layout.Sheet)]，还在后台排版时返回 None
+
+        文件、页码范围和方向不变时直接复用；页面尺寸只读取一次。
+        """
+        if self.auto_plan is None or self.auto_plan[0] != self.auto_plan_key():
+            return None
+        return self.auto_plan[1]
+
+    def request_auto_plan(self):
+        """文件、页码范围或方向变化后在后台重新自动排版"""
+        key = self.auto_plan_key()
+        if self.auto_plan is not None and self.auto_plan[0] == key:
+            return
+        if any(worker.key == key for worker in self.plan_workers):
+            return
+        for worker in self.plan_workers:
+            worker.cancel()
+        worker = AutoPlanWorker(key, self.page_index, self.page_sizes, self)
+        worker.planned.connect(self.on_auto_plan)
+        worker.finished.connect(lambda: self.plan_workers.discard(worker))
+        worker.finished.connect(worker.deleteLater)
+        self.plan_workers.add(worker)
+        worker.start()
+
+    def on_auto_plan(self, key, plan, sizes):
+        self.page_sizes.update((ref, size) for ref, size in sizes.items() if ref.path in self.files)
+        if key != self.auto_plan_key():
+            return
+        self.auto_plan = (key, plan)
+        if self.auto_layout.isChecked():
+            self.update_preview()
+
+    def current_auto_sheet(self):
+        """当前预览页面的 (页面列表, auto_layout.Sheet)，没有文件或还在排版时返回 None"""
+        plan = self.auto_sheets()
+        if plan is None or self.preview_sheet >= len(plan):
+            return None
+        return plan[self.preview_sheet]
+
+    def page_count_key(self):
+        return tuple((file, self.page_ranges.get(file)) for file in self.files)
+
+    def request_page_total(self):
+        """文件或页码范围变化后在后台重新统计总页数"""
+        key = self.page_count_key()
+        if self.page_total is not None and self.page_total[0] == key:
+            return
+        if any(worker.key == key for worker in self.count_workers):
+            return
+        for worker in self.count_workers:
+            worker.cancel()
+        worker = PageCountWorker(key, self.page_index, self)
+        worker.counted.connect(self.on_page_total)
+        worker.finished.connect(lambda: self.count_workers.discard(worker))
+        worker.finished.connect(worker.deleteLater)
+        self.count_workers.add(worker)
+        worker.start()
+
+    def on_page_total(self, key, total):
+        if key != self.page_count_key():
+            return
+        self.page_total = (key, total)
+        count = self.sheet_count()
+        if count is not None and self.preview_sheet >= count:
+            self.update_preview()
+        else:
+            self.update_page_controls()
+
+    def sheet_count(self):
+        """输出页数；总页数还在后台统计或还在自动排版时返回 None"""
+        if self.auto_layout.isChecked():
+            plan = self.auto_sheets()
+            return len(plan) if plan is not None else None
+        key = self.page_count_key()
+        if self.page_total is None or self.page_total[0] != key:
+            return None
+        return merge_engine.sheet_count(self.page_total[1], self.rows.value(), self.cols.value())
+
+    def visible_pages(self):
+        """当前预览页面上的页面"""
+        if self.auto_layout.isChecked():
+            current = self.current_auto_sheet()
+            return current[0] if current is not None else []
+        per_sheet = self.rows.value() * self.cols.value()
+        return merge_engine.sheet_inputs(self.page_refs((self.preview_sheet + 1) * per_sheet),
+                                         self.preview_sheet, self.rows.value(), self.cols.value())
+
+    def update_page_controls(self):
+        count = self.sheet_count()
+        self.prev_page_button.setEnabled(self.preview_sheet > 0)
+        if count is None and self.auto_layout.isChecked():
+            self.page_label.setText('正在自动排版...' if self.files else '')
+            self.next_page_button.setEnabled(False)
+            return
+        if count is None:
+            # 总页数统计完成前，只要当前页面之后还有页面就允许翻页
+            per_sheet = self.rows.value() * self.cols.value()
+            shown = (self.preview_sheet + 1) * per_sheet
+            self.page_label.setText(f'第 {self.preview_sheet + 1} / ... 页')
+            self.next_page_button.setEnabled(len(self.page_refs(shown + 1)) > shown)
+            return
+        self.page_label.setText(f'第 {self.preview_sheet + 1} / {count} 页' if count else '')
+        self.next_page_button.setEnabled(self.preview_sheet + 1 < count)
+
+    def show_preview_sheet(self, sheet):
+        self.preview_sheet = sheet
+        self.update_preview()
 
     def update_preview(self):
+        """文件、布局或页码变化后立即用已有的图块重绘预览，缺少的图块延迟生成
+
+        连续的变化只触发一次后台渲染，只有当前页面上还没有足够大图块的文件会被处理。
+        """
+        self.cancel_preview()
+        if self.auto_layout.isChecked():
+            self.request_auto_plan()
+        else:
+            self.request_page_total()
+        count = self.sheet_count()
+        if count is not None:
+            self.preview_sheet = max(0, min(self.preview_sheet, count - 1))
+        self.update_page_controls()
         if not self.files:
+            self.preview_canvas = None
             self.preview_label.clear()
             return
+        self.compose_preview()
+        if self.missing_tiles():
+            self.preview_timer.start()
+
+    def preview_box(self):
+        """当前布局下单元格内容区域的像素大小，自动排版时为当前页面上最大的放置区域"""
+        if self.auto_layout.isChecked():
+            current = self.current_auto_sheet()
+            if current is not None:
+                zoom = merge_engine.PREVIEW_ZOOM
+                return (max(1, int(max(x1 - x0 for x0, _, x1, _ in current[1].boxes) * zoom)),
+                        max(1, int(max(y1 - y0 for _, y0, _, y1 in current[1].boxes) * zoom)))
+        return merge_engine.preview_cell_size(self.rows.value(), self.cols.value(),
+                                              self.current_orientation())
+
+    def missing_tiles(self):
+        """当前页面上没有图块或图块比单元格小（需要放大显示）的页面"""
+        width, height = self.preview_box()
+        missing = []
+        for ref in dict.fromkeys(self.visible_pages()):
+            tile = self.preview_tiles.get(ref)
+            # 图块至少有一边达到单元格大小即可，缩小显示不损失清晰度
+            if tile is None or (tile.width() < width - 1 and tile.height() < height - 1):
+                missing.append(ref)
+        return missing
 
+    def compose_preview(self):
+        """把图块绘制到预览页面上，只重绘内容发生变化的单元格"""
+        if self.auto_layout.isChecked():
+            self.compose_auto_preview()
+            return
+        rows, cols = self.rows.value(), self.cols.value()
+        page_width, page_height = merge_engine.page_size_for(self.current_orientation())
+        width = round(page_width * merge_engine.PREVIEW_ZOOM)
+        height = round(page_height * merge_engine.PREVIEW_ZOOM)
+        layout = (rows, cols, self.current_orientation())
+        if self.preview_canvas is None or self.preview_layout != layout:
+            # 布局变化时重建页面，所有单元格都需要重绘
+            self.preview_canvas = QImage(width, height, QImage.Format_RGB32)
+            self.preview_canvas.fill(Qt.white)
+            self.preview_layout = layout
+            self.preview_cells = [None] * (rows * cols)
+
+        visible = self.visible_pages()
+        painter = QPainter(self.preview_canvas)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
         try:
-            # 创建临时PDF用于预览
-            temp_preview = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-            temp_preview.close()
-            temp_pdfs = []
-
-            # 处理所有文件
-            processed_files = []
-            total_files = len(self.files)
-            self.progress_bar.setValue(0)
-            self.progress_bar.setFormat("正在生成预览...")
-            QApplication.processEvents()
+            for index in range(rows * cols):
+                ref = visible[index] if index < len(visible) else None
+                tile = self.preview_tiles.get(ref)
+                # 同一文件换成更清晰的图块时也需要重绘
+                drawn = (ref, tile.cacheKey()) if tile is not None else None
+                if tile is not None:
+                    self.preview_tiles.move_to_end(ref)
+                if self.preview_cells[index] == drawn:
+                    continue
+                row, col = divmod(index, cols)
+                painter.fillRect(QRectF(col * width / cols, row * height / rows, width / cols, height / rows),
+                                 Qt.white)
+                if tile is not None:
+                    x0, y0, x1, y1 = merge_engine.cell_box(index, rows, cols, width, height,
+                                                           tile.width(), tile.height())
+                    painter.drawImage(QRectF(x0, y0, x1 - x0, y1 - y0), tile)
+                self.preview_cells[index] = drawn
+        finally:
+            painter.end()
+        self.preview_label.setPixmap(QPixmap.fromImage(self.preview_canvas))
 
-            for i, file in enumerate(self.files):
-                try:
-                    if file.lower().endswith('.pdf'):
-                        temp_pdf = self.process_pdf_page(file)
-                    else:
-                        temp_pdf = self.convert_image_to_pdf(file)
-                    temp_pdfs.append(temp_pdf)
-                    processed_files.append(temp_pdf)
-                    
-                    # 更新进度条
-                    progress_value = int(((i + 1) / total_files) * 50) # 前50%用于文件处理
-                    self.progress_bar.setValue(progress_value)
-                    self.progress_bar.setFormat(f'正在处理文件: %p% - {i + 1}/{total_files} 文件')
-                    QApplication.processEvents()
-
-                except Exception as e:
-                    error_msg = f'处理文件时出错：{str(e)}'
-                    self.log_error(error_msg)
-                    QMessageBox.warning(self, '警告', error_msg)
+    def compose_auto_preview(self):
+        """按自动排版的放置区域绘制当前预览页面"""
+        current = self.current_auto_sheet()
+        if current is None:
+            self.preview_canvas = None
+            self.preview_label.clear()
+            if self.auto_sheets() is None:
+                self.preview_label.setText('正在读取页面尺寸并自动排版...')
+            return
+        pages, sheet = current
+        zoom = merge_engine.PREVIEW_ZOOM
+        layout = (merge_engine.LAYOUT_AUTO, sheet)
+        if self.preview_canvas is None or self.preview_layout != layout:
+            self.preview_canvas = QImage(round(sheet.width * zoom), round(sheet.height * zoom),
+                                         QImage.Format_RGB32)
+            self.preview_canvas.fill(Qt.white)
+            self.preview_layout = layout
+            self.preview_cells = [None] * len(sheet.boxes)
+
+        painter = QPainter(self.preview_canvas)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        try:
+            for index, (ref, (x0, y0, x1, y1)) in enumerate(zip(pages, sheet.boxes)):
+                tile = self.preview_tiles.get(ref)
+                drawn = (ref, tile.cacheKey()) if tile is not None else None
+                if tile is not None:
+                    self.preview_tiles.move_to_end(ref)
+                if self.preview_cells[index] == drawn:
                     continue
+                rect = QRectF(x0 * zoom, y0 * zoom, (x1 - x0) * zoom, (y1 - y0) * zoom)
+                painter.fillRect(rect, Qt.white)
+                if tile is not None:
+                    painter.drawImage(rect, tile)
+                self.preview_cells[index] = drawn
+        finally:
+            painter.end()
+        self.preview_label.setPixmap(QPixmap.fromImage(self.preview_canvas))
 
-            if not processed_files:
-                self.progress_bar.setValue(0)
-                self.progress_bar.setFormat("预览生成失败")
-                return
+    def cancel_preview(self):
+        self.preview_timer.stop()
+        self.preview_request_id += 1
+        if self.preview_worker is not None:
+            self.preview_worker.cancel()
+            self.preview_worker = None
 
-            # 创建预览PDF
-            page_size = A4
-            if self.orientation.currentText() == '横向':
-                page_size = landscape(A4)
-
-            c = canvas.Canvas(temp_preview.name, pagesize=page_size)
-            page_width, page_height = page_size
-            rows = self.rows.value()
-            cols = self.cols.value()
-            cell_width = page_width / cols
-            cell_height = page_height / rows
-
-            for i, file_path in enumerate(processed_files):
-                if i >= rows * cols:
-                    break
-                
-                # 更新进度条
-                progress_value = int(50 + ((i + 1) / (rows * cols)) * 50) # 后50%用于渲染
-                self.progress_bar.setValue(progress_value)
-                self.progress_bar.setFormat(f'正在渲染预览: %p% - {i + 1}/{rows * cols} 页面')
-                QApplication.processEvents()
+    def start_preview(self):
+        self.cancel_preview()
+        missing = self.missing_tiles()
+        if not missing:
+            return
 
-                try:
-                    row = i // cols
-                    col = i % cols
-                    x = col * cell_width
-                    y = page_height - (row + 1) * cell_height
-
-                    # 计算缩放和居中
-                    doc = fitz.open(file_path)
-                    if doc.page_count > 0:
-                        page = doc[0]
-                        pdf_width = page.rect.width
-                        pdf_height = page.rect.height
-                        
-                        # 计算最佳缩放比例，保持纵横比
-                        scale_x = (cell_width * 0.95) / pdf_width  # 留出5%边距
-                        scale_y = (cell_height * 0.95) / pdf_height
-                        scale = min(scale_x, scale_y)
-                        
-                        # 计算居中位置
-                        scaled_width = pdf_width * scale
-                        scaled_height = pdf_height * scale
-                        centered_x = x + (cell_width - scaled_width) / 2
-                        centered_y = y + (cell_height - scaled_height) / 2
-
-                        # 将PDF页面转换为图像后绘制到画布上
-                        # 提高DPI以改善图像质量
-                        dpi = 1200  # 设置DPI为1200，提高图像质量
-                        pix = page.get_pixmap(matrix=fitz.Matrix(dpi/72, dpi/72))
-                        img_data = pix.tobytes("png")
-                        
-                        # 创建临时图像文件
-                        temp_img = tempfile.NamedTemporaryFile(delete=False, suffix='.png')
-                        temp_img.write(img_data)
-                        temp_img.close()
-                        
-                        c.saveState()
-                        c.translate(centered_x, centered_y)
-                        c.scale(scale, scale)
-                        c.drawImage(temp_img.name, 0, 0, width=pdf_width, height=pdf_height)
-                        c.restoreState()
-                        
-                        # 删除临时图像文件
-                        try:
-                            os.unlink(temp_img.name)
-                        except:
-                            pass
-                    doc.close()
-                except Exception as e:
-                    error_msg = f'预览文件时出错（{os.path.basename(file_path)}）：{str(e)}'
-                    self.log_error(error_msg, exc_info=True)
-                    QMessageBox.warning(self, '警告', error_msg)
-                    continue
+        if self.merge_worker is None:
+            self.progress_bar.setValue(0)
+            self.progress_bar.setFormat("正在生成预览...")
 
-            c.save()
+        worker = PreviewWorker(self.preview_request_id, missing, self.preview_box(), self.cache,
+                               self.page_index, self)
+        worker.progress.connect(self.on_preview_progress)
+        worker.warning.connect(self.on_preview_warning)
+        worker.tile_ready.connect(self.on_tile_ready)
+        worker.completed.connect(self.on_preview_completed)
+        worker.failed.connect(self.on_preview_failed)
+        worker.finished.connect(lambda: self.preview_workers.discard(worker))
+        worker.finished.connect(worker.deleteLater)
+        # 保留引用，直到被取消的旧线程真正结束
+        self.preview_workers.add(worker)
+        self.preview_worker = worker
+        worker.start()
 
-            # 使用PyMuPDF将PDF转换为图像进行预览
-            try:
-                doc = fitz.open(temp_preview.name)
-                page = doc[0]
-                pix = page.get_pixmap(matrix=fitz.Matrix(0.5, 0.5))  # 缩放为50%以适应显示
-                img_data = pix.tobytes("ppm")
-                qimg = QPixmap()
-                qimg.loadFromData(img_data)
-                
-                # 设置预览图像
-                self.preview_label.setPixmap(qimg)
-                doc.close()
-            except Exception as e:
-                error_msg = f'生成预览图像时出错：{str(e)}'
-                self.log_error(error_msg, exc_info=True)
-                QMessageBox.warning(self, '警告', error_msg)
+    def on_preview_progress(self, request_id, value, text):
+        # 合并期间进度条只显示合并进度
+        if request_id != self.preview_request_id or self.merge_worker is not None:
+            return
+        self.progress_bar.setValue(value)
+        self.progress_bar.setFormat(text)
 
-        except Exception as e:
-            error_msg = f'预览生成失败：{str(e)}'
-            self.log_error(error_msg, exc_info=True)
+    def on_preview_warning(self, request_id, error_msg):
+        if request_id == self.preview_request_id:
             QMessageBox.warning(self, '警告', error_msg)
-            self.preview_label.clear()
+
+    def on_tile_ready(self, request_id, ref, tile):
+        # 已取消的请求渲染好的图块同样可以保留，布局变化后只要不需要放大就能继续使用
+        if tile.isNull() or ref.path not in self.files:
+            return
+        old = self.preview_tiles.get(ref)
+        if old is not None and old.width() > tile.width():
+            return
+        self.preview_tiles[ref] = tile
+        visible = self.visible_pages()
+        limit = max(PREVIEW_TILE_LIMIT, len(visible))
+        while len(self.preview_tiles) > limit:
+            self.preview_tiles.popitem(last=False)
+        if ref in visible:
+            self.compose_preview()
+
+    def on_preview_completed(self, request_id):
+        if request_id != self.preview_request_id or self.merge_worker is not None:
+            return
+        self.progress_bar.setValue(100)
+        self.progress_bar.setFormat("预览完成")
+
+    def on_preview_failed(self, request_id, error_msg):
+        if request_id != self.preview_request_id:
+            return
+        if error_msg:
+            QMessageBox.warning(self, '警告', error_msg)
+        if self.merge_worker is None:
             self.progress_bar.setValue(0)
             self.progress_bar.setFormat("预览生成失败")
-            QApplication.processEvents()
 
-        finally:
-            # 清理临时文件
-            for temp_pdf in temp_pdfs:
-                try:
-                    os.unlink(temp_pdf)
-                except:
-                    pass
-            try:
-                os.unlink(temp_preview.name)
-            except:
-                pass
-            self.progress_bar.setValue(100)
-            self.progress_bar.setFormat("预览完成")
-            QApplication.processEvents()
+    def closeEvent(self, event):
+        # 未完成的合并取消后会删除不完整的输出文件
+        if self.merge_worker is not None:
+            self.merge_worker.cancel()
+            self.merge_worker.wait()
+        self.cancel_preview()
+        for worker in list(self.duplicate_workers) + list(self.count_workers) + list(self.plan_workers):
+            worker.cancel()
+        if self.sort_worker is not None:
+            self.sort_worker.wait()
+        for worker in (list(self.preview_workers) + list(self.duplicate_workers)
+                       + list(self.count_workers) + list(self.plan_workers)):
+            worker.wait()
+        self.page_index.close()
+        super().closeEvent(event)
 
     def merge_files(self):
         if not self.files:
             QMessageBox.warning(self, '警告', '请先添加文件！')
             return
+        if self.merge_worker is not None:
+            return
 
         output_file, _ = QFileDialog.getSaveFileName(
             self,
@@ -394,174 +1064,81 @@ class PDFMerger(QMainWindow):
         if not output_file:
             return
 
-        try:
-            # 创建临时PDF文件列表
-            temp_pdfs = []
-            processed_files = []
+        invoices = sidecar = None
+        if self.write_sidecar.isChecked():
+            invoices = self.invoice_index()
+            sidecar = os.path.splitext(output_file)[0] + '.csv'
 
-            # 处理所有输入文件
-            total_files_to_process = len(self.files)
-            self.progress_bar.setValue(0)
-            self.progress_bar.setFormat("正在处理文件...")
-            QApplication.processEvents()
+        self.progress_bar.setValue(0)
+        self.progress_bar.setFormat("正在处理文件...")
+        worker = MergeWorker(
+            self.files, self.rows.value(), self.cols.value(), output_file, self,
+            invoices=invoices, sidecar=sidecar,
+            orientation=self.current_orientation(), rasterize=self.rasterize.isChecked(),
+            workers=merge_engine.default_workers(), cache=self.cache, stream=True,
+            profile=self.quality.currentData(), page_ranges=dict(self.page_ranges),
+            index=self.page_index,
+            layout=merge_engine.LAYOUT_AUTO if self.auto_layout.isChecked() else merge_engine.LAYOUT_GRID)
+        worker.progress.connect(self.on_merge_progress)
+        worker.warning.connect(self.show_warning)
+        worker.completed.connect(self.on_merge_completed)
+        worker.failed.connect(self.on_merge_failed)
+        worker.cancelled.connect(self.on_merge_cancelled)
+        worker.finished.connect(self.on_merge_finished)
+        worker.finished.connect(worker.deleteLater)
+        self.merge_worker = worker
+        self.merge_button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+        worker.start()
 
-            for i, file in enumerate(self.files):
-                try:
-                    if file.lower().endswith('.pdf'):
-                        temp_pdf = self.process_pdf_page(file)
-                    else:
-                        temp_pdf = self.convert_image_to_pdf(file)
-                    temp_pdfs.append(temp_pdf)
-                    processed_files.append(temp_pdf)
-                    
-                    # 更新进度条
-                    progress_value = int(((i + 1) / total_files_to_process) * 50) # 前50%用于文件处理
-                    self.progress_bar.setValue(progress_value)
-                    self.progress_bar.setFormat(f'正在处理文件: %p% - {i + 1}/{total_files_to_process} 文件')
-                    QApplication.processEvents()
-
-                except Exception as e:
-                    error_msg = f'处理文件时出错：{str(e)}'
-                    self.log_error(error_msg)
-                    QMessageBox.warning(self, '警告', error_msg)
-                    continue
+    def cancel_merge(self):
+        if self.merge_worker is None:
+            return
+        self.merge_worker.cancel()
+        self.cancel_button.setEnabled(False)
+        self.progress_bar.setFormat("正在取消...")
 
-            if not processed_files:
-                QMessageBox.warning(self, '警告', '没有可处理的文件！')
-                self.progress_bar.setValue(0)
-                self.progress_bar.setFormat("合并失败")
-                return
+    def on_merge_progress(self, value, text):
+        if self.merge_worker is not None and not self.merge_worker.job.is_cancelled():
+            self.progress_bar.setValue(value)
+            self.progress_bar.setFormat(text)
 
-            # 设置页面大小和方向
-            page_size = A4
-            if self.orientation.currentText() == '横向':
-                page_size = landscape(A4)
-
-            # 创建输出PDF写入器
-            output_writer = PdfWriter()
-            
-            # 计算每页的网格大小
-            rows = self.rows.value()
-            cols = self.cols.value()
-            files_per_page = rows * cols
-            
-            # 按页处理文件
-            for i in range(0, len(processed_files), files_per_page):
-                page_files = processed_files[i:i + files_per_page]
-                
-                # 创建新的空白页面
-                temp_page = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-                temp_page.close()
-                c = canvas.Canvas(temp_page.name, pagesize=page_size)
-                page_width, page_height = page_size
-                
-                # 计算每个文件的显示区域大小
-                cell_width = page_width / cols
-                cell_height = page_height / rows
-
-                # 在页面上排列文件
-                for j, pdf_file in enumerate(page_files):
-                    try:
-                        row = j // cols
-                        col = j % cols
-                        
-                        # 计算当前单元格的位置
-                        x = col * cell_width
-                        y = page_height - (row + 1) * cell_height
-
-                        # 使用PyMuPDF读取PDF
-                        doc = fitz.open(pdf_file)
-                        if doc.page_count > 0:
-                            page = doc[0]
-                            pdf_width = page.rect.width
-                            pdf_height = page.rect.height
-                            
-                            # 计算最佳缩放比例，保持纵横比
-                            scale_x = (cell_width * 0.95) / pdf_width  # 留出5%边距
-                            scale_y = (cell_height * 0.95) / pdf_height
-                            scale = min(scale_x, scale_y)
-                            
-                            # 计算居中位置
-                            scaled_width = pdf_width * scale
-                            scaled_height = pdf_height * scale
-                            centered_x = x + (cell_width - scaled_width) / 2
-                            centered_y = y + (cell_height - scaled_height) / 2
-
-                            # 将PDF页面转换为图像后绘制到画布上
-                            # 提高DPI以改善图像质量
-                            dpi = 1200  # 设置DPI为1200，提高图像质量
-                            pix = page.get_pixmap(matrix=fitz.Matrix(dpi/72, dpi/72))
-                            img_data = pix.tobytes("png")
-                            
-                            # 创建临时图像文件
-                            temp_img = tempfile.NamedTemporaryFile(delete=False, suffix='.png')
-                            temp_img.write(img_data)
-                            temp_img.close()
-
-                        # 更新进度条
-                        current_file_index = i + j
-                        progress_value = int(50 + ((current_file_index + 1) / len(processed_files)) * 50) # 后50%用于合并
-                        self.progress_bar.setValue(progress_value)
-                        self.progress_bar.setFormat(f'正在合并: %p% - {current_file_index + 1}/{len(processed_files)} 文件')
-                        QApplication.processEvents() # 允许UI更新
-
-                            
-                        if doc.page_count > 0:
-                            c.saveState()
-                            c.translate(centered_x, centered_y)
-                            c.scale(scale, scale)
-                            c.drawImage(temp_img.name, 0, 0, width=pdf_width, height=pdf_height)
-                            c.restoreState()
-                            
-                            # 删除临时图像文件
-                            try:
-                                os.unlink(temp_img.name)
-                            except:
-                                pass
-                        doc.close()
-                    except Exception as e:
-                        error_msg = f'处理文件时出错（{os.path.basename(pdf_file)}）：{str(e)}'
-                        self.log_error(error_msg, exc_info=True)
-                        QMessageBox.warning(self, '警告', error_msg)
-                        continue
-
-                # 保存当前页面
-                c.save()
-                
-                # 将当前页面添加到输出PDF
-                reader = PdfReader(temp_page.name)
-                output_writer.add_page(reader.pages[0])
-                temp_pdfs.append(temp_page.name)
-
-            # 保存最终的PDF文件
-            with open(output_file, 'wb') as output:
-                output_writer.write(output)
-
-            QMessageBox.information(self, '成功', '文件合并完成！')
-            self.progress_bar.setValue(100)
-            self.progress_bar.setFormat("合并完成")
-            QApplication.processEvents() # 允许UI更新
+    def on_merge_completed(self, pages):
+        self.progress_bar.setValue(100)
+        self.progress_bar.setFormat("合并完成")
+        QMessageBox.information(self, '成功', '文件合并完成！')
 
-        except Exception as e:
-            error_msg = f'文件合并失败：{str(e)}'
-            self.log_error(error_msg, exc_info=True)
+    def on_merge_failed(self, error_msg, unexpected):
+        self.progress_bar.setValue(0)
+        self.progress_bar.setFormat("合并失败")
+        if unexpected:
             QMessageBox.critical(self, '错误', error_msg)
-            self.progress_bar.setValue(0)
-            self.progress_bar.setFormat("合并失败")
-            QApplication.processEvents()
+        else:
+            QMessageBox.warning(self, '警告', error_msg)
 
-        finally:
-            # 清理临时文件
-            for temp_pdf in temp_pdfs:
-                try:
-                    os.unlink(temp_pdf)
-                except:
-                    pass
+    def on_merge_cancelled(self):
+        self.progress_bar.setValue(0)
+        self.progress_bar.setFormat("合并已取消")
+
+    def on_merge_finished(self):
+        self.merge_worker = None
+        self.merge_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
 
 def main():
+    # 打包后的程序在工作进程中启动时需要先调用
+    multiprocessing.freeze_support()
+    # 设置环境变量 PDF_MERGER_METRICS=1 时记录各阶段耗时
+    merge_metrics.configure_from_env()
     app = QApplication(sys.argv)
     merger = PDFMerger()
     merger.show()
+    # 进入事件循环、窗口绘制完成后再开始预加载
+    QTimer.singleShot(0, lambda: merge_metrics.elapsed('startup', STARTUP_TIME))
+    if os.environ.get(STARTUP_CHECK_ENV):
+        QTimer.singleShot(0, app.quit)
+    else:
+        QTimer.singleShot(0, merger.warm_up)
     sys.exit(app.exec_())
 
 if __name__ == '__main__':
@@ -1,23 +1,34 @@
 # -*- mode: python ; coding: utf-8 -*-
-from PyInstaller.utils.hooks import collect_all
+# 打包为目录（onedir）而不是单个exe：单文件程序每次启动都要先把全部依赖解压到
+# 临时目录，这是打包后启动慢的主要原因。PyQt5 使用 PyInstaller 自带的钩子，
+# 只收集实际用到的模块和插件，不再用 collect_all 打包整个 Qt。
 
-datas = []
-binaries = []
-hiddenimports = ['PyQt5.sip']
-tmp_ret = collect_all('PyQt5')
-datas += tmp_ret[0]; binaries += tmp_ret[1]; hiddenimports += tmp_ret[2]
+# 程序没有用到的库，避免被间接依赖带入
+excludes = [
+    'tkinter',
+    'reportlab',
+    'PyPDF2',
+    'PyQt5.QtWebEngine',
+    'PyQt5.QtWebEngineCore',
+    'PyQt5.QtWebEngineWidgets',
+    'PyQt5.QtQml',
+    'PyQt5.QtQuick',
+    'PyQt5.QtMultimedia',
+    'PyQt5.QtSql',
+    'PyQt5.QtTest',
+]
 
 
 a = Analysis(
     ['pdf_merger.py'],
     pathex=[],
-    binaries=binaries,
-    datas=datas,
-    hiddenimports=hiddenimports,
+    binaries=[],
+    datas=[],
+    hiddenimports=['PyQt5.sip'],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
-    excludes=[],
+    excludes=excludes,
     noarchive=False,
     optimize=0,
 )
@@ -26,16 +37,14 @@ pyz = PYZ(a.pure)
 exe = EXE(
     pyz,
     a.scripts,
-    a.binaries,
-    a.datas,
     [],
+    exclude_binaries=True,
     name='pdf_merger',
     debug=False,
     bootloader_ignore_signals=False,
     strip=False,
-    upx=True,
-    upx_exclude=[],
-    runtime_tmpdir=None,
+    # UPX压缩的文件每次加载都要解压，会拖慢启动
+    upx=False,
     console=False,
     disable_windowed_traceback=False,
     argv_emulation=False,
@@ -43,3 +52,12 @@ exe = EXE(
     codesign_identity=None,
     entitlements_file=None,
 )
+coll = COLLECT(
+    exe,
+    a.binaries,
+    a.datas,
+    strip=False,
+    upx=False,
+    upx_exclude=[],
+    name='pdf_merger',
+)
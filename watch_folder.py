@@ -0,0 +1,446 @@
+"""监视文件夹，自动合并新到的发票
+
+长期运行，发现文件夹中新增的PDF和图片后立即在后台规范化（结果存入页面缓存），
+每积累 N 个文件或每隔一段时间把这些文件合并为一个PDF写到输出目录。已经合并过的
+文件按内容哈希记录在输出目录的状态文件中，改名、复制或重启后都不会再次处理。
+
+Linux 下使用 inotify 在文件写完或移入时立即得到通知，其他系统定时轮询目录，
+文件大小和修改时间在两次轮询之间不再变化时才认为写完。
+
+    python watch_folder.py 扫描件 -o 合并结果 --batch-files 20
+    python watch_folder.py 扫描件 -o 合并结果 -r 3 -c 2 --every 3600
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import duplicate_index
+import merge_engine
+import merge_metrics
+import page_cache
+from merge_engine import MergeError
+
+logger = logging.getLogger('pdf_merger')
+
+# 已合并文件的记录，保存在输出目录中
+STATE_FILE = '.pdf_merger_watch.json'
+# 默认每积累多少个文件合并一次
+DEFAULT_BATCH_FILES = 20
+# 轮询目录的间隔（秒）；使用 inotify 时为检查定时合并的最长间隔
+DEFAULT_POLL_INTERVAL = 2.0
+# 输出文件名前缀，后接合并时间
+OUTPUT_PREFIX = '发票合并'
+# 每隔多少秒清理一次已不存在的文件的记录
+PRUNE_INTERVAL = 3600.0
+
+# inotify 事件：写入后关闭、移入目录、事件队列溢出
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+def _is_candidate(name):
+    # 跳过隐藏文件和 Office 等程序的临时文件
+    return not name.startswith(('.', '~$')) and merge_engine.is_supported(name)
+
+
+def _is_inside(path, folder):
+    """path 是否为 folder 本身或其中的子目录"""
+    path, folder = os.path.realpath(path), os.path.realpath(folder)
+    try:
+        return os.path.commonpath([path, folder]) == folder
+    except ValueError:
+        # Windows 下位于不同的盘符
+        return False
+
+
+class PollingWatcher:
+    """定时扫描目录，返回大小和修改时间在两次扫描之间不再变化的新文件"""
+
+    def __init__(self, folder, interval=DEFAULT_POLL_INTERVAL):
+        self.folder = folder
+        self.interval = interval
+        # 上次扫描时各文件的 (大小, 修改时间)，以及已经返回过的文件返回时的状态
+        self._sizes = {}
+        self._reported = {}
+
+    def poll(self, timeout):
+        """等待最多 timeout 秒，返回写完的新文件列表"""
+        time.sleep(max(0.0, min(timeout, self.interval)))
+        ready = []
+        current = {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if not entry.is_file() or not _is_candidate(entry.name):
+                    continue
+                stat = entry.stat()
+                state = (stat.st_size, stat.st_mtime_ns)
+                current[entry.path] = state
+                if self._sizes.get(entry.path) == state and self._reported.get(entry.path) != state:
+                    self._reported[entry.path] = state
+                    ready.append(entry.path)
+        self._sizes = current
+        self._reported = {path: state for path, state in self._reported.items() if path in current}
+        return sorted(ready)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """Linux inotify：文件写完关闭或移入目录时立即返回"""
+
+    def __init__(self, folder, settle=DEFAULT_POLL_INTERVAL):
+        import ctypes
+        self.folder = folder
+        self.settle = settle
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), '无法初始化 inotify')
+        if libc.inotify_add_watch(self._fd, os.fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            error = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(error, f'无法监视文件夹：{folder}')
+        self._initial = True
+        # 扫描时刚修改过的文件 -> 修改时间：可能还没写完，关闭事件也可能发生在开始监视之前，
+        # 在 settle 秒内没有再变化时返回
+        self._recent = {}
+
+    def _scan(self):
+        cutoff = time.time() - self.settle
+        ready = []
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.is_file() and _is_candidate(entry.name):
+                    mtime = entry.stat().st_mtime
+                    if mtime < cutoff:
+                        ready.append(entry.path)
+                    else:
+                        self._recent[entry.path] = mtime
+        return sorted(ready)
+
+    def _settled(self):
+        ready = []
+        cutoff = time.time() - self.settle
+        for path, mtime in list(self._recent.items()):
+            try:
+                current = os.stat(path).st_mtime
+            except OSError:
+                del self._recent[path]
+                continue
+            if current != mtime:
+                self._recent[path] = current
+            elif current < cutoff:
+                del self._recent[path]
+                ready.append(path)
+        return ready
+
+    def _read_events(self, timeout):
+        readable, _, _ = select.select([self._fd], [], [], max(0.0, timeout))
+        if not readable:
+            return []
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        ready = []
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # 事件丢失时重新扫描整个目录，已处理的文件会按内容哈希跳过
+                return self._scan()
+            path = os.path.join(self.folder, name)
+            if name and _is_candidate(name) and path not in ready:
+                ready.append(path)
+        return ready
+
+    def poll(self, timeout):
+        """等待最多 timeout 秒，返回写完的新文件列表"""
+        if self._initial:
+            self._initial = False
+            return self._scan()
+        if self._recent:
+            timeout = min(timeout, self.settle)
+        ready = self._read_events(timeout)
+        for path in ready:
+            self._recent.pop(path, None)
+        return ready + self._settled()
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def create_watcher(folder, poll_interval=DEFAULT_POLL_INTERVAL, polling=False):
+    """Linux 下优先使用 inotify，不可用时（或 polling=True）定时轮询"""
+    if not polling and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(folder, poll_interval)
+        except (OSError, AttributeError):
+            logger.info('inotify 不可用，改为定时轮询')
+    return PollingWatcher(folder, poll_interval)
+
+
+class FolderMerger:
+    """监视文件夹并分批合并新文件
+
+    新文件到达后在后台线程中规范化到 cache，合并时直接复用。batch_files 个文件
+    积累齐或距上次合并超过 every 秒时合并一次。内容相同的文件只合并一次。
+    merge_options 为 merge 的其他关键字参数（orientation、profile、workers 等）。
+    """
+
+    def __init__(self, folder, output_dir, rows=2, cols=2, batch_files=DEFAULT_BATCH_FILES,
+                 every=None, cache=None, poll_interval=DEFAULT_POLL_INTERVAL, watcher=None,
+                 **merge_options):
+        if not os.path.isdir(folder):
+            raise MergeError(f'找不到要监视的文件夹：{folder}')
+        if _is_inside(output_dir, folder):
+            # 否则合并结果会被当作新发票再次合并
+            raise MergeError(f'输出目录不能是被监视的文件夹或其中的子文件夹：{output_dir}')
+        os.makedirs(output_dir, exist_ok=True)
+        self.folder = folder
+        self.output_dir = output_dir
+        self.rows = rows
+        self.cols = cols
+        self.batch_files = max(1, batch_files) if batch_files else None
+        self.every = every
+        self.cache = cache if cache is not None else page_cache.PageCache()
+        self.poll_interval = poll_interval
+        self.watcher = watcher
+        self.merge_options = merge_options
+        self.state_path = os.path.join(output_dir, STATE_FILE)
+        self.processed = self._load_state()
+        self.pending = []
+        self.outputs = []
+        # 文件 -> 指纹：本次运行中已经检查过的文件，内容不变时不再计算哈希
+        self._seen = {}
+        # 上次清理时记录的文件已经不存在的内容哈希
+        self._missing = set()
+        self._next_prune = time.monotonic() + PRUNE_INTERVAL
+        self._pending_digests = set()
+        self._prefetches = []
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._next_emit = time.monotonic() + every if every else None
+        self._stop = threading.Event()
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, encoding='utf-8') as f:
+                return json.load(f).get('processed', {})
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            raise MergeError(f'无法读取状态文件 {self.state_path}：{e}')
+
+    def _save_state(self):
+        # 先写临时文件再替换，中途退出也不会损坏已有记录
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'processed': self.processed}, f, ensure_ascii=False, indent=1)
+        os.replace(temp_path, self.state_path)
+
+    def stop(self):
+        """让 run() 在当前一轮结束后返回（可在其他线程中调用）"""
+        self._stop.set()
+
+    def add(self, path):
+        """登记新文件并在后台规范化；已合并过或已在等待中的文件返回 False"""
+        try:
+            fingerprint = page_cache.file_fingerprint(path)
+            if self._seen.get(path) == fingerprint:
+                return False
+            self._seen[path] = fingerprint
+            digest = duplicate_index.content_hash(path)
+        except OSError:
+            # 文件在检查前又被移走
+            return False
+        if digest in self.processed or digest in self._pending_digests:
+            logger.info('跳过已处理的文件：%s', os.path.basename(path))
+            entry = self.processed.get(digest)
+            if (entry is not None and entry.get('path') != path
+                    and not os.path.exists(entry.get('path') or '')):
+                # 改名或移动后记录新位置，清理时才不会因为原路径不存在而忘记它；
+                # 原文件还在时是复制出的文件，记录仍指向原文件
+                entry['path'] = path
+                self._save_state()
+            return False
+        self.pending.append((path, digest))
+        self._pending_digests.add(digest)
+        self._prefetches.append(self._executor.submit(self._prefetch, path))
+        logger.info('发现新文件：%s（等待合并 %d 个）', os.path.basename(path), len(self.pending))
+        return True
+
+    def _prefetch(self, path):
+        try:
+            merge_engine.prefetch(
+                [path], self.rows, self.cols, self.merge_options.get('orientation', merge_engine.PORTRAIT),
+                self.cache, self.merge_options.get('profile', merge_engine.DEFAULT_PROFILE),
+                on_error=lambda msg: logger.warning('%s', msg),
+                layout=self.merge_options.get('layout', merge_engine.LAYOUT_GRID))
+        except Exception:
+            # 出错的文件在合并时会再次报告并被跳过
+            merge_engine.log_error(f'预先处理文件时出错（{os.path.basename(path)}）', exc_info=True)
+
+    def due(self):
+        """是否应该合并等待中的文件"""
+        if not self.pending:
+            return False
+        if self.batch_files and len(self.pending) >= self.batch_files:
+            return True
+        return self._next_emit is not None and time.monotonic() >= self._next_emit
+
+    def _output_path(self):
+        stamp = time.strftime('%Y%m%d_%H%M%S')
+        path = os.path.join(self.output_dir, f'{OUTPUT_PREFIX}_{stamp}.pdf')
+        suffix = 2
+        while os.path.exists(path):
+            path = os.path.join(self.output_dir, f'{OUTPUT_PREFIX}_{stamp}_{suffix}.pdf')
+            suffix += 1
+        return path
+
+    def emit(self):
+        """合并所有等待中的文件，返回输出文件路径；没有可输出的页面时返回 None"""
+        if self.every:
+            self._next_emit = time.monotonic() + self.every
+        if not self.pending:
+            return None
+        for future in self._prefetches:
+            future.result()
+        self._prefetches = []
+        batch = self.pending
+        output = self._output_path()
+        try:
+            pages = merge_engine.merge(
+                [path for path, _ in batch], self.rows, self.cols, output=output, cache=self.cache,
+                on_error=lambda msg: logger.warning('%s', msg), **self.merge_options)
+        except MergeError as e:
+            # 整批都无法处理（如文件全部损坏）时同样记为已处理，避免反复重试
+            logger.warning('合并失败：%s', e)
+            output, pages = None, 0
+        except OSError as e:
+            # 写出失败（磁盘已满、没有权限等）时保留等待中的文件，下次再试
+            logger.warning('写出合并结果失败，稍后重试：%s', e)
+            return None
+        self.pending = []
+        self._pending_digests.clear()
+        merged_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+        for path, digest in batch:
+            self.processed[digest] = {'path': path, 'output': output, 'time': merged_at}
+        self._save_state()
+        if output is not None:
+            self.outputs.append(output)
+            logger.info('已合并 %d 个文件 -> %d 页 -> %s', len(batch), pages, output)
+        return output
+
+    def prune(self):
+        """忘记已经不存在的文件，长期运行时记录不会无限增长
+
+        已合并文件的原路径连续两次清理时都不存在才删除记录，改名或移动的文件在此之前
+        已经按内容重新登记了新路径。
+        """
+        self._seen = {path: fingerprint for path, fingerprint in self._seen.items()
+                      if os.path.exists(path)}
+        missing = {digest for digest, entry in self.processed.items()
+                   if not os.path.exists(entry.get('path') or '')}
+        stale = missing & self._missing
+        for digest in stale:
+            del self.processed[digest]
+        self._missing = missing - stale
+        if stale:
+            self._save_state()
+            logger.info('已清理 %d 个不存在的文件的记录', len(stale))
+
+    def run(self):
+        """监视文件夹直到 stop() 被调用，退出时等待中的文件保留到下次运行"""
+        watcher = self.watcher or create_watcher(self.folder, self.poll_interval)
+        logger.info('开始监视：%s -> %s', self.folder, self.output_dir)
+        try:
+            while not self._stop.is_set():
+                timeout = self.poll_interval
+                if self._next_emit is not None:
+                    timeout = min(timeout, self._next_emit - time.monotonic())
+                for path in watcher.poll(timeout):
+                    self.add(path)
+                if self.due():
+                    self.emit()
+                if time.monotonic() >= self._next_prune:
+                    self._next_prune = time.monotonic() + PRUNE_INTERVAL
+                    self.prune()
+        finally:
+            watcher.close()
+            self._executor.shutdown(wait=True)
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description='监视文件夹，自动合并新到的发票')
+    parser.add_argument('folder', help='要监视的文件夹')
+    parser.add_argument('-o', '--output-dir', required=True, help='合并结果的输出目录')
+    parser.add_argument('-r', '--rows', type=int, default=2, help='每页行数（默认2）')
+    parser.add_argument('-c', '--cols', type=int, default=2, help='每页列数（默认2）')
+    parser.add_argument('--landscape', action='store_true', help='横向页面')
+    parser.add_argument('--auto-layout', action='store_true',
+                        help='按页面实际尺寸自动排版（忽略行数和列数）')
+    parser.add_argument('--batch-files', type=int, default=DEFAULT_BATCH_FILES,
+                        help=f'每积累多少个新文件合并一次（默认{DEFAULT_BATCH_FILES}，0 表示只按时间合并）')
+    parser.add_argument('--every', type=float, default=None,
+                        help='每隔多少秒合并一次已到达的文件（默认不按时间合并）')
+    parser.add_argument('--quality', choices=sorted(merge_engine.QUALITY_PROFILES),
+                        default=merge_engine.DEFAULT_PROFILE, help='输出质量')
+    parser.add_argument('--rasterize', action='store_true', help='按图像嵌入PDF页面（兼容模式）')
+    parser.add_argument('-j', '--workers', type=int, default=merge_engine.default_workers(),
+                        help='合并时的工作进程数')
+    parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL,
+                        help=f'轮询目录的间隔（秒，默认{DEFAULT_POLL_INTERVAL}）')
+    parser.add_argument('--polling', action='store_true', help='不使用 inotify，始终定时轮询')
+    parser.add_argument('--cache-dir', default=page_cache.default_cache_dir(),
+                        help='磁盘缓存目录')
+    parser.add_argument('--no-cache', action='store_true', help='只使用内存缓存')
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    merge_metrics.configure_from_env()
+    if not args.batch_files and not args.every:
+        print('--batch-files 为 0 时必须指定 --every', file=sys.stderr)
+        return 2
+    try:
+        cache = page_cache.PageCache(disk_dir=None if args.no_cache else args.cache_dir)
+        folder_merger = FolderMerger(
+            args.folder, args.output_dir, args.rows, args.cols, batch_files=args.batch_files,
+            every=args.every, cache=cache, poll_interval=args.poll_interval,
+            watcher=create_watcher(args.folder, args.poll_interval, args.polling),
+            orientation=merge_engine.LANDSCAPE if args.landscape else merge_engine.PORTRAIT,
+            profile=args.quality, rasterize=args.rasterize, workers=args.workers,
+            layout=merge_engine.LAYOUT_AUTO if args.auto_layout else merge_engine.LAYOUT_GRID)
+    except (MergeError, OSError) as e:
+        print(f'无法开始监视：{e}', file=sys.stderr)
+        return 1
+    try:
+        folder_merger.run()
+    except KeyboardInterrupt:
+        logger.info('已停止，%d 个等待中的文件留到下次运行', len(folder_merger.pending))
+    return 0
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())